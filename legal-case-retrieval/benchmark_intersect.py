@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+import sys
+import getopt
+import random
+import time
+
+from dictionary import Dictionary
+from postingsfile import PostingsFile
+import intersect
+import biword
+import zones
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file [-n num-pairs] [-r repeats]")
+
+
+def get_term_pairs(dictionary, num_pairs):
+    """
+    Picks pairs of terms of the index with different shapes of postings lists:
+    a rare and a common term, two common terms, and two terms of about the same document frequency.
+
+    Returns:
+        - pairs: { kind: [ (term, term), ... ] }
+    """
+    terms = sorted(dictionary.get_terms(), key=dictionary.get_df)
+    terms = [term for term in terms if dictionary.get_df(term) > 1 and not biword.is_biword(term) and not zones.is_zone_term(term)]
+
+    rare = terms[:len(terms) // 2]
+    common = terms[-max(len(terms) // 100, 2):]
+
+    random.seed(0)
+
+    pairs = {"skewed": [], "common": [], "similar": []}
+    for _ in range(num_pairs):
+        pairs["skewed"].append((random.choice(rare), random.choice(common)))
+        pairs["common"].append(tuple(random.sample(common, 2)))
+
+        idx = random.randrange(len(terms) - 1)
+        pairs["similar"].append((terms[idx], terms[idx + 1]))
+
+    return pairs
+
+
+def run_benchmark(dict_file, postings_file, num_pairs, repeats):
+    """
+    Times each intersection engine on the postings lists of pairs of terms of the index,
+    and checks that all engines return the same results.
+    """
+    dictionary = Dictionary(dict_file)
+    dictionary.load()
+    postings = PostingsFile(postings_file, use_mmap=True)
+
+    print("%-10s %12s %12s" % ("pairs", "avg shorter", "avg longer") + "".join("%12s" % name for name in intersect.ENGINES))
+
+    for kind, pairs in get_term_pairs(dictionary, num_pairs).items():
+        postings_lists = []
+        for term_1, term_2 in pairs:
+            lists = []
+            for term in (term_1, term_2):
+                offset, size = dictionary.get_offset_and_size_of_term(term)
+                lists.append(postings.get_posting_list(offset, size, dictionary))
+            postings_lists.append(lists)
+
+        expected = [intersect.intersect_merge(list_1, list_2) for list_1, list_2 in postings_lists]
+
+        timings = []
+        for name, engine in intersect.ENGINES.items():
+            results = [engine(list_1, list_2) for list_1, list_2 in postings_lists]
+            assert results == expected, name + " returned different results"
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for list_1, list_2 in postings_lists:
+                    engine(list_1, list_2)
+            timings.append((time.perf_counter() - start) / (repeats * len(postings_lists)))
+
+        avg_short = sum(min(len(list_1), len(list_2)) for list_1, list_2 in postings_lists) / len(postings_lists)
+        avg_long = sum(max(len(list_1), len(list_2)) for list_1, list_2 in postings_lists) / len(postings_lists)
+
+        print("%-10s %12s %12s" % (kind, "%d" % avg_short, "%d" % avg_long)
+                + "".join("%10.1fus" % (timing * 1e6) for timing in timings))
+
+    postings.close()
+
+
+if __name__ == "__main__":
+    dictionary_file = postings_file = None
+    num_pairs = 50
+    repeats = 20
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:n:r:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-n':
+            num_pairs = int(a)
+        elif o == '-r':
+            repeats = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None:
+        usage()
+        sys.exit(2)
+
+    run_benchmark(dictionary_file, postings_file, num_pairs, repeats)
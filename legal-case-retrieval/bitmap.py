@@ -0,0 +1,243 @@
+"""
+Compressed bitmaps of docIDs, in the layout of roaring bitmaps.
+
+The docIDs are grouped by their high 16 bits into containers of their low 16 bits. A container with
+at most ARRAY_MAX_SIZE documents is a sorted array of 16 bit integers, and a container with more
+documents is a bitset of 2^16 bits, held as a Python integer, so that a container never takes more
+than 8 KB and sparse sets of documents take 2 bytes per document.
+
+Saved as the size in bytes of a header of variable-byte encoded integers (see `codec.py`) as 4 bytes
+little-endian, the header, and the contents of the containers:
+
+    header_size
+    num_of_containers key1 num_of_docs1 key2 num_of_docs2 ...
+    container1 container2 ...
+
+where a container is its num_of_docs low 16 bits as 2 bytes little-endian each, or its bitset as 8 KB little-endian.
+"""
+import bisect
+import sys
+from array import array
+
+import codec
+import intersect
+
+ARRAY_MAX_SIZE = 4096  # Containers with more documents are stored as bitsets
+BITSET_BYTES = 1 << 13  # Bytes of the bitset of a container of 2^16 bits
+
+
+def get_bitset(container):
+    """
+    Returns the container as a bitset.
+    """
+    if isinstance(container, int):
+        return container
+
+    bits = bytearray(BITSET_BYTES)
+    for low in container:
+        bits[low >> 3] |= 1 << (low & 7)
+
+    return int.from_bytes(bits, 'little')
+
+
+def get_lows(container):
+    """
+    Returns the sorted low 16 bits of the documents of the container.
+    """
+    if not isinstance(container, int):
+        return container
+
+    lows = array('H')
+    for idx, byte in enumerate(container.to_bytes(BITSET_BYTES, 'little')):
+        while byte:
+            lowest_bit = byte & -byte
+            lows.append((idx << 3) | (lowest_bit.bit_length() - 1))
+            byte ^= lowest_bit
+
+    return lows
+
+
+def make_container(bits):
+    """
+    Returns the container of the bitset, as a sorted array if it has at most ARRAY_MAX_SIZE documents. None if empty.
+    """
+    num_of_docs = bits.bit_count()
+
+    if num_of_docs == 0:
+        return None
+    if num_of_docs > ARRAY_MAX_SIZE:
+        return bits
+
+    return get_lows(bits)
+
+
+def get_size(container):
+    if isinstance(container, int):
+        return container.bit_count()
+
+    return len(container)
+
+
+class Bitmap(object):
+    """
+    Immutable compressed set of docIDs.
+    """
+    def __init__(self, keys=None, containers=None):
+        self.keys = keys if keys is not None else []  # Sorted high 16 bits of the docIDs
+        self.containers = containers if containers is not None else []  # Container of each key
+        self.num_of_docs = sum(get_size(container) for container in self.containers)
+
+    @staticmethod
+    def from_sorted(doc_ids):
+        """
+        Returns the bitmap of the docIDs, given in increasing order.
+        """
+        keys = []
+        containers = []
+
+        for doc_id in doc_ids:
+            high = doc_id >> 16
+            if not keys or keys[-1] != high:
+                keys.append(high)
+                containers.append(array('H'))
+
+            containers[-1].append(doc_id & 0xFFFF)
+
+        containers = [get_bitset(container) if len(container) > ARRAY_MAX_SIZE else container for container in containers]
+
+        return Bitmap(keys, containers)
+
+    def __len__(self):
+        return self.num_of_docs
+
+    def __contains__(self, doc_id):
+        doc_id = int(doc_id)
+
+        idx = bisect.bisect_left(self.keys, doc_id >> 16)
+        if idx == len(self.keys) or self.keys[idx] != doc_id >> 16:
+            return False
+
+        container = self.containers[idx]
+        low = doc_id & 0xFFFF
+
+        if isinstance(container, int):
+            return container >> low & 1 == 1
+
+        low_idx = bisect.bisect_left(container, low)
+        return low_idx < len(container) and container[low_idx] == low
+
+    def __iter__(self):
+        for high, container in zip(self.keys, self.containers):
+            high <<= 16
+            for low in get_lows(container):
+                yield high | low
+
+    def combine(self, other, combine_bits, keep_missing_self, keep_missing_other):
+        """
+        Combines the containers of the two bitmaps with the same key with the function of their bitsets.
+        Containers of keys in only one bitmap are kept if keep_missing_self or keep_missing_other.
+        """
+        keys = []
+        containers = []
+
+        i = j = 0
+        while i < len(self.keys) or j < len(other.keys):
+            if j == len(other.keys) or (i < len(self.keys) and self.keys[i] < other.keys[j]):
+                key, container = self.keys[i], (self.containers[i] if keep_missing_self else None)
+                i += 1
+            elif i == len(self.keys) or other.keys[j] < self.keys[i]:
+                key, container = other.keys[j], (other.containers[j] if keep_missing_other else None)
+                j += 1
+            else:
+                key, container = self.keys[i], make_container(combine_bits(get_bitset(self.containers[i]), get_bitset(other.containers[j])))
+                i += 1
+                j += 1
+
+            if container is not None:
+                keys.append(key)
+                containers.append(container)
+
+        return Bitmap(keys, containers)
+
+    def __and__(self, other):
+        return self.combine(other, lambda bits_1, bits_2: bits_1 & bits_2, False, False)
+
+    def __or__(self, other):
+        return self.combine(other, lambda bits_1, bits_2: bits_1 | bits_2, True, True)
+
+    def __sub__(self, other):
+        return self.combine(other, lambda bits_1, bits_2: bits_1 & ~bits_2, True, False)
+
+    def filter_postings(self, postings):
+        """
+        Returns the postings [ (docID, ...), ... ] sorted by docID of the documents in the bitmap.
+        When the bitmap has much fewer documents than the postings list, each of its documents is found
+        by galloping in the postings list, so that heavily filtered postings lists are not scanned.
+        """
+        if len(self) * intersect.GALLOPING_RATIO >= len(postings):
+            return [posting for posting in postings if posting[0] in self]
+
+        filtered = []
+        idx = 0
+        for doc_id in self:
+            idx = intersect.gallop(postings, doc_id, idx)
+            if idx == len(postings):
+                break
+
+            if postings[idx][0] == doc_id:
+                filtered.append(postings[idx])
+
+        return filtered
+
+    def to_bytes(self):
+        header = bytearray()
+        codec.encode_varint(len(self.keys), header)
+
+        for key, container in zip(self.keys, self.containers):
+            codec.encode_varint(key, header)
+            codec.encode_varint(get_size(container), header)
+
+        out = bytearray(len(header).to_bytes(4, 'little'))
+        out += header
+
+        for container in self.containers:
+            if isinstance(container, int):
+                out += container.to_bytes(BITSET_BYTES, 'little')
+            else:
+                lows = array('H', container)
+                if sys.byteorder == 'big':
+                    lows.byteswap()
+
+                out += lows.tobytes()
+
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        Decodes a bitmap saved by `to_bytes`.
+        """
+        header_size = int.from_bytes(data[:4], 'little')
+        values = codec.decode_varints(data[4:4 + header_size])
+        num_of_containers = values[0]
+        offset = 4 + header_size
+
+        keys = []
+        containers = []
+        for i in range(num_of_containers):
+            num_of_docs = values[2 + 2 * i]
+            keys.append(values[1 + 2 * i])
+
+            if num_of_docs > ARRAY_MAX_SIZE:
+                containers.append(int.from_bytes(data[offset:offset + BITSET_BYTES], 'little'))
+                offset += BITSET_BYTES
+            else:
+                lows = array('H')
+                lows.frombytes(data[offset:offset + 2 * num_of_docs])
+                if sys.byteorder == 'big':
+                    lows.byteswap()
+
+                containers.append(lows)
+                offset += 2 * num_of_docs
+
+        return Bitmap(keys, containers)
@@ -0,0 +1,59 @@
+"""
+Biword index of the frequent pairs of adjacent terms, so that exact phrases are answered without
+intersecting the positional postings lists of their words.
+
+The postings of the pair of terms "w1 w2" are saved in the dictionary and postings file like those of
+a term, under the two terms joined by SEPARATOR, with the positions of the first term of the pair.
+Terms never contain SEPARATOR, so biwords cannot collide with terms. Biwords are not part of the
+document lengths or the document vectors, and only the biwords in at least a minimum number of
+documents are kept in the index.
+
+An exact phrase w1 w2 ... wn occurs at position p iff each pair "wi wi+1" occurs at position p + i - 1,
+so a phrase of 2 terms is a single postings list, and a longer phrase is a phrase of the biwords.
+"""
+
+SEPARATOR = ' '
+
+
+def get_biword(term_1, term_2):
+    """
+    Returns the key of the pair of adjacent terms in the dictionary. Eg. 'fiduciari duti'
+    """
+    return term_1 + SEPARATOR + term_2
+
+
+def is_biword(term):
+    """
+    Returns True if the term of the dictionary is a biword.
+    """
+    return SEPARATOR in term
+
+
+def get_biwords(terms):
+    """
+    Returns the biwords of the consecutive terms of a phrase.
+
+    :param terms: normalised terms of the phrase. Eg. ['breach', 'of', 'fiduciari']
+    :return: ['breach of', 'of fiduciari']
+    """
+    return [get_biword(terms[i], terms[i + 1]) for i in range(len(terms) - 1)]
+
+
+def get_biword_positions(tokens):
+    """
+    Groups the positions of the pairs of adjacent tokens of a document by biword.
+
+    :param tokens: list of normalised tokens of the document
+    :return: { biword: [position of the first term, ...] } with biwords in order of first occurrence
+    """
+    biword_positions = {}
+
+    for position in range(len(tokens) - 1):
+        biword = get_biword(tokens[position], tokens[position + 1])
+
+        if biword in biword_positions:
+            biword_positions[biword].append(position)
+        else:
+            biword_positions[biword] = [position]
+
+    return biword_positions
@@ -13,9 +13,19 @@ from nltk.wsd import lesk
 from dictionary import Dictionary
 from postingsfile import PostingsFile
 from extended_boolean import extended_boolean_p_norm_model
+import extended_boolean
+import intersect
+import phrase
+import biword
+import zones
 import tf_idf
 import query_expansion
 
+# Weights of the scores of the methods in the ranking of boolean queries
+LOG_TF_WEIGHT = 0.5
+P_NORM_WEIGHT = 0.85
+TF_IDF_WEIGHT = 0.7
+
 def retrieve_query_term_postings(query_term, dictionary, postings_file, should_get_positions=False):
     """
     Gets the postings list for the query term from the disk.
@@ -35,7 +45,9 @@ def retrieve_query_term_postings(query_term, dictionary, postings_file, should_g
 
     if offset != -1:
         if should_get_positions:
-            term_postings = postings_file.get_posting_list_with_positions(offset, size, dictionary)
+            positions_offset, positions_size = dictionary.get_positions_offset_and_size_of_term(query_term)
+            term_postings = postings_file.get_posting_list_with_positions(offset, size, dictionary,
+                                                                          positions_offset, positions_size)
         else:
             term_postings = postings_file.get_posting_list(offset, size, dictionary)
     else:
@@ -44,28 +56,99 @@ def retrieve_query_term_postings(query_term, dictionary, postings_file, should_g
     return term_postings
 
 
-def retrieve_phrasal_query_postings(query_str, dictionary, postings_file):
+def retrieve_biword_postings(query_terms, dictionary, postings_file):
+    """
+    Retrieves the postings list of the exact phrase from the biword index. A phrase of 2 words is
+    a single postings list without positions, and a longer phrase is matched as a phrase of the biwords.
+
+    Params:
+        - query_terms: words of the phrasal query. Eg. ['fiduciary', 'duty']
+        - dictionary: Dictionary object
+        - postings_file: PostingsFile object
+
+    Returns:
+        postings: [ (docID, log-tf), ...  ], or None if a pair of adjacent words is not in the biword index
+    """
+    terms = [util.preprocess_content(query_term)[0] for query_term in query_terms]
+    biwords = biword.get_biwords(terms)
+
+    for term in biwords:
+        if dictionary.get_df(term) == -1:
+            return None
+
+    if len(biwords) == 1:
+        offset, size = dictionary.get_offset_and_size_of_term(biwords[0])
+
+        return [(docID, 1 + util.log10(tf)) for docID, tf in postings_file.get_posting_list_with_tf(offset, size)]
+
+    postings_lists = []
+    for term in biwords:
+        offset, size = dictionary.get_offset_and_size_of_term(term)
+        positions_offset, positions_size = dictionary.get_positions_offset_and_size_of_term(term)
+        postings_lists.append(postings_file.get_posting_list_with_positions(offset, size, dictionary,
+                                                                            positions_offset, positions_size))
+
+    return phrase.phrase_intersect(postings_lists)
+
+
+def retrieve_zone_postings(zone, words, dictionary, postings_file):
+    """
+    Retrieves the postings list of a query token scoped to a zone (see `zones.py`) from the terms of the zone.
+    A token of several words is matched as an exact phrase in the zone.
+
+    Params:
+        - zone: zone of the query token. Eg. title
+        - words: words of the query token. Eg. medical negligence
+
+    Returns:
+        postings: [ (docID, log-tf), ...  ]
+    """
+    zone_terms = [zones.get_zone_term(zone, term) for term in util.preprocess_content(words)]
+
+    postings_lists = []
+    for term in zone_terms:
+        offset, size = dictionary.get_offset_and_size_of_term(term)
+        if offset == -1:
+            return []
+
+        if len(zone_terms) == 1:
+            return postings_file.get_posting_list(offset, size, dictionary)
+
+        positions_offset, positions_size = dictionary.get_positions_offset_and_size_of_term(term)
+        postings_lists.append(postings_file.get_posting_list_with_positions(offset, size, dictionary,
+                                                                            positions_offset, positions_size))
+
+    return phrase.phrase_intersect(postings_lists)
+
+
+def retrieve_phrasal_query_postings(query_str, dictionary, postings_file, slop=0):
     """
     Retrieves the postings lists for the phrasal query from the disk.
-    Performs positional intersect to get the postings list.
+    Exact phrases are retrieved from the biword index if all their pairs of adjacent words are in it,
+    and otherwise positional intersect is performed to get the postings list.
 
     Params:
-        - query_str: Phrasal query term. Eg. fertility treatment
+        - query_str: Phrasal query term of any number of words. Eg. breach of fiduciary duty
         - dictionary: Dictionary object
         - postings_file: PostingsFile object
+        - slop: Number of other words allowed between consecutive words of the phrase
 
     Returns:
         postings: [ (docID, log-tf), ...  ]
     """
-    query_terms = [query_term.strip() for query_term in query_str.split(' ')]
-    phrasal_query_size = len(query_terms)
+    query_terms = query_str.split()
+
+    if slop == 0 and len(query_terms) > 1:
+        phrasal_query_postings = retrieve_biword_postings(query_terms, dictionary, postings_file)
+        if phrasal_query_postings is not None:
+            return phrasal_query_postings
 
     postings_lists = []
     for query_term in query_terms:
         term_postings = retrieve_query_term_postings(query_term, dictionary, postings_file, True)
         postings_lists.append(term_postings)
 
-    phrasal_query_postings = util.positional_intersect(phrasal_query_size == 2, *postings_lists)
+    phrasal_query_postings = phrase.phrase_intersect(postings_lists, slop)
 
     return phrasal_query_postings
 
@@ -85,22 +168,15 @@ def eval_boolean_query(query, dictionary, postings_file):
     for query_term in query:
         postings = None
 
-        if query_term[0] == '"' and query_term[-1] == '"':
-            postings = retrieve_phrasal_query_postings(query_term[1:-1], dictionary, postings_file)
+        phrase_str, slop = phrase.parse_phrase(query_term)
+        if phrase_str is not None:
+            postings = retrieve_phrasal_query_postings(phrase_str, dictionary, postings_file, slop)
         else:
             postings = retrieve_query_term_postings(query_term, dictionary, postings_file)
 
         query_postings.append(postings)
 
-    query_postings_lengths = [(idx, len(postings)) for idx, postings in enumerate(query_postings)]
-    query_postings_lengths = sorted(query_postings_lengths, key=lambda x: x[1])
-
-    search_results = query_postings[query_postings_lengths[0][0]]
-
-    for i in range(1, len(query_postings_lengths)):
-        postings = query_postings[query_postings_lengths[i][0]]
-
-        search_results = util.perform_and_operation(search_results, postings)
+    search_results = intersect.intersect_many(query_postings)
 
     # search_results = [doc[0] for doc in search_results]
     # return search_results
@@ -130,24 +206,25 @@ def eval_boolean_query(query, dictionary, postings_file):
     return docs
 
 
-def eval_extended_boolean_query(query, dictionary, postings_file):
+def eval_extended_boolean_query(query, dictionary, postings_file, k=None):
     """
       Params:
         - query: boolean query string tokens. Eg. ['"fertility treatment"', 'damages', '"medicine "', 'sick']
         - dictionary: Dictionary object
         - postings_file: PostingsFile object
+        - k: number of top results to return. None to return all results
 
       Returns:
-        - search_results: [ (docID, log-tf), ... ]
+        - search_results: [ (docID, similarity), ... ]
     """
     DEFAULT_QUERY_TERM_WT = 1  # uniform term importance weights. Eg. 1 or assign based on idf
 
     query_term_weights = {}  # { term: query weight }
-    document_term_weights = defaultdict(lambda: defaultdict(lambda: 0.0))  # { docID: { term: lnc tf-idf weight } }
+    term_postings = {}  # { term: [ (docID, lnc tf-idf weight), ... ] }
 
     total_docs = dictionary.get_doc_count()
 
-    for query_token in set(query):
+    for query_token in dict.fromkeys(query):
         df = dictionary.get_df(util.preprocess_content(query_token)[0])
         if df == 0 or df == -1:
             idf = 0.001
@@ -157,32 +234,29 @@ def eval_extended_boolean_query(query, dictionary, postings_file):
         query_term_weights[query_token] = idf  # DEFAULT_QUERY_TERM_WT
 
         postings = None
-        if query_token[0] == '"' and query_token[-1] == '"':
-            postings = retrieve_phrasal_query_postings(query_token[1:-1], dictionary, postings_file)
+        phrase_str, slop = phrase.parse_phrase(query_token)
+        if phrase_str is not None:
+            postings = retrieve_phrasal_query_postings(phrase_str, dictionary, postings_file, slop)
         else:
             postings = retrieve_query_term_postings(query_token, dictionary, postings_file)
 
-        for (docId, log_tf) in postings:
-            doc_len = dictionary.get_normalised_doc_length(str(docId))
-            document_term_weights[docId][query_token] = log_tf / doc_len
+        term_postings[query_token] = [(docId, log_tf / dictionary.get_normalised_doc_length(str(docId)))
+                                        for docId, log_tf in postings]
 
-    return extended_boolean_p_norm_model(query, query_term_weights, document_term_weights)
+    return extended_boolean_p_norm_model(query, query_term_weights, term_postings, k=k)
 
 
-def rank_results_bool(results_bool, results_ex_bool, results_lnc):
+def rank_results_bool(results_bool, results_ex_bool, results_lnc, k=None):
     """
     Rank the results using weighted sum of normalised log-tf, p-norm, and tf-idf scores
     from the inputs.
 
     Params:
         - results_bool, results_ex_bool, results_lnc: [ (docID, score), ...]
+        - k: number of top ranked results to return. None to return all results
     """
     document_scores = defaultdict(lambda: 0)
 
-    LOG_TF_WEIGHT = 0.5
-    P_NORM_WEIGHT = 0.85
-    TF_IDF_WEIGHT = 0.7
-
     for docId, val in results_bool:
         document_scores[docId] += LOG_TF_WEIGHT * val
 
@@ -192,4 +266,248 @@ def rank_results_bool(results_bool, results_ex_bool, results_lnc):
     for docId, val in results_lnc:
         document_scores[docId] += TF_IDF_WEIGHT * val
 
-    return heapq.nlargest(len(document_scores), document_scores, key=document_scores.__getitem__)
+    if k is None:
+        k = len(document_scores)
+
+    return heapq.nlargest(k, document_scores, key=document_scores.__getitem__)
+
+
+def get_term_postings(term, term_postings, dictionary, postings_file, doc_filter=None):
+    """
+    Returns the postings list [ (docID, log-tf), ... ] of the normalised term, reading it
+    from disk only if it is not in term_postings { term: postings }, which are all read with the same doc_filter
+    """
+    if term not in term_postings:
+        offset, size = dictionary.get_offset_and_size_of_term(term)
+
+        if offset != -1:
+            term_postings[term] = postings_file.get_posting_list(offset, size, dictionary, doc_filter)
+        else:
+            term_postings[term] = []
+
+    return term_postings[term]
+
+
+def retrieve_fused_query_postings(query, expanded_query, dictionary, postings_file, doc_filter=None):
+    """
+    Retrieves the postings lists of the query tokens and of the expanded query terms,
+    reading the postings list of each term only once.
+
+    Params:
+        - query: boolean query string tokens, which may be scoped to a zone. Eg. ['"fertility treatment"', 'damages', 'title:negligence']
+        - expanded_query: expanded query terms with term weights. [ (term, weight), ...]
+        - doc_filter: Bitmap of the documents to keep in the postings lists. None to keep all documents
+
+    Returns:
+        - query_tokens: distinct query tokens [ (query token, [ (docID, log-tf), ... ], idf), ... ]
+        - lnc_terms: distinct expanded query terms [ ([ (docID, log-tf / doc length), ... ], wt), ... ]
+        - norm_query: length of the tf-idf vector of the expanded query
+    """
+    total_docs = dictionary.get_doc_count()
+    term_postings = {}  # { term: [ (docID, log-tf), ... ] } of the terms read so far
+
+    query_tokens = []
+    for query_token in dict.fromkeys(query):
+        zone, words = zones.parse_zone_token(query_token)
+        if zone is not None:
+            term = zones.get_zone_term(zone, util.preprocess_content(words)[0])
+        else:
+            term = util.preprocess_content(query_token)[0]
+
+        df = dictionary.get_df(term)
+        if df == 0 or df == -1:
+            idf = 0.001
+        else:
+            idf = util.log10(total_docs / df)
+
+        phrase_str, slop = phrase.parse_phrase(query_token)
+        if zone is not None:
+            postings = retrieve_zone_postings(zone, words, dictionary, postings_file)
+        elif phrase_str is not None:
+            postings = retrieve_phrasal_query_postings(phrase_str, dictionary, postings_file, slop)
+        else:
+            postings = get_term_postings(term, term_postings, dictionary, postings_file, doc_filter)
+
+        # Zones and phrases are matched with the positions of all documents before they are filtered
+        if doc_filter is not None and (zone is not None or phrase_str is not None):
+            postings = doc_filter.filter_postings(postings)
+
+        query_tokens.append((query_token, postings, idf))
+
+    tf_query = defaultdict(int)
+    query_norm_tokens = list()
+    for term, weight in expanded_query:
+        query_norm_tokens.append(term)
+        tf_query[term] += 1 * weight
+
+    lnc_terms = []
+    norm_query = 0
+    for term in set(query_norm_tokens):
+        offset, size = dictionary.get_offset_and_size_of_term(term)
+        if offset == -1:
+            continue
+
+        df = dictionary.get_df(term)
+        if df == 0 or df == -1:
+            idf = 0
+        else:
+            idf = util.log10(total_docs / df)
+
+        wt = idf * (1 + util.log10(tf_query[term]))
+        norm_query += (wt * wt)
+
+        if dictionary.has_precomputed_weights():
+            postings = postings_file.get_normalised_posting_list(offset, size, dictionary, doc_filter)
+        else:
+            postings = get_term_postings(term, term_postings, dictionary, postings_file, doc_filter)
+
+        if not dictionary.has_precomputed_weights():
+            postings = [(docID, log_tf / dictionary.get_normalised_doc_length(str(docID))) for docID, log_tf in postings]
+
+        lnc_terms.append((postings, wt))
+
+    return query_tokens, lnc_terms, math.sqrt(norm_query)
+
+
+def eval_fused_query(query, expanded_query, dictionary, postings_file, k=None, doc_filter=None):
+    """
+    Evaluates the boolean query with the standard boolean model, the extended boolean model
+    (P-norm) and tf-idf on the expanded query in a single document-at-a-time pass over 
+    the postings lists, and ranks the documents by the weighted sum of the normalised scores.
+
+    Returns the same ranking as `rank_results_bool` of `eval_boolean_query`, 
+    `eval_extended_boolean_query` and `tf_idf.eval_free_text_query`, without building the
+    results and dicts of each method. Documents with equal scores are ranked by docID.
+
+    Params:
+        - query: boolean query string tokens. Eg. ['"fertility treatment"', 'damages', '"medicine "', 'sick']
+        - expanded_query: expanded query terms with term weights. [ (term, weight), ...]
+        - dictionary: Dictionary object
+        - postings_file: PostingsFile object
+        - k: number of top ranked results to return. None to return all results
+        - doc_filter: Bitmap of the documents to rank. None to rank all documents
+
+    Returns:
+        - results: ranked docIDs [ docID, ... ]
+    """
+    return rank_fused_query(score_fused_query(query, expanded_query, dictionary, postings_file, doc_filter), k)
+
+
+def score_fused_query(query, expanded_query, dictionary, postings_file, doc_filter=None):
+    """
+    Scores the documents of the boolean query with each method of `eval_fused_query`, in a single 
+    document-at-a-time pass over the postings lists, before the scores are normalised.
+
+    Returns:
+        - docs: scores of the documents in docID order [ (docID, exp(log-tf) or None, p-norm similarity or None,
+        exp(tf-idf score) or None, index of the first expanded query term in the document or None), ... ]
+    """
+    query_tokens, lnc_terms, norm_query = retrieve_fused_query_postings(query, expanded_query, dictionary, postings_file,
+                                                                        doc_filter)
+
+    num_of_tokens = len(query_tokens)
+    query_values = list(extended_boolean.get_query_values(query, 
+        {query_token: idf for query_token, _, idf in query_tokens}).values())  # In order of query_tokens
+    sum_query_values = sum(query_values)
+
+    if norm_query == 0:
+        # All the expanded query terms have an idf of 0, and the documents have no tf-idf scores
+        lnc_terms = []
+
+    postings_lists = [postings for _, postings, _ in query_tokens] + [postings for postings, _ in lnc_terms]
+    lnc_wts = [wt for _, wt in lnc_terms]
+
+    # Standard boolean: documents with all query tokens, with the minimum log-tf { docID: log-tf }
+    boolean_matches = dict(intersect.intersect_many([postings for _, postings, _ in query_tokens]))
+
+    # Min heap of the current document of each postings list [ (docID, list index), ... ]
+    heap = [(postings[0][0], idx) for idx, postings in enumerate(postings_lists) if postings]
+    heapq.heapify(heap)
+    cursors = [0] * len(postings_lists)
+
+    docs = []
+
+    while heap:
+        docID = heap[0][0]
+
+        matches = []  # [ (list index, value), ... ] in order of list index
+        while heap and heap[0][0] == docID:
+            _, idx = heapq.heappop(heap)
+            matches.append((idx, postings_lists[idx][cursors[idx]][1]))
+
+            cursors[idx] += 1
+            if cursors[idx] < len(postings_lists[idx]):
+                heapq.heappush(heap, (postings_lists[idx][cursors[idx]][0], idx))
+
+        token_matches = [(idx, log_tf) for idx, log_tf in matches if idx < num_of_tokens]
+        lnc_matches = [(idx - num_of_tokens, value) for idx, value in matches if idx >= num_of_tokens]
+
+        # Standard boolean: documents with all query tokens, scored by the minimum log-tf
+        exp_log_tf = None
+        if docID in boolean_matches:
+            exp_log_tf = math.exp(boolean_matches[docID])
+
+        # Extended boolean: documents with any query token
+        similarity = None
+        if token_matches:
+            doc_len = dictionary.get_normalised_doc_length(str(docID))
+
+            doc_value = 0.0
+            for idx, log_tf in token_matches:
+                doc_value += extended_boolean.get_doc_term_value(query_values[idx], log_tf / doc_len)
+
+            similarity = extended_boolean.get_similarity(doc_value, sum_query_values)
+
+        # tf-idf: documents with any expanded query term
+        exp_score = None
+        lnc_idx = None
+        if lnc_matches:
+            score = 0.0
+            for idx, normalised_tf_doc in lnc_matches:
+                score += lnc_wts[idx] * normalised_tf_doc
+
+            exp_score = math.exp(score / norm_query)
+            lnc_idx = lnc_matches[0][0]
+
+        docs.append((docID, exp_log_tf, similarity, exp_score, lnc_idx))
+
+    return docs
+
+
+def rank_fused_query(docs, k=None):
+    """
+    Ranks the documents scored by `score_fused_query` by the weighted sum of their normalised scores.
+
+    Params:
+        - docs: scores of the documents in docID order, as returned by `score_fused_query`
+        - k: number of top ranked results to return. None to return all results
+
+    Returns:
+        - results: ranked docIDs [ docID, ... ]
+    """
+    lnc_order = defaultdict(list)  # Scored docs by the first expanded query term they contain
+    for _, _, _, exp_score, lnc_idx in docs:
+        if exp_score is not None:
+            lnc_order[lnc_idx].append(exp_score)
+
+    # Normalise the boolean and tf-idf scores using softmax. The exponentials are summed in the same
+    # order as the separate methods, so that the scores are exactly the same
+    sum_exp_log_tfs = sum(exp_log_tf for _, exp_log_tf, _, _, _ in docs if exp_log_tf is not None)
+    sum_exp_scores = sum(exp_score for lnc_idx in sorted(lnc_order) for exp_score in lnc_order[lnc_idx])
+
+    document_scores = {}
+    for docID, exp_log_tf, similarity, exp_score, _ in docs:
+        score = 0
+        if exp_log_tf is not None:
+            score += LOG_TF_WEIGHT * (exp_log_tf / sum_exp_log_tfs)
+        if similarity is not None:
+            score += P_NORM_WEIGHT * similarity
+        if exp_score is not None:
+            score += TF_IDF_WEIGHT * (exp_score / sum_exp_scores)
+
+        document_scores[docID] = score
+
+    if k is None:
+        k = len(document_scores)
+
+    return heapq.nlargest(k, document_scores, key=document_scores.__getitem__)
@@ -0,0 +1,156 @@
+"""
+Binary encoding of the postings lists, using delta (gap) encoding and variable-byte encoding.
+
+A postings file starts with a header of MAGIC followed by the FORMAT_VERSION byte.
+The postings list of a term is stored as two streams of varints, so that queries which do
+not need positions only read the docs stream:
+
+    docs stream:       num_of_docs  (docID gap, tf) * num_of_docs
+    positions stream:  (position gap * tf) * num_of_docs
+
+where docIDs are gaps from the previous docID in the list, and positions are gaps from the
+previous position in the document.
+
+If the index is built with precomputed weights, the docs stream is followed by two arrays of
+num_of_docs little-endian float32: the court-weighted log-tf, and the log-tf divided by the
+normalised length of the document.
+"""
+import sys
+from array import array
+
+MAGIC = b'LCRPOST'
+FORMAT_VERSION = 2
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+
+
+def encode_varint(value, out):
+    """
+    Appends the variable-byte encoding of a non-negative integer to the bytearray.
+    7 bits are stored per byte, least significant first, and the high bit is set on all but the last byte.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def decode_varints(data):
+    """
+    Decodes all the varints in the bytes.
+
+    :param data: bytes-like object of varints
+    :return: list of integers
+    """
+    values = []
+
+    value = 0
+    shift = 0
+    for byte in data:
+        if byte & 0x80:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+        else:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+
+    return values
+
+
+def encode_postings(docs):
+    """
+    Encodes the postings list of a term.
+
+    :param docs: [ (docID, [position, ...]), ... ] sorted by docID, with sorted positions
+    :return: bytearrays of the docs stream and the positions stream
+    """
+    docs_out = bytearray()
+    positions_out = bytearray()
+    encode_varint(len(docs), docs_out)
+
+    prev_docID = 0
+    for docID, positions in docs:
+        encode_varint(docID - prev_docID, docs_out)
+        encode_varint(len(positions), docs_out)
+
+        prev_pos = 0
+        for pos in positions:
+            encode_varint(pos - prev_pos, positions_out)
+            prev_pos = pos
+
+        prev_docID = docID
+
+    return docs_out, positions_out
+
+
+def decode_postings_with_positions(docs_data, positions_data):
+    """
+    Decodes the postings list of a term.
+
+    :param docs_data: bytes-like object of the docs stream
+    :param positions_data: bytes-like object of the positions stream
+    :return: [ (docID, [position, ...]), ... ]
+    """
+    position_gaps = decode_varints(positions_data)
+
+    postings = []
+    i = 0
+    for docID, tf in decode_postings(docs_data):
+        positions = []
+        pos = 0
+        for gap in position_gaps[i:i + tf]:
+            pos += gap
+            positions.append(pos)
+        i += tf
+
+        postings.append((docID, positions))
+
+    return postings
+
+
+def decode_postings(docs_data, doc_filter=None):
+    """
+    Decodes the docs stream of the postings list of a term.
+
+    :param docs_data: bytes-like object of the docs stream
+    :param doc_filter: Bitmap of the documents to keep. None to keep all documents
+    :return: [ (docID, tf), ... ]
+    """
+    values = decode_varints(docs_data)
+
+    postings = []
+    docID = 0
+    for i in range(1, 2 * values[0] + 1, 2):
+        docID += values[i]
+        postings.append((docID, values[i + 1]))
+
+    if doc_filter is not None:
+        return doc_filter.filter_postings(postings)
+
+    return postings
+
+
+def encode_floats(values):
+    """
+    Encodes the floats as an array of little-endian float32.
+    """
+    floats = array('f', values)
+    if sys.byteorder == 'big':
+        floats.byteswap()
+
+    return floats.tobytes()
+
+
+def decode_floats(data):
+    """
+    Decodes an array of little-endian float32.
+
+    :return: array of floats
+    """
+    floats = array('f')
+    floats.frombytes(data)
+    if sys.byteorder == 'big':
+        floats.byteswap()
+
+    return floats
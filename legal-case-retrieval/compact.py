@@ -0,0 +1,269 @@
+"""
+Compact binary format of the dictionary, which is memory-mapped when loaded instead of unpickled.
+
+The file starts with MAGIC and the FORMAT_VERSION byte, followed by the length of the metadata
+as 8 bytes little-endian, and the metadata as JSON. The metadata holds the scalar values of the
+dictionary, and the typecode, offset and length of each column. The columns are arrays stored
+after the metadata, each aligned to 8 bytes:
+
+    - terms: utf8 encoded terms, concatenated in sorted order of their bytes
+    - term_offsets: start of each term in `terms`, and the end of the last term
+    - one column per field of the terms (offset, size, docFreq, ...), in the order of the terms
+    - doc_ids: sorted docIDs of the collection
+    - one column per table of documents (normalised lengths, court weights, ...), in the order of doc_ids
+"""
+import bisect
+import json
+import mmap
+import sys
+from array import array
+
+MAGIC = b'LCRDICT'
+FORMAT_VERSION = 1
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+
+TERM_FIELDS = [
+    ("offset", 'q'),
+    ("size", 'q'),
+    ("positionsOffset", 'q'),
+    ("positionsSize", 'q'),
+    ("docFreq", 'q'),
+]
+MISSING = -1  # Value of a field that a term does not have
+
+
+def is_compact(file_name):
+    """
+    Returns whether the file is a dictionary saved in the compact format.
+    """
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save(file_name, terms, doc_tables, scalars):
+    """
+    Saves the dictionary in the compact format.
+
+    Params:
+        - terms: { term: { field: value } } with the fields of TERM_FIELDS
+        - doc_tables: { table_name: { docId: int or float } } where docIds are integers or strings of integers
+        - scalars: { name: JSON serialisable value }
+    """
+    sorted_terms = sorted((term.encode('utf8'), term) for term in terms)
+
+    columns = {}  # { name: array }
+
+    term_offsets = array('q', [0])
+    for term_bytes, _ in sorted_terms:
+        term_offsets.append(term_offsets[-1] + len(term_bytes))
+    columns["terms"] = array('B', b''.join(term_bytes for term_bytes, _ in sorted_terms))
+    columns["term_offsets"] = term_offsets
+
+    for field, typecode in TERM_FIELDS:
+        columns["term." + field] = array(typecode, [terms[term].get(field, MISSING) for _, term in sorted_terms])
+
+    doc_ids = sorted(set(int(docId) for table in doc_tables.values() for docId in table))
+    columns["doc_ids"] = array('q', doc_ids)
+
+    for table_name, table in doc_tables.items():
+        values = {int(docId): value for docId, value in table.items()}
+        typecode = 'q' if all(isinstance(value, int) for value in values.values()) else 'd'
+        columns["doc." + table_name] = array(typecode, [values.get(docId, MISSING) for docId in doc_ids])
+
+    metadata = {"byteorder": sys.byteorder, "scalars": scalars, "columns": {}}
+    offset = 0
+    for name, column in columns.items():
+        metadata["columns"][name] = [column.typecode, offset, len(column)]
+        offset += align(len(column) * column.itemsize)
+
+    metadata_bytes = json.dumps(metadata).encode('utf8')
+    data_start = align(len(HEADER) + 8 + len(metadata_bytes))
+
+    with open(file_name, 'wb') as f:
+        f.write(HEADER)
+        f.write(len(metadata_bytes).to_bytes(8, 'little'))
+        f.write(metadata_bytes)
+        f.write(bytes(data_start - f.tell()))
+
+        for name, column in columns.items():
+            column_bytes = column.tobytes()
+            f.write(column_bytes)
+            f.write(bytes(align(len(column_bytes)) - len(column_bytes)))
+
+    f.close()
+
+
+def load(file_name):
+    """
+    Memory-maps a dictionary saved in the compact format.
+
+    Returns:
+        - terms: TermTable
+        - doc_ids: sorted docIDs (memoryview of int64)
+        - doc_tables: { table_name: DocColumn }
+        - scalars: { name: value }
+    """
+    with open(file_name, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    f.close()
+
+    if mapping[:len(HEADER)] != HEADER:
+        raise ValueError("Unsupported dictionary file format version " + str(mapping[len(HEADER) - 1]) + ". Re-index the collection.")
+
+    metadata_length = int.from_bytes(mapping[len(HEADER):len(HEADER) + 8], 'little')
+    metadata = json.loads(mapping[len(HEADER) + 8:len(HEADER) + 8 + metadata_length].decode('utf8'))
+    data_start = align(len(HEADER) + 8 + metadata_length)
+
+    columns = {}
+    for name, (typecode, offset, length) in metadata["columns"].items():
+        columns[name] = load_column(mapping, data_start + offset, typecode, length, metadata["byteorder"])
+
+    terms = TermTable(mapping, data_start + metadata["columns"]["terms"][1], columns["term_offsets"],
+                      {field: columns["term." + field] for field, _ in TERM_FIELDS})
+
+    doc_ids = columns["doc_ids"]
+    doc_tables = {name[len("doc."):]: DocColumn(doc_ids, column)
+                    for name, column in columns.items() if name.startswith("doc.")}
+
+    return terms, doc_ids, doc_tables, metadata["scalars"]
+
+
+def align(size):
+    """
+    Rounds the number of bytes up to a multiple of 8.
+    """
+    return (size + 7) // 8 * 8
+
+
+def load_column(mapping, offset, typecode, length, byteorder):
+    """
+    Returns the column as a zero-copy memoryview of the mapping, or as a byteswapped
+    copy if the file was saved on a machine with another byte order.
+    """
+    size = length * array(typecode).itemsize
+    view = memoryview(mapping)[offset:offset + size]
+
+    if byteorder == sys.byteorder:
+        return view.cast(typecode)
+
+    column = array(typecode)
+    column.frombytes(view)
+    column.byteswap()
+    return column
+
+
+class TermTable(object):
+    """
+    Read-only mapping of term to its fields { field: value }, backed by the columns of
+    the compact dictionary. Terms are looked up by binary search over the sorted terms.
+    """
+    def __init__(self, mapping, terms_offset, term_offsets, fields):
+        self.mapping = mapping
+        self.terms_offset = terms_offset  # Offset of the concatenated terms in the mapping
+        self.term_offsets = term_offsets
+        self.fields = fields  # { field: column }
+
+    def __len__(self):
+        return len(self.term_offsets) - 1
+
+    def get_term_bytes(self, idx):
+        return self.mapping[self.terms_offset + self.term_offsets[idx]:self.terms_offset + self.term_offsets[idx + 1]]
+
+    def get_term(self, idx):
+        return self.get_term_bytes(idx).decode('utf8')
+
+    def find(self, term):
+        """
+        Returns the index of the term in the sorted terms, or -1 if term not present.
+        """
+        term_bytes = term.encode('utf8')
+
+        idx = bisect.bisect_left(range(len(self)), term_bytes, key=self.get_term_bytes)
+        if idx < len(self) and self.get_term_bytes(idx) == term_bytes:
+            return idx
+
+        return -1
+
+    def get_entry(self, idx):
+        return {field: column[idx] for field, column in self.fields.items() if column[idx] != MISSING}
+
+    def __contains__(self, term):
+        return self.find(term) != -1
+
+    def __getitem__(self, term):
+        idx = self.find(term)
+        if idx == -1:
+            raise KeyError(term)
+
+        return self.get_entry(idx)
+
+    def get(self, term, default=None):
+        idx = self.find(term)
+        if idx == -1:
+            return default
+
+        return self.get_entry(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.get_term(idx)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for idx in range(len(self)):
+            yield self.get_term(idx), self.get_entry(idx)
+
+
+class DocColumn(object):
+    """
+    Read-only mapping of docID to a value of the document, backed by the sorted docIDs
+    and a column of values in the same order. DocIDs may be integers or strings.
+    """
+    def __init__(self, doc_ids, values):
+        self.doc_ids = doc_ids
+        self.values = values
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def find(self, doc_id):
+        """
+        Returns the index of the document in the sorted docIDs, or -1 if not present.
+        """
+        doc_id = int(doc_id)
+
+        idx = bisect.bisect_left(self.doc_ids, doc_id)
+        if idx < len(self.doc_ids) and self.doc_ids[idx] == doc_id and self.values[idx] != MISSING:
+            return idx
+
+        return -1
+
+    def __contains__(self, doc_id):
+        return self.find(doc_id) != -1
+
+    def __getitem__(self, doc_id):
+        idx = self.find(doc_id)
+        if idx == -1:
+            raise KeyError(doc_id)
+
+        return self.values[idx]
+
+    def get(self, doc_id, default=None):
+        idx = self.find(doc_id)
+        if idx == -1:
+            return default
+
+        return self.values[idx]
+
+    def __iter__(self):
+        for idx in range(len(self.doc_ids)):
+            if self.values[idx] != MISSING:
+                yield str(self.doc_ids[idx])
+
+    def items(self):
+        for idx in range(len(self.doc_ids)):
+            if self.values[idx] != MISSING:
+                yield str(self.doc_ids[idx]), self.values[idx]
@@ -1,21 +1,47 @@
 import pickle
+from array import array
 
 from math import sqrt, log
 from posting import Posting
+import biword
+import compact
 import util
+import zones
+
+# Estimated memory used by the postings while indexing, to decide when to flush a block to disk
+BYTES_PER_TERM = 400  # Posting and its empty arrays, for a term with postings in memory
+BYTES_PER_POSTING = 8  # docID and term frequency of the document in the arrays of the posting
+BYTES_PER_POSITION = 4  # Position in the positions array
 
 class Dictionary(object):
     """
     Getter and Setter functions related to the dictionary index.
-    Store on disk and accessed using pickle.
+    Store on disk in a compact array format and accessed using mmap.
     Tracks normalised docs lengths, and total number of docs.
     """
     def __init__(self, disk_file):
-        self.terms = {}  # { term: { offset: int, docFreq: int, posting: Posting}}
+        self.terms = {}  # { term: { offset: int, size: int, positionsOffset: int, positionsSize: int, docFreq: int }} of the saved terms
         self.court_weights = {}  # { docID: court_weight }
+        self.doc_offsets = {}  # { docID: byte offset of the document's row in the dataset file }
+        self.doc_sizes = {}  # { docID: number of bytes of the document's row in the dataset file }
+        self.doc_hashes = {}  # { docID: hash of the fields of the document's row, see docstore.get_row_hash }
+        self.dataset_file = None  # Path of the dataset file that was indexed
+        self.biword_min_df = None  # Minimum document frequency of the indexed biwords. None if biwords are not indexed
+        self.forward_offsets = {}  # { docID: byte offset of the document's vector in the forward index }
+        self.forward_sizes = {}  # { docID: number of bytes of the document's vector in the forward index }
+        self.sorted_terms = None  # Terms in sorted order, indexed by termID. Built when needed
         self.disk_file = disk_file  # File name where dictionary is stored in disk
         self.num_of_docs = 0  # Total number of documents in collection
         self.normalised_doc_lengths = {}  #  { doc_id: normalized_length } where normalized_length = sqrt(sum((1+log(tf)^2)))
+        self.zone_doc_lengths = {zone: {} for zone in zones.ZONES}  # { zone: { doc_id: normalized_length of the zone } }
+        self.has_weights = False  # Whether postings have precomputed court-weighted log-tf and normalised weights
+        self.doc_table = None  # (doc_ids, normalised_lengths) arrays sorted by docID. Built when needed
+        self.term_ids = {}  # { term: termID } of the terms interned while indexing
+        self.indexed_terms = []  # Interned terms, indexed by termID
+        self.doc_freqs = array('I')  # Document frequencies of the interned terms, indexed by termID
+        self.term_postings = []  # Posting of the interned terms, indexed by termID. None if not in memory
+        self.terms_in_memory = []  # termIDs with postings in memory, that have not been saved to disk
+        self.memory_usage = 0  # Estimated bytes used by the postings in memory
 
 
     def add_tokens_of_doc(self, content, docId):
@@ -29,48 +55,183 @@ class Dictionary(object):
         Returns:
             - normalised_tf: normalised length of document
         """
-        tf_freq = {} # Term frequencies of this document
+        return self.add_term_positions_of_doc(util.get_term_positions(content), docId)
 
-        position = 0 # position of token in content
-        for token in content:
-            if token not in self.terms:
-                self.terms[token] = {}
-                self.terms[token]["offset"] = None
-                self.terms[token]["size"] = None
-                self.terms[token]["docFreq"] = 1
-                self.terms[token]["posting"] = Posting()
-            else:
-                if token not in tf_freq:
-                    self.terms[token]["docFreq"] += 1
 
-            self.terms[token]["posting"].add_doc_to_postings(docId)
-            self.terms[token]["posting"].add_pos_to_doc(docId, position)
+    def add_term_positions_of_doc(self, term_positions, docId):
+        """
+        Updates indices and postings lists with the term positions of this document.
 
-            position += 1
+        Params:
+            - term_positions: { term: [position, ...] } in order of first occurrence
+            - docId: document ID
 
-            if token in tf_freq:
-                tf_freq[token] += 1
-            else:
-                tf_freq[token] = 1
+        Returns:
+            - normalised_tf: normalised length of document
+        """
+        normalised_tf = 0
+        for token, positions in term_positions.items():
+            self.add_positions_of_term(token, positions, docId)
+
+            normalised_tf += pow((1 + util.log10(len(positions))), 2)
+
+        return sqrt(normalised_tf)
+
+
+    def add_biword_positions_of_doc(self, biword_positions, docId):
+        """
+        Updates the postings lists of the biwords with their positions in this document.
+        Biwords are not part of the length of the document.
+
+        Params:
+            - biword_positions: { biword: [position of the first term, ...] }
+            - docId: document ID
+        """
+        for term, positions in biword_positions.items():
+            self.add_positions_of_term(term, positions, docId)
+
+
+    def add_zone_term_positions_of_doc(self, zone, term_positions, docId):
+        """
+        Updates the postings lists of the terms of the zone with their positions in the zone of this document.
+        Terms of zones are not part of the length of the document.
 
+        Params:
+            - zone: zone of the document. Eg. title
+            - term_positions: { term: [position in the zone, ...] }
+            - docId: document ID
 
+        Returns:
+            - normalised_tf: normalised length of the zone of the document
+        """
         normalised_tf = 0
-        for token in tf_freq.keys():
-            freq = tf_freq[token]
-            normalised_tf += pow((1 + util.log10(freq)), 2)
+        for token, positions in term_positions.items():
+            self.add_positions_of_term(zones.get_zone_term(zone, token), positions, docId)
+
+            normalised_tf += pow((1 + util.log10(len(positions))), 2)
 
         return sqrt(normalised_tf)
 
 
+    def add_positions_of_term(self, token, positions, docId):
+        """
+        Adds the document with the positions of the term to the postings list of the term.
+        The term is looked up once, and its document frequency and postings are indexed by its termID.
+        """
+        term_id = self.term_ids.get(token)
+        if term_id is None:
+            term_id = self.intern_term(token)
+
+        posting = self.term_postings[term_id]
+
+        # Postings of the term may have been flushed to a block on disk
+        if posting is None:
+            posting = self.term_postings[term_id] = Posting()
+            self.terms_in_memory.append(term_id)
+            self.memory_usage += BYTES_PER_TERM
+
+        posting.add_positions_to_doc(docId, positions)
+        self.doc_freqs[term_id] += 1
+
+        self.memory_usage += BYTES_PER_POSTING + BYTES_PER_POSITION * len(positions)
+
+
+    def intern_term(self, token):
+        """
+        Assigns the next termID to a new term.
+        :return: termID
+        """
+        term_id = len(self.indexed_terms)
+
+        self.term_ids[token] = term_id
+        self.indexed_terms.append(token)
+        self.doc_freqs.append(0)
+        self.term_postings.append(None)
+
+        return term_id
+
+
+    def has_indexed_term(self, term):
+        """
+        Returns True if the term was added while indexing, and was not removed.
+        """
+        return term in self.term_ids
+
+
+    def remove_rare_biwords(self, min_df):
+        """
+        Removes the biwords in less than min_df documents, with their postings in memory.
+        Their postings already flushed to blocks on disk are skipped when the blocks are merged.
+        """
+        rare_biwords = [(term, term_id) for term, term_id in self.term_ids.items()
+                            if biword.is_biword(term) and self.doc_freqs[term_id] < min_df]
+
+        for term, term_id in rare_biwords:
+            del self.term_ids[term]
+            self.term_postings[term_id] = None
+
+        self.terms_in_memory = [term_id for term_id in self.terms_in_memory if self.term_postings[term_id] is not None]
+
+
     def format_dict_for_saving_postings(self, term):
-        posting_list = self.terms[term]["posting"]
+        posting_list = self.term_postings[self.term_ids[term]]
         return posting_list
 
 
+    def get_terms_in_memory(self):
+        """
+        Gets the terms whose postings are in memory, in sorted order.
+        :return: list of terms
+        """
+        return sorted(self.indexed_terms[term_id] for term_id in self.terms_in_memory)
+
+
+    def get_memory_usage(self):
+        """
+        Gets the estimated number of bytes used by the postings in memory.
+        :return: int
+        """
+        return self.memory_usage
+
+
+    def clear_postings(self):
+        """
+        Removes the postings in memory, after they have been saved to a block on disk.
+        """
+        for term_id in self.terms_in_memory:
+            self.term_postings[term_id] = None
+
+        self.terms_in_memory = []
+        self.memory_usage = 0
+
+
     def update_offset_and_size(self, term, offset, size):
-        del self.terms[term]["posting"]
-        self.terms[term]["offset"] = offset
-        self.terms[term]["size"] = size
+        """
+        Stores the location of the saved postings list of the term, with the document frequency
+        of an interned term, whose postings are then removed from memory.
+        """
+        entry = self.terms.setdefault(term, {})
+        entry["offset"] = offset
+        entry["size"] = size
+
+        term_id = self.term_ids.get(term)
+        if term_id is not None:
+            entry["docFreq"] = self.doc_freqs[term_id]
+            self.term_postings[term_id] = None
+
+
+    def add_doc_freq(self, term, doc_freq):
+        """
+        Adds to the document frequency of the term, in a dictionary of the statistics 
+        of several indexes that has no postings lists (see `shards.py`).
+        """
+        entry = self.terms.setdefault(term, {"docFreq": 0})
+        entry["docFreq"] += doc_freq
+
+
+    def update_positions_offset_and_size(self, term, offset, size):
+        self.terms[term]["positionsOffset"] = offset
+        self.terms[term]["positionsSize"] = size
 
 
     def get_terms(self):
@@ -81,6 +242,19 @@ class Dictionary(object):
         return self.terms
 
 
+    def get_term_by_id(self, term_id):
+        """
+        Returns the term with the termID, which is the position of the term in the sorted terms.
+        """
+        if isinstance(self.terms, compact.TermTable):
+            return self.terms.get_term(term_id)
+
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.terms)
+
+        return self.sorted_terms[term_id]
+
+
     def get_df(self, token):
         """
         Gets the Document frequency for a term.
@@ -88,8 +262,9 @@ class Dictionary(object):
         :param token: term
         :return: int representing documentFrequency for the term
         """
-        if token in self.terms:
-            return self.terms[token]["docFreq"]
+        entry = self.terms.get(token)
+        if entry is not None:
+            return entry["docFreq"]
         else:
             return -1
 
@@ -101,8 +276,23 @@ class Dictionary(object):
         :param term: normalised term
         :return: -1 if term not present and offset if term present
         """
-        if term in self.terms:
-            return self.terms[term]["offset"], self.terms[term]["size"]
+        entry = self.terms.get(term)
+        if entry is not None:
+            return entry["offset"], entry["size"]
+        else:
+            return -1, -1
+
+
+    def get_positions_offset_and_size_of_term(self, term):
+        """
+        Gets offset to seek to for the positions of the posting list in posting file, and
+        number of bytes to read. Postings files saved as text have no separate positions.
+        :param term: normalised term
+        :return: -1 if term or its positions are not present and offset if present
+        """
+        entry = self.terms.get(term)
+        if entry is not None and "positionsOffset" in entry:
+            return entry["positionsOffset"], entry["positionsSize"]
         else:
             return -1, -1
 
@@ -128,6 +318,40 @@ class Dictionary(object):
         return self.normalised_doc_lengths[doc_id]
 
 
+    def add_zone_doc_length(self, zone, doc_id, normalized_length):
+        """
+        Sets the normalised length of the zone of the document.
+        """
+        self.zone_doc_lengths[zone][doc_id] = normalized_length
+
+
+    def get_zone_doc_length(self, zone, doc_id):
+        """
+        Returns the normalised length of the zone of the document.
+
+        :param zone: zone of the document. Eg. title
+        :param doc_id: document ID
+        :return: float normalised length of the zone. 0 if the zone of the document has no terms
+        """
+        return self.zone_doc_lengths[zone].get(doc_id, 0)
+
+
+    def get_doc_table(self):
+        """
+        Returns the dense table of documents, where the index of a document is its position
+        in the sorted docIDs.
+
+        :return: doc_ids, normalised_lengths: array('q') of sorted docIDs, and array('d') of their normalised lengths
+        """
+        if self.doc_table is None:
+            docs = sorted((int(doc_id), length) for doc_id, length in self.normalised_doc_lengths.items())
+
+            self.doc_table = (array('q', [doc_id for doc_id, _ in docs]),
+                              array('d', [length for _, length in docs]))
+
+        return self.doc_table
+
+
     def add_court_weight(self, doc_id, court_weight):
         """
         Sets the weight of the term frequencies for the document, based on importance of court.
@@ -145,17 +369,124 @@ class Dictionary(object):
         :param doc_id: document ID
         :return: term frequency weights
         """
-        if doc_id not in self.court_weights:
-        	return 1
+        return self.court_weights.get(doc_id, 1)
+
+
+    def add_doc_location(self, doc_id, offset, size):
+        """
+        Sets the location of the document's row in the dataset file.
+
+        :param doc_id: docId for which it is to be set
+        :param offset: byte offset of the row
+        :param size: number of bytes of the row
+        """
+        self.doc_offsets[doc_id] = offset
+        self.doc_sizes[doc_id] = size
+
+
+    def get_doc_location(self, doc_id):
+        """
+        Returns the location of the document's row in the dataset file.
+
+        :param doc_id: document ID
+        :return: offset, size in bytes. -1, -1 if the location is not present
+        """
+        return self.doc_offsets.get(doc_id, -1), self.doc_sizes.get(doc_id, -1)
+
+
+    def add_doc_hash(self, doc_id, doc_hash):
+        """
+        Sets the hash of the fields of the document's row when it was indexed.
+
+        :param doc_id: docId for which it is to be set
+        :param doc_hash: non-negative integer
+        """
+        self.doc_hashes[doc_id] = doc_hash
+
+
+    def get_doc_hash(self, doc_id):
+        """
+        Returns the hash of the fields of the document's row when it was indexed.
+
+        :param doc_id: document ID
+        :return: hash, or -1 if the document is not present or its index has no hashes
+        """
+        return self.doc_hashes.get(doc_id, -1)
+
+
+    def add_forward_location(self, doc_id, offset, size):
+        """
+        Sets the location of the document's vector in the forward index.
+
+        :param doc_id: docId for which it is to be set
+        :param offset: byte offset of the vector
+        :param size: number of bytes of the vector
+        """
+        self.forward_offsets[doc_id] = offset
+        self.forward_sizes[doc_id] = size
+
+
+    def get_forward_location(self, doc_id):
+        """
+        Returns the location of the document's vector in the forward index.
 
-        return self.court_weights[doc_id]
+        :param doc_id: document ID
+        :return: offset, size in bytes. -1, -1 if the document has no vector
+        """
+        return self.forward_offsets.get(doc_id, -1), self.forward_sizes.get(doc_id, -1)
+
+
+    def set_dataset_file(self, dataset_file):
+        """
+        Sets the path of the dataset file that is indexed.
+        """
+        self.dataset_file = dataset_file
+
+
+    def get_dataset_file(self):
+        """
+        Returns the path of the dataset file that was indexed.
+        """
+        return self.dataset_file
 
 
-    def add_doc_count(self):
+    def set_biword_min_df(self, min_df):
+        """
+        Sets the minimum document frequency of the biwords that are indexed. None if biwords are not indexed.
+        """
+        self.biword_min_df = min_df
+
+
+    def get_biword_min_df(self):
+        """
+        Returns the minimum document frequency of the indexed biwords, or None if biwords are not indexed.
+        A biword that is not in the dictionary does not occur in the collection only if this is at most 1.
+        """
+        return self.biword_min_df
+
+
+    def set_precomputed_weights(self, has_weights):
+        """
+        Sets whether the court-weighted log-tf and the log-tf normalised by document length 
+        are computed when saving the postings, instead of when reading them.
+
+        :param has_weights: bool
+        """
+        self.has_weights = has_weights
+
+
+    def has_precomputed_weights(self):
+        """
+        Returns whether the postings have precomputed weights.
+        """
+        return self.has_weights
+
+
+    def add_doc_count(self, num_of_docs=1):
         """
         Increment doc count of collection.
         """
-        self.num_of_docs += 1
+        self.num_of_docs += num_of_docs
 
 
     def get_doc_count(self):
@@ -168,28 +499,51 @@ class Dictionary(object):
 
     def save(self):
         """
-        Saves dictionary dict() using pickle dump
-        in dict format as {terms: {}, normalised_doc_lengths: {}, num_of_docs: int}
+        Saves dictionary in the compact format of compact.py, with the terms and documents
+        stored as sorted arrays, and the scalars { num_of_docs: int, has_weights: bool, dataset_file: str, biword_min_df: int }
         """
-        with open(self.disk_file, 'wb') as f:
-            pickle.dump({
-                "terms": self.terms,
-                "court_weights": self.court_weights,
-                "normalised_doc_lengths": self.normalised_doc_lengths,
-                "num_of_docs": self.num_of_docs}, f)
-        f.close()
+        compact.save(self.disk_file, self.terms, 
+            { "normalised_doc_lengths": self.normalised_doc_lengths, "court_weights": self.court_weights,
+              "doc_offsets": self.doc_offsets, "doc_sizes": self.doc_sizes, "doc_hashes": self.doc_hashes,
+              "forward_offsets": self.forward_offsets, "forward_sizes": self.forward_sizes,
+              **{zone + "_doc_lengths": self.zone_doc_lengths[zone] for zone in zones.ZONES} },
+            { "num_of_docs": self.num_of_docs, "has_weights": self.has_weights, "dataset_file": self.dataset_file,
+              "biword_min_df": self.biword_min_df })
 
 
     def load(self):
         """
-        Loads dictionary from disk and stores in the Dictionary in memory object
-        in dict format as {terms: {}, normalised_doc_lengths: {}, num_of_docs: int}
+        Loads dictionary from disk by memory-mapping the compact format. The terms and 
+        documents tables are read-only mappings backed by the arrays in the file.
+
+        Dictionaries pickled by older versions are loaded into memory 
+        in dict format as {terms: {}, normalised_doc_lengths: {}, num_of_docs: int, has_weights: bool}
         """
+        if compact.is_compact(self.disk_file):
+            terms, doc_ids, doc_tables, scalars = compact.load(self.disk_file)
+
+            self.terms = terms
+            self.court_weights = doc_tables["court_weights"]
+            self.normalised_doc_lengths = doc_tables["normalised_doc_lengths"]
+            self.doc_offsets = doc_tables.get("doc_offsets", {})
+            self.doc_sizes = doc_tables.get("doc_sizes", {})
+            self.doc_hashes = doc_tables.get("doc_hashes", {})
+            self.forward_offsets = doc_tables.get("forward_offsets", {})
+            self.forward_sizes = doc_tables.get("forward_sizes", {})
+            self.zone_doc_lengths = {zone: doc_tables.get(zone + "_doc_lengths", {}) for zone in zones.ZONES}
+            self.num_of_docs = scalars["num_of_docs"]
+            self.has_weights = scalars["has_weights"]
+            self.dataset_file = scalars.get("dataset_file")
+            self.biword_min_df = scalars.get("biword_min_df")
+            self.doc_table = (doc_ids, self.normalised_doc_lengths.values)
+            return
+
         with open(self.disk_file, 'rb') as f:
             res = pickle.load(f)
             self.terms = res["terms"]
             self.court_weights = res["court_weights"]
             self.normalised_doc_lengths = res["normalised_doc_lengths"]
             self.num_of_docs = res["num_of_docs"]
+            self.has_weights = res.get("has_weights", False)
 
         f.close()
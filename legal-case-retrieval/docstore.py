@@ -0,0 +1,215 @@
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+
+maxInt = sys.maxsize
+while True:
+    try:
+        csv.field_size_limit(maxInt)
+        break
+    except OverflowError:
+        maxInt = int(maxInt/10)
+
+
+def read_records(dataset_file):
+    """
+    Streams the records of the CSV data file one at a time, with their location in the file.
+    Only the lines of the current record are kept in memory.
+
+    A record is complete at the end of a line when it has an even number of quotes, as
+    quotes in fields are escaped by doubling them.
+
+    Params:
+        - dataset_file: Path to dataset
+
+    Returns:
+        - Generator of (row, offset, size) where offset and size are the bytes of the record in the file
+    """
+    with open(dataset_file, 'rb') as dataset_csv:
+        offset = 0
+        lines = []
+        num_of_quotes = 0
+
+        for line in dataset_csv:
+            lines.append(line)
+            num_of_quotes += line.count(b'"')
+
+            if num_of_quotes % 2 == 0:
+                record = b''.join(lines)
+
+                row = parse_record(record)
+                if row:
+                    yield row, offset, len(record)
+
+                offset += len(record)
+                lines = []
+                num_of_quotes = 0
+
+    dataset_csv.close()
+
+
+def parse_record(record):
+    """
+    Parses the bytes of a CSV record into a row, with newlines in fields translated
+    to '\\n' as when reading the file in text mode.
+
+    :return: row [field, ...], or [] for a blank line
+    """
+    text = record.decode('utf8').replace('\r\n', '\n').replace('\r', '\n')
+
+    for row in csv.reader(io.StringIO(text, newline='')):
+        return row
+
+    return []
+
+
+def get_row_hash(row):
+    """
+    Returns the hash of the fields of a row, saved in the dictionary to tell whether
+    the row of a document has changed since it was indexed.
+
+    :param row: [docId, title, content, date, court]
+    :return: 56-bit non-negative integer, so that it is never the -1 of a missing value
+    """
+    digest = hashlib.blake2b(json.dumps(row).encode('utf8'), digest_size=7).digest()
+
+    return int.from_bytes(digest, 'little')
+
+
+def write_record(rows, record):
+    """
+    Appends the bytes of a CSV record to a rows file, ending it with a newline.
+
+    :param rows: rows file opened for writing in binary mode
+    :return: offset, size in bytes of the record in the rows file
+    """
+    # The last record of a dataset file may not end with a newline
+    if not record.endswith(b'\n'):
+        record += b'\n'
+
+    offset = rows.tell()
+    rows.write(record)
+
+    return offset, len(record)
+
+
+def copy_records(records, dataset_file, rows):
+    """
+    Copies the streamed records of the dataset file to a rows file, so that the rows of the
+    documents are kept when the dataset file is later overwritten.
+
+    Params:
+        - records: (row, offset, size) of the records of the dataset file, as read by `read_records`
+        - dataset_file: Path to dataset
+        - rows: rows file opened for writing in binary mode
+
+    Returns:
+        - Generator of (row, offset, size) where offset and size are the bytes of the copied record in the rows file
+    """
+    with open(dataset_file, 'rb') as dataset_csv:
+        for row, offset, size in records:
+            dataset_csv.seek(offset)
+            copy_offset, copy_size = write_record(rows, dataset_csv.read(size))
+
+            yield row, copy_offset, copy_size
+
+    dataset_csv.close()
+
+
+class DocumentStore(object):
+    """
+    Fetches the raw CSV rows of documents from the dataset file, using the byte offsets
+    and sizes of the records saved in the dictionary while indexing. A row is only returned
+    if it has the hash saved for the document, as the dataset file may have been overwritten since.
+    """
+    def __init__(self, dictionary, dataset_file=None):
+        self.dictionary = dictionary
+        self.dataset_file = dataset_file if dataset_file is not None else dictionary.get_dataset_file()
+
+    def get_record(self, doc_id):
+        """
+        Reads the bytes of the CSV record of the document from the dataset file. If the row is no longer
+        at its location, the dataset file is searched for it.
+
+        :param doc_id: document ID
+        :return: bytes of the record, or None if document not present or its row has changed
+        """
+        record = self.read_record(doc_id)
+        if record is None and self.dictionary.get_doc_hash(doc_id) != -1:
+            return self.find_records({doc_id}).get(doc_id)
+
+        return record
+
+    def read_record(self, doc_id):
+        """
+        Reads the bytes of the CSV record of the document at its location in the dataset file.
+
+        :param doc_id: document ID
+        :return: bytes of the record, or None if document not present or the row at its location is not its indexed row
+        """
+        offset, size = self.dictionary.get_doc_location(doc_id)
+        if offset == -1 or not os.path.exists(self.dataset_file):
+            return None
+
+        with open(self.dataset_file, 'rb') as dataset_csv:
+            dataset_csv.seek(offset)
+            record = dataset_csv.read(size)
+
+        dataset_csv.close()
+
+        try:
+            row = parse_record(record)
+        except (UnicodeDecodeError, csv.Error):
+            # The bytes were cut from other rows of an overwritten dataset file
+            return None
+
+        if not self.is_indexed_row(doc_id, row):
+            return None
+
+        return record
+
+    def find_records(self, doc_ids):
+        """
+        Finds the records of the documents anywhere in the dataset file, by their docID and hash.
+        Used for the documents whose rows have moved in the dataset file since it was indexed, in a single pass.
+
+        :param doc_ids: set of document IDs
+        :return: { docID: bytes of the record } of the documents found
+        """
+        records = {}
+        if not os.path.exists(self.dataset_file):
+            return records
+
+        with open(self.dataset_file, 'rb') as dataset_csv:
+            for row, offset, size in read_records(self.dataset_file):
+                if row[0] in doc_ids and row[0] not in records and self.is_indexed_row(row[0], row):
+                    dataset_csv.seek(offset)
+                    records[row[0]] = dataset_csv.read(size)
+
+        dataset_csv.close()
+
+        return records
+
+    def is_indexed_row(self, doc_id, row):
+        """
+        Returns True if the row has the hash saved for the document, or if no hash was saved.
+        """
+        doc_hash = self.dictionary.get_doc_hash(doc_id)
+
+        return doc_hash == -1 or (len(row) > 0 and row[0] == doc_id and doc_hash == get_row_hash(row))
+
+    def get_document(self, doc_id):
+        """
+        Reads the row of the document from the dataset file.
+
+        :param doc_id: document ID
+        :return: row [docId, title, content, date, court], or None if document not present
+        """
+        record = self.get_record(doc_id)
+        if record is None:
+            return None
+
+        return parse_record(record)
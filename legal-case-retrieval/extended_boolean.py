@@ -1,42 +1,91 @@
-from collections import defaultdict 
+import heapq
 
 from dictionary import Dictionary
 from postingsfile import PostingsFile
 
-def extended_boolean_p_norm_model(query, query_term_weights, document_term_weights):
+P = 1  # Operator coefficient p-value to indicate the degree of strictness
+
+AND = 'AND'
+OR = 'OR'
+
+def get_query_values(query, query_term_weights, p=P):
+    """
+    Returns the query values a_i^p of the distinct query terms, in order of first occurrence.
+    A term that occurs several times in the query is counted as many times.
+
+    :return: { term: query value }
+    """
+    query_values = {}
+    for query_token in query:
+        query_values[query_token] = query_values.get(query_token, 0) + 1
+
+    return {query_token: count * pow(query_term_weights[query_token], p) for query_token, count in query_values.items()}
+
+
+def get_doc_term_value(query_value, doc_term_weight, operator=AND, p=P):
+    """
+    Returns the value a document with the term adds to its sum, compared to a document without
+    the term (of weight 0). Only the terms in the document are needed to compute its similarity.
+
+        AND: a_i^p * (1 - (1 - d_i)^p)
+        OR:  a_i^p * d_i^p
+    """
+    if operator == AND:
+        return query_value * (1 - pow(1 - doc_term_weight, p))
+
+    return query_value * pow(doc_term_weight, p)
+
+
+def get_similarity(doc_value, sum_query_values, operator=AND, p=P):
+    """
+    Returns the query-document similarity from the sum of the values of the terms in the document.
+
+        AND: 1 - ( sum(a_i^p * (1 - d_i)^p) / sum(a_i^p) )^(1/p)
+        OR:  ( sum(a_i^p * d_i^p) / sum(a_i^p) )^(1/p)
+    """
+    if operator == AND:
+        return 1 - pow((sum_query_values - doc_value) / sum_query_values, 1 / p)
+
+    return pow(doc_value / sum_query_values, 1 / p)
+
+
+def extended_boolean_p_norm_model(query, query_term_weights, term_postings, operator=AND, p=P, k=None):
     """
-    Returns search results for the boolean AND query, by using the P-norm Extended Boolean model as
+    Returns search results for the boolean AND or OR query, by using the P-norm Extended Boolean model as
     described in http://dns.uls.cl/~ej/daa_08/Algoritmos/books/book5/chap15.htm
 
+    The sums of the documents are accumulated one postings list at a time, so the time and memory
+    are linear in the number of postings of the query terms, instead of the number of query terms
+    times the number of documents.
+
     Params:
         - query: boolean query string tokens. Eg. ['"fertility treatment"', 'damages', '"medicine "', 'sick']
         - query_term_weights: Query term weights a_i. { term: query weight }
-        - document_term_weights: Document weights for terms d_i. defaultdict of defaultdicts. { docID: { term: doc_term_weight } }
-    
+        - term_postings: Document weights d_i in [0, 1] of the terms. { term: [ (docID, doc_term_weight), ... ] }
+        - operator: AND or OR
+        - p: Operator coefficient. 1 for the vector space model, and the strict boolean model as p grows
+        - k: number of top results to return. None to return all results
+
     Returns:
         - search_results: Document IDs and query-doc similarities sorted by relevance [(docID, similarity), ...]
     """
-    P = 1 # Operator coefficient p-value to indicate the degree of strictness
-    document_values = defaultdict(lambda: {'numerator': 0.0, 'denominator': 0.0})
-
-    for query_token in query:
-        for docID, term_weights in document_term_weights.items():
-            query_val = pow(query_term_weights[query_token], P)
-            doc_term_val = pow(1 - term_weights[query_token], P) # compute numerator value for AND query
+    query_values = get_query_values(query, query_term_weights, p)
+    sum_query_values = sum(query_values.values())
 
-            document_values[docID]['numerator'] += query_val * doc_term_val
-            document_values[docID]['denominator'] += query_val
+    document_values = {}  # { docID: sum of the values of the terms in the document }
+    for query_token, query_value in query_values.items():
+        for docID, doc_term_weight in term_postings[query_token]:
+            doc_term_value = get_doc_term_value(query_value, doc_term_weight, operator, p)
+            document_values[docID] = document_values.get(docID, 0.0) + doc_term_value
 
     # Compute query-document similarities
-    document_similarities = []
-    for docID in document_values:
-        numer = document_values[docID]['numerator']
-        denom = document_values[docID]['denominator']
-
-        similarity = 1 - pow((numer / denom), 1 / P) # compute similarity for AND query
-        document_similarities.append((docID, similarity))
+    document_similarities = [(docID, get_similarity(doc_value, sum_query_values, operator, p))
+                                for docID, doc_value in document_values.items()]
 
     # Sort documents from highest to lowest similarities
+    if k is not None:
+        return heapq.nlargest(k, document_similarities, key=lambda x: x[1])
+
     search_results = sorted(document_similarities, key=lambda x: x[1], reverse=True)
-    
+
     return search_results
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+"""
+Facets of the documents, to filter the results of queries by court and by year.
+
+While indexing, the docIDs of each court and of each year of the documents are collected, and saved
+as compressed bitmaps (see `bitmap.py`) next to the postings file (`postings-file.facets`). A query
+can contain filter clauses on the facets:
+
+    court:"SG Court of Appeal"    documents of the court, case insensitive
+    year:2015                     documents dated in 2015
+    year:2010-2015                documents dated from 2010 to 2015, with 2010 <= 2015 <= MAX_YEAR
+
+Clauses on the same field match the documents of any of their values, and the clauses on different
+fields must all match. The bitmap of the documents that match the filter is intersected with the
+postings lists of the query terms before the documents are scored.
+
+Format of the file, after the MAGIC header and FORMAT_VERSION byte, and the length of the metadata as
+8 bytes little-endian:
+
+    metadata       JSON { facet: [offset, size] } with facets as "field:value", eg. "court:sg high court"
+    bitmaps        bitmap of the docIDs of each facet, at offset from the end of the metadata
+"""
+import getopt
+import json
+import os
+import re
+import sys
+from array import array
+
+import util
+from bitmap import Bitmap
+
+MAGIC = b'LCRFACET'
+FORMAT_VERSION = 1
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+
+FILTER_CLAUSE = re.compile(r'\b(court|year):(?:"([^"]*)"|(\S+))')
+MAX_YEAR = 9999  # Largest end of a range of years
+
+
+def get_file_name(postings_file):
+    """
+    Returns the name of the facets file saved next to the postings file.
+    """
+    return postings_file + '.facets'
+
+
+def has_facets(postings_file):
+    return os.path.exists(get_file_name(postings_file))
+
+
+def get_facet(field, value):
+    """
+    Returns the facet of the value of the field. Eg. court:sg high court
+    """
+    return field + ':' + value.strip().lower()
+
+
+def get_doc_facets(row):
+    """
+    Returns the facets of the document.
+
+    :param row: [docId, title, content, date, court] where date is "YYYY-MM-DD hh:mm:ss"
+    :return: [ "court:...", "year:YYYY" ]
+    """
+    doc_facets = [get_facet('court', row[4])]
+
+    year = row[3].strip()[:4]
+    if year.isdigit():
+        doc_facets.append(get_facet('year', year))
+
+    return doc_facets
+
+
+def parse_filters(query_str):
+    """
+    Removes the filter clauses from the query.
+
+    Eg. 'damages AND court:"SG High Court" AND year:2010-2015' -> 'damages', { court: ['SG High Court'], year: ['2010-2015'] }
+
+    Returns:
+        - query_str: the query without the filter clauses and their AND operators
+        - filters: { field: [value, ...] }. Empty if the query has no filter clauses
+    """
+    filters = {}
+    for match in FILTER_CLAUSE.finditer(query_str):
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        filters.setdefault(match.group(1), []).append(value)
+
+    if not filters:
+        return query_str, filters
+
+    return util.remove_clauses(query_str, FILTER_CLAUSE), filters
+
+
+class FacetIndex(object):
+    """
+    Builds the bitmaps of the facets while indexing, and reads them to filter queries.
+    """
+    def __init__(self, file_name):
+        self.disk_file = file_name
+        self.facet_docs = {}  # { facet: array of docIDs } while indexing
+        self.locations = None  # { facet: [offset, size] } of the saved bitmaps. Read when needed
+        self.data = None  # Saved bitmaps
+        self.bitmaps = {}  # { facet: Bitmap } decoded so far
+
+    def add_doc(self, doc_id, doc_facets):
+        """
+        Adds the document to the bitmaps of its facets.
+        """
+        for facet in doc_facets:
+            if facet not in self.facet_docs:
+                self.facet_docs[facet] = array('I')
+
+            self.facet_docs[facet].append(int(doc_id))
+
+    def save(self):
+        """
+        Saves the bitmaps of the facets in sorted order of facets.
+        """
+        bitmaps = [(facet, Bitmap.from_sorted(sorted(doc_ids)).to_bytes()) for facet, doc_ids in sorted(self.facet_docs.items())]
+
+        locations = {}
+        offset = 0
+        for facet, bitmap_bytes in bitmaps:
+            locations[facet] = [offset, len(bitmap_bytes)]
+            offset += len(bitmap_bytes)
+
+        metadata = json.dumps(locations).encode('utf8')
+
+        with open(self.disk_file, 'wb') as facets_file:
+            facets_file.write(HEADER)
+            facets_file.write(len(metadata).to_bytes(8, 'little'))
+            facets_file.write(metadata)
+
+            for _, bitmap_bytes in bitmaps:
+                facets_file.write(bitmap_bytes)
+
+        facets_file.close()
+
+        self.facet_docs = {}
+
+    def load(self):
+        """
+        Reads the facets file. The bitmaps are decoded when they are first used.
+        """
+        if not os.path.exists(self.disk_file):
+            raise ValueError("The index has no facets to filter by. Re-index the collection.")
+
+        with open(self.disk_file, 'rb') as facets_file:
+            data = facets_file.read()
+
+        facets_file.close()
+
+        if data[:len(HEADER)] != HEADER:
+            raise ValueError("Unsupported facets file format version " + str(data[len(HEADER) - 1]) + ". Re-index the collection.")
+
+        metadata_length = int.from_bytes(data[len(HEADER):len(HEADER) + 8], 'little')
+        data_start = len(HEADER) + 8 + metadata_length
+
+        self.locations = json.loads(data[len(HEADER) + 8:data_start].decode('utf8'))
+        self.data = memoryview(data)[data_start:]
+
+    def get_facets(self):
+        """
+        Returns the sorted facets of the documents.
+        """
+        if self.locations is None:
+            self.load()
+
+        return sorted(self.locations)
+
+    def get_bitmap(self, facet):
+        """
+        Returns the bitmap of the documents of the facet. Empty if no document has the facet.
+        """
+        if self.locations is None:
+            self.load()
+
+        if facet not in self.bitmaps:
+            if facet not in self.locations:
+                return Bitmap()
+
+            offset, size = self.locations[facet]
+            self.bitmaps[facet] = Bitmap.from_bytes(self.data[offset:offset + size])
+
+        return self.bitmaps[facet]
+
+    def get_value_bitmap(self, field, value):
+        """
+        Returns the bitmap of the documents with the value of the field, or with a year in the range of years.
+        Only the years of the documents are looked up for a range. Raises ValueError for a range of years
+        that is reversed or ends after MAX_YEAR.
+        """
+        years = value.split('-')
+        if field == 'year' and len(years) == 2 and years[0].isdigit() and years[1].isdigit():
+            start, end = int(years[0]), int(years[1])
+            if start > end or end > MAX_YEAR:
+                raise ValueError("Invalid range of years " + value + ", expected year:start-end with start <= end <= " + str(MAX_YEAR))
+
+            year_prefix = get_facet('year', '')
+
+            bitmap = Bitmap()
+            for facet in self.get_facets():
+                year = facet[len(year_prefix):]
+                if facet.startswith(year_prefix) and year.isdigit() and start <= int(year) <= end:
+                    bitmap = bitmap | self.get_bitmap(facet)
+
+            return bitmap
+
+        return self.get_bitmap(get_facet(field, value))
+
+    def get_filter(self, filters):
+        """
+        Returns the bitmap of the documents that match the filters.
+
+        :param filters: { field: [value, ...] } as returned by `parse_filters`
+        """
+        doc_filter = None
+
+        for field, values in filters.items():
+            field_bitmap = Bitmap()
+            for value in values:
+                field_bitmap = field_bitmap | self.get_value_bitmap(field, value)
+
+            doc_filter = field_bitmap if doc_filter is None else doc_filter & field_bitmap
+
+        return doc_filter
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -p postings-file")
+
+
+if __name__ == "__main__":
+    postings_file = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-p':
+            postings_file = a
+        else:
+            assert False, "unhandled option"
+
+    if postings_file == None:
+        usage()
+        sys.exit(2)
+
+    # List the facets of the index with their number of documents
+    facet_index = FacetIndex(get_file_name(postings_file))
+    for facet in facet_index.get_facets():
+        print(facet + '\t' + str(len(facet_index.get_bitmap(facet))))
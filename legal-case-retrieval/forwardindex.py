@@ -0,0 +1,227 @@
+"""
+Forward index of the collection, from each document to the terms it contains and their term frequencies.
+
+The file starts with MAGIC and the FORMAT_VERSION byte. The vector of a document is stored as varints:
+
+    num_of_terms  (termID gap, tf) * num_of_terms
+
+where termIDs are the positions of the terms in the sorted terms of the dictionary, stored as gaps
+from the previous termID in the vector. This is the same layout as the docs stream of a postings
+list (see `codec.py`). The offset and size of the vector of each document are stored in the dictionary.
+
+The vectors are built term by term as the postings lists are saved. When the vectors in memory reach the
+memory budget, they are flushed to a block file sorted by docID, and the blocks are merged into the forward
+index when it is saved.
+"""
+import heapq
+import mmap
+import os
+from array import array
+from itertools import groupby
+
+import codec
+import util
+
+MAGIC = b'LCRFWD'
+FORMAT_VERSION = 1
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+
+MEMORY_BUDGET = 64 * 1024 * 1024  # Default bytes of document vectors to keep in memory while indexing
+BYTES_PER_VECTOR = 300  # Vector of a document in memory, with its empty arrays
+BYTES_PER_TERM = 8  # termID and term frequency in the arrays of a vector
+
+
+def get_file_name(postings_file):
+    """
+    Returns the name of the forward index file saved next to the postings file.
+    """
+    return postings_file + '.fwd'
+
+
+class ForwardIndex(object):
+    """
+    Builds the document vectors from the postings lists while they are saved, and reads the
+    vector of a document with a single slice of the memory-mapped file, so that relevance
+    feedback does not need to scan every postings list of the collection.
+    """
+    def __init__(self, file_name, memory_budget=MEMORY_BUDGET):
+        self.disk_file = file_name
+        self.term_ids = {}  # { term: termID in order of saving }. Remapped to sorted order when saved
+        self.doc_vectors = {}  # { docID: (array of termIDs, array of tfs) } while indexing
+        self.memory_budget = memory_budget  # Bytes of vectors to keep in memory before flushing a block. None to keep all in memory
+        self.memory_usage = 0  # Estimated bytes used by the vectors in memory
+        self.block_files = []  # Blocks of vectors flushed to disk while indexing
+        self.mmap = None  # Memory-mapped forward index file
+        self.mmap_pid = None  # Process that created the mapping
+
+    def add_postings(self, term, docs):
+        """
+        Adds the term to the vectors of the documents in its postings list, and flushes the
+        vectors to a block if they reach the memory budget.
+
+        :param docs: [ (docID, [position, ...]), ... ]
+        """
+        term_id = self.term_ids.setdefault(term, len(self.term_ids))
+
+        for docID, positions in docs:
+            if docID not in self.doc_vectors:
+                self.doc_vectors[docID] = (array('I'), array('I'))
+                self.memory_usage += BYTES_PER_VECTOR
+
+            term_ids, tfs = self.doc_vectors[docID]
+            term_ids.append(term_id)
+            tfs.append(len(positions))
+
+        self.memory_usage += BYTES_PER_TERM * len(docs)
+
+        if self.memory_budget is not None and self.memory_usage >= self.memory_budget:
+            self.save_block()
+
+    def save_block(self):
+        """
+        Saves the vectors in memory to a new block on disk, sorted by docID, and removes them from memory.
+
+        Each line of the block is "docID<TAB>termID1#tf1 termID2#tf2 ", with the termIDs in order of saving
+        """
+        block_file = self.disk_file + '.block' + str(len(self.block_files))
+
+        with open(block_file, 'wt') as block:
+            for docID in sorted(self.doc_vectors):
+                term_ids, tfs = self.doc_vectors[docID]
+                block.write(str(docID) + '\t' + ''.join(str(term_id) + '#' + str(tf) + ' ' for term_id, tf in zip(term_ids, tfs)) + '\n')
+
+        block.close()
+
+        self.doc_vectors = {}
+        self.memory_usage = 0
+        self.block_files.append(block_file)
+
+    def read_block(self, block_idx):
+        """
+        Reads the lines of a block one at a time.
+
+        Returns:
+            - Generator of (docID, block_idx, vector_str) in sorted order of docIDs
+        """
+        with open(self.block_files[block_idx], 'rt') as block:
+            for line in block:
+                [docID, vector_str] = line.rstrip('\n').split('\t')
+                yield int(docID), block_idx, vector_str
+
+        block.close()
+
+    def read_vectors(self):
+        """
+        Returns the vectors in memory, or else performs a k-way merge of the blocks, with only the
+        vector of one document in memory at a time.
+
+        Returns:
+            - Generator of (docID, array of termIDs, array of tfs) in sorted order of docIDs
+        """
+        if not self.block_files:
+            for docID in sorted(self.doc_vectors):
+                yield (docID,) + self.doc_vectors[docID]
+            return
+
+        # Flush the remaining vectors and merge all the blocks
+        self.save_block()
+
+        blocks = [self.read_block(block_idx) for block_idx in range(len(self.block_files))]
+
+        for docID, block_lines in groupby(heapq.merge(*blocks), key=lambda line: line[0]):
+            term_ids = array('I')
+            tfs = array('I')
+            for _, _, vector_str in block_lines:
+                for term in vector_str.split():
+                    [term_id, tf] = term.split('#')
+                    term_ids.append(int(term_id))
+                    tfs.append(int(tf))
+
+            yield docID, term_ids, tfs
+
+    def save(self, dictionary):
+        """
+        Saves the document vectors in sorted order of docIDs, with the termIDs of the sorted
+        terms of the dictionary, and stores the offsets and sizes of the vectors in the dictionary.
+        The blocks flushed to disk are merged, and deleted.
+        """
+        sorted_term_ids = array('I', bytes(4 * len(self.term_ids)))
+        for sorted_term_id, term in enumerate(sorted(dictionary.get_terms())):
+            if term in self.term_ids:
+                sorted_term_ids[self.term_ids[term]] = sorted_term_id
+
+        with open(self.disk_file, 'wb') as forward_file:
+            forward_file.write(HEADER)
+
+            for docID, term_ids, tfs in self.read_vectors():
+                vector = sorted(zip((sorted_term_ids[term_id] for term_id in term_ids), tfs))
+
+                out = bytearray()
+                codec.encode_varint(len(vector), out)
+
+                prev_term_id = 0
+                for term_id, tf in vector:
+                    codec.encode_varint(term_id - prev_term_id, out)
+                    codec.encode_varint(tf, out)
+                    prev_term_id = term_id
+
+                dictionary.add_forward_location(str(docID), forward_file.tell(), len(out))
+                forward_file.write(out)
+
+        forward_file.close()
+
+        for block_file in self.block_files:
+            os.remove(block_file)
+        self.block_files = []
+
+        self.doc_vectors = {}
+        self.memory_usage = 0
+
+    def open_mmap(self):
+        """
+        Memory-maps the forward index file for this process, and checks its version.
+        """
+        with open(self.disk_file, 'rb') as forward_file:
+            self.mmap = mmap.mmap(forward_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        forward_file.close()
+
+        if self.mmap[:len(HEADER)] != HEADER:
+            raise ValueError("Unsupported forward index file format version " + str(self.mmap[len(HEADER) - 1]) + ". Re-index the collection.")
+
+        self.mmap_pid = os.getpid()
+
+    def close(self):
+        """
+        Unmaps the forward index file, if it is memory-mapped.
+        """
+        if self.mmap is not None:
+            self.mmap.close()
+
+        self.mmap = None
+        self.mmap_pid = None
+
+    def get_doc_vector_with_tf(self, doc_id, dictionary):
+        """
+        Returns the vector of the document as { term: raw tf }, without any court weights.
+        Empty if the document is not in the forward index.
+        """
+        offset, size = dictionary.get_forward_location(str(doc_id))
+        if offset == -1:
+            return {}
+
+        if self.mmap_pid != os.getpid():
+            self.open_mmap()
+
+        return {dictionary.get_term_by_id(term_id): tf
+                    for term_id, tf in codec.decode_postings(self.mmap[offset:offset + size])}
+
+    def get_doc_vector(self, doc_id, dictionary):
+        """
+        Returns the vector of the document as { term: log-tf }, with the term frequencies
+        weighted by the importance of the court, as in the postings lists of the terms.
+        """
+        tf_weight = dictionary.get_court_weight(str(doc_id))
+
+        return {term: 1 + util.log10(tf * tf_weight)
+                    for term, tf in self.get_doc_vector_with_tf(doc_id, dictionary).items()}
@@ -6,110 +6,322 @@ import nltk
 import sys
 import getopt
 import os
-import csv
+import multiprocessing
+from functools import partial
+from itertools import islice
 
 import util
 from dictionary import Dictionary
 from postingsfile import PostingsFile
+import forwardindex
 import court 
+import docstore
+import biword
+import facets
+import zones
+import segments
+import shards
 
 
-maxInt = sys.maxsize
-while True:
-    try:
-        csv.field_size_limit(maxInt)
-        break
-    except OverflowError:
-        maxInt = int(maxInt/10)
+CHUNK_SIZE = 16  # Rows tokenized in a batch, and sent to a worker process at a time
+BATCH_SIZE = 4096  # Rows read from the CSV before waiting for the workers, to bound memory
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i dataset-file -d dictionary-file -p postings-file")
+    print("usage: " + sys.argv[0] + " -i dataset-file -d dictionary-file -p postings-file [-w num-workers] [-m memory-budget-MB] [-t] [-b biword-min-df] [-n num-shards]")
+    print("       " + sys.argv[0] + " -a [-i dataset-file] [-x deleted-ids-file] -d dictionary-file -p postings-file [-w num-workers] [-m memory-budget-MB] [-t] [-b biword-min-df]")
+
+
+def read_rows(dataset_file):
+    """
+    Streams the rows of the CSV data file, skipping the header and duplicate document IDs.
+
+    Params:
+        - dataset_file: Path to dataset
+
+    Returns:
+        - Generator of (row, offset, size) where row is [docId, title, content, date, court], 
+        and offset and size are the bytes of the row in the dataset file
+    """
+    i = 0
+    prev_docId = 0
+
+    for row, offset, size in docstore.read_records(dataset_file):
+        i += 1
+
+        # Skip CSV header
+        if i == 1:
+            continue
+
+        docId = row[0]
+
+        # Skip duplicate document IDs
+        if prev_docId == docId:
+            continue
+
+        prev_docId = docId
+
+        yield row, offset, size
+
+
+def get_content(row):
+    """
+    Returns the text of a CSV row that is indexed: its title, content, date and court.
+    """
+    return row[1] + " " + row[2] + " " + row[3] + " " + row[4]
+
+
+def preprocess_row(record, tokens, zone_tokens, index_biwords=False):
+    """
+    Groups the term positions of the tokenized and stemmed content of a CSV row.
+
+    Params:
+        - record: (row, offset, size) where row is [docId, title, content, date, court]
+        - tokens: normalised tokens of the content of the row
+        - zone_tokens: normalised tokens of each zone of the row, in the order of zones.ZONES
+        - index_biwords: Whether to also group the positions of the pairs of adjacent terms
+
+    Returns:
+        - docId: document ID
+        - term_positions: { term: [position, ...] } in order of first occurrence
+        - biword_positions: { biword: [position, ...] }. Empty if biwords are not indexed
+        - zone_term_positions: { zone: { term: [position, ...] } } of the zones of doc, eg. the title
+        - court_weight: weight for term frequencies of doc
+        - doc_facets: court and year facets of doc, to filter queries by
+        - offset, size: bytes of the row in the dataset file
+        - doc_hash: hash of the fields of the row, to tell whether it changes (see `docstore.get_row_hash`)
+    """
+    row, offset, size = record
+
+    biword_positions = biword.get_biword_positions(tokens) if index_biwords else {}
+
+    return (row[0], util.get_term_positions(tokens), biword_positions, zones.get_zone_term_positions(zone_tokens),
+            court.get_court_weight(row[4]), facets.get_doc_facets(row), offset, size, docstore.get_row_hash(row))
+
+
+def preprocess_chunk(records, index_biwords=False):
+    """
+    Tokenizes and stems the contents and zones of a chunk of CSV rows in a single batch (see
+    `util.preprocess_contents`), and groups the term positions of each row.
+    Runs in the worker processes when indexing in parallel.
+
+    Returns:
+        - [ (docId, term_positions, ...) as returned by `preprocess_row`, ... ] in the order of the rows
+    """
+    contents = []
+    for row, _, _ in records:
+        contents.append(get_content(row))
+        contents.extend(zones.get_zone_contents(row))
+
+    tokens = util.preprocess_contents(contents)
+
+    preprocessed = []
+    for record in records:
+        row_tokens = next(tokens)
+        zone_tokens = [next(tokens) for _ in zones.ZONES]
+        preprocessed.append(preprocess_row(record, row_tokens, zone_tokens, index_biwords))
+
+    return preprocessed
 
 
-def process_csv(dataset_file, out_dict):
+def preprocess_rows(rows, num_workers, index_biwords=False):
+    """
+    Preprocesses the rows in order, in chunks of CHUNK_SIZE rows, using a pool of worker processes if more
+    than one worker is used. Rows are dispatched in batches so that the CSV is not read into memory ahead of the workers.
+
+    Returns:
+        - Generator of (docId, term_positions, biword_positions, zone_term_positions, court_weight, doc_facets, offset, size, doc_hash),
+        in the same order as the rows
+    """
+    preprocess = partial(preprocess_chunk, index_biwords=index_biwords)
+
+    if num_workers <= 1:
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+
+            yield from preprocess(chunk)
+        return
+
+    with multiprocessing.Pool(num_workers) as pool:
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+
+            chunks = [batch[i:i + CHUNK_SIZE] for i in range(0, len(batch), CHUNK_SIZE)]
+            for preprocessed in pool.imap(preprocess, chunks):
+                yield from preprocessed
+
+
+def process_csv(dataset_file, out_dict, num_workers=1, postings_file=None, memory_budget=None, precompute_weights=False,
+                biword_min_df=None, keep_row=None, facet_index=None, rows=None):
     """
     Parses and processes the CSV data file to create the index and postings lists.
+    Documents are added to the index in the order of the CSV, so the index is the same for any number of workers.
 
     Params:
         - dataset_file: Path to dataset
         - out_dict: Path to save dictionary to
+        - num_workers: Number of processes used to tokenize and stem the documents
+        - postings_file: PostingsFile to flush blocks of postings to
+        - memory_budget: Bytes of postings to keep in memory before flushing a block. None to keep all in memory
+        - precompute_weights: Whether to save the court-weighted log-tf and normalised weights in the postings
+        - biword_min_df: Minimum document frequency of the biwords to index. None to not index biwords
+        - keep_row: Function of a row [docId, title, content, date, court] that returns False to skip the row. None to index all rows
+        - facet_index: FacetIndex to add the court and year of each document to. None to not collect facets
+        - rows: File opened for writing in binary mode, to copy the indexed rows to. The locations of the documents are then in this file.
+        None to locate the documents in the dataset file
 
     Returns:
         - dictionary: Dictionary containing index and postings
     """
     dictionary = Dictionary(out_dict)
+    dictionary.set_precomputed_weights(precompute_weights)
+    dictionary.set_dataset_file(os.path.abspath(dataset_file if rows is None else rows.name))
+    dictionary.set_biword_min_df(biword_min_df)
 
-    with open(dataset_file, encoding="utf8") as dataset_csv:
-        i = 0
-        prev_docId = 0
+    records = read_rows(dataset_file)
+    if keep_row is not None:
+        records = (record for record in records if keep_row(record[0]))
+    if rows is not None:
+        records = docstore.copy_records(records, dataset_file, rows)
 
-        csv_reader = csv.reader(dataset_csv)
-        for row in csv_reader:
-            i += 1
+    for docId, term_positions, biword_positions, zone_term_positions, court_weight, doc_facets, offset, size, doc_hash in \
+            preprocess_rows(records, num_workers, biword_min_df is not None):
+        # For each document, add the term positions to the posting lists
+        normalised_tf = dictionary.add_term_positions_of_doc(term_positions, docId)
+        dictionary.add_biword_positions_of_doc(biword_positions, docId)
 
-            # Skip CSV header
-            if i == 1:
-                continue
+        # Terms of each zone are normalised by the length of the zone
+        for zone, positions in zone_term_positions.items():
+            dictionary.add_zone_doc_length(zone, docId, dictionary.add_zone_term_positions_of_doc(zone, positions, docId))
 
-            docId = row[0]
+        # Maintain document lengths, location in dataset and count in dictionary
+        dictionary.add_normalised_doc_length(docId, normalised_tf)
+        dictionary.add_court_weight(docId, court_weight)
+        dictionary.add_doc_location(docId, offset, size)
+        dictionary.add_doc_hash(docId, doc_hash)
+        dictionary.add_doc_count()
 
-            # Skip duplicate document IDs
-            if prev_docId == docId:
-                continue
-            
-            # For each document, get the content tokens and add it to the posting lists
-            tokens = util.preprocess_content(row[1] + " " + row[2] + " " + row[3] + " " + row[4])
-            normalised_tf = dictionary.add_tokens_of_doc(tokens, docId)
+        if facet_index is not None:
+            facet_index.add_doc(docId, doc_facets)
 
-            # Maintain document lengths and count in dictionary
-            dictionary.add_normalised_doc_length(docId, normalised_tf)
-            dictionary.add_court_weight(docId, court.get_court_weight(row[4]))
-            dictionary.add_doc_count()
+        if memory_budget is not None and dictionary.get_memory_usage() >= memory_budget:
+            postings_file.save_block(dictionary)
 
-            prev_docId = docId
-
-    dataset_csv.close()
+    # Document frequencies of the biwords are only known once all documents are added
+    if biword_min_df is not None:
+        dictionary.remove_rare_biwords(biword_min_df)
 
     return dictionary
 
 
-def build_index(dataset_file, out_dict, out_postings):
+def build_index(dataset_file, out_dict, out_postings, num_workers=1, memory_budget=None, precompute_weights=False,
+                biword_min_df=None, keep_row=None, rows_file=None):
     """
     build index from documents stored in the dataset file,
-    then output the dictionary file and postings file
+    then output the dictionary file and postings file, and the forward index and facets next to the postings file.
+    With a rows_file, the indexed rows are copied to it, and the documents are located in it instead of the dataset file
+
+    Returns:
+        - dictionary: the saved Dictionary
     """
     print('indexing...')
 
     postings_file = PostingsFile(out_postings)
+    facet_index = facets.FacetIndex(facets.get_file_name(out_postings))
+
+    if rows_file is None:
+        dictionary = process_csv(dataset_file, out_dict, num_workers, postings_file, memory_budget, precompute_weights,
+                                 biword_min_df, keep_row, facet_index)
+    else:
+        with open(rows_file, 'wb') as rows:
+            dictionary = process_csv(dataset_file, out_dict, num_workers, postings_file, memory_budget, precompute_weights,
+                                     biword_min_df, keep_row, facet_index, rows)
 
-    dictionary = process_csv(dataset_file, out_dict)
+        rows.close()
 
-    # Save dictionary and postings lists to disk
-    postings_file.save(dictionary)
+    # Save dictionary, postings lists and document vectors to disk
+    forward_index = forwardindex.ForwardIndex(forwardindex.get_file_name(out_postings), memory_budget or forwardindex.MEMORY_BUDGET)
+    postings_file.save(dictionary, forward_index)
+    forward_index.save(dictionary)
+    facet_index.save()
     dictionary.save()
 
+    return dictionary
+
+
+if __name__ == "__main__":
+    dataset_file = output_file_dictionary = output_file_postings = None
+    num_workers = 1
+    memory_budget = None
+    precompute_weights = False
+    biword_min_df = None
+    append = False
+    deleted_ids_file = None
+    num_shards = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:w:m:tb:ax:n:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i': # dataset file
+            dataset_file = a
+        elif o == '-d': # dictionary file
+            output_file_dictionary = a
+        elif o == '-p': # postings file
+            output_file_postings = a
+        elif o == '-w': # number of worker processes
+            num_workers = int(a)
+        elif o == '-m': # memory budget for postings in MB
+            memory_budget = int(float(a) * 1024 * 1024)
+        elif o == '-t': # precompute term weights
+            precompute_weights = True
+        elif o == '-b': # index the biwords in at least this many documents
+            biword_min_df = int(a)
+        elif o == '-a': # index the new and changed rows into a new segment
+            append = True
+        elif o == '-x': # file of docIDs to delete from the index, one per line
+            deleted_ids_file = a
+        elif o == '-n': # partition the documents into this many shards
+            num_shards = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if (dataset_file == None and not append) or output_file_postings == None or output_file_dictionary == None:
+        usage()
+        sys.exit(2)
+
+    if append and (num_shards is not None or shards.has_shards(output_file_dictionary)):
+        print("cannot append to an index built in shards")
+        sys.exit(2)
 
-dataset_file = output_file_dictionary = output_file_postings = None
+    if append:
+        deleted_doc_ids = []
+        if deleted_ids_file is not None:
+            with open(deleted_ids_file, 'r') as f:
+                deleted_doc_ids = [line.strip() for line in f if line.strip()]
 
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
+            f.close()
 
-for o, a in opts:
-    if o == '-i': # dataset file
-        dataset_file = a
-    elif o == '-d': # dictionary file
-        output_file_dictionary = a
-    elif o == '-p': # postings file
-        output_file_postings = a
+        manager = segments.SegmentManager(output_file_dictionary, output_file_postings)
+        manager.append(dataset_file, num_workers, memory_budget, precompute_weights, biword_min_df, deleted_doc_ids)
+        manager.merge_in_background()
     else:
-        assert False, "unhandled option"
+        # The new index replaces all the segments or shards of the previous index
+        if segments.has_segments(output_file_dictionary):
+            segments.SegmentManager(output_file_dictionary, output_file_postings).remove_segments()
 
-if dataset_file == None or output_file_postings == None or output_file_dictionary == None:
-    usage()
-    sys.exit(2)
+        if num_shards is not None:
+            shards.build_shards(dataset_file, output_file_dictionary, output_file_postings, num_shards, num_workers,
+                                memory_budget, precompute_weights, biword_min_df)
+        else:
+            shards.remove_shards(output_file_dictionary)
 
-build_index(dataset_file, output_file_dictionary, output_file_postings)
+            build_index(dataset_file, output_file_dictionary, output_file_postings, num_workers, memory_budget, precompute_weights,
+                        biword_min_df)
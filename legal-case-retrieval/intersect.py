@@ -0,0 +1,159 @@
+"""
+Engines for the intersection of postings lists [ (docID, log-tf), ... ] sorted by docID.
+
+All engines return the documents in both lists, with the minimum of their log-tf in the
+two lists, and can be passed to `intersect_many` as the engine of the intersection:
+
+    - intersect_merge: linear merge of the two lists
+    - intersect_galloping: exponential search in the longer list for each document of the shorter list
+    - intersect_numpy: vectorized intersection of the docIDs with numpy, for long lists
+    - intersect_auto: chooses one of the above from the lengths of the lists
+"""
+import bisect
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Long lists are intersected by merging without numpy
+
+GALLOPING_RATIO = 8  # Gallop when the longer list is this many times longer than the shorter list
+NUMPY_MIN_SIZE = 256  # Use numpy when the shorter list has at least this many documents
+
+
+def intersect_merge(list_1, list_2):
+    """
+    Merges the two lists in a single pass, advancing the list with the smaller docID.
+    Takes O(m + n) for lists of lengths m and n.
+    """
+    len_1 = len(list_1)
+    len_2 = len(list_2)
+
+    results = []
+    i = 0
+    j = 0
+    while i < len_1 and j < len_2:
+        docID_1, log_tf_1 = list_1[i]
+        docID_2, log_tf_2 = list_2[j]
+
+        if docID_1 == docID_2:
+            results.append((docID_1, min(log_tf_1, log_tf_2)))
+            i += 1
+            j += 1
+        elif docID_1 < docID_2:
+            i += 1
+        else:
+            j += 1
+
+    return results
+
+
+def gallop(postings, docID, start=0):
+    """
+    Returns the index of the first posting from start with a docID that is not less than docID,
+    or the length of the postings list if there is none. Doubles the step from start until it
+    passes the document, and then binary searches the last step, so that looking up documents
+    in increasing order takes time logarithmic in the distance between them.
+
+    :param postings: [ (docID, ...), ... ] sorted by docID
+    """
+    length = len(postings)
+
+    step = 1
+    while start + step < length and postings[start + step][0] < docID:
+        step *= 2
+
+    lo = start + step // 2 if step > 1 else start  # The previous step is before the document
+    return bisect.bisect_left(postings, docID, lo, min(start + step + 1, length), key=lambda posting: posting[0])
+
+
+def intersect_galloping(list_1, list_2):
+    """
+    Looks up each document of the shorter list in the longer list, by doubling the step from
+    the previous match until it passes the document, and then binary searching the last step.
+    Takes O(m log(n/m)) for lists of lengths m < n, instead of O(m + n).
+    """
+    swapped = len(list_1) > len(list_2)
+    short, long = (list_2, list_1) if swapped else (list_1, list_2)
+    len_long = len(long)
+
+    results = []
+    j = 0
+    for docID, log_tf in short:
+        j = gallop(long, docID, j)
+        if j == len_long:
+            break
+
+        if long[j][0] == docID:
+            # Keep the order of the arguments of min, as in intersect_merge
+            if swapped:
+                results.append((docID, min(long[j][1], log_tf)))
+            else:
+                results.append((docID, min(log_tf, long[j][1])))
+            j += 1
+
+    return results
+
+
+def intersect_numpy(list_1, list_2):
+    """
+    Intersects the docIDs of the lists as numpy arrays. DocIDs are unique in a postings list.
+    """
+    if not list_1 or not list_2:
+        return []
+
+    postings_1 = np.fromiter(chain.from_iterable(list_1), np.float64, 2 * len(list_1)).reshape(-1, 2)
+    postings_2 = np.fromiter(chain.from_iterable(list_2), np.float64, 2 * len(list_2)).reshape(-1, 2)
+
+    docIDs, idx_1, idx_2 = np.intersect1d(postings_1[:, 0], postings_2[:, 0], assume_unique=True, return_indices=True)
+    log_tfs = np.minimum(postings_1[idx_1, 1], postings_2[idx_2, 1])
+
+    return list(zip(docIDs.astype(np.int64).tolist(), log_tfs.tolist()))
+
+
+def intersect_auto(list_1, list_2):
+    """
+    Gallops if one list is much longer than the other, uses numpy if both lists are long,
+    and merges otherwise.
+    """
+    short_len, long_len = sorted((len(list_1), len(list_2)))
+
+    if long_len >= GALLOPING_RATIO * short_len:
+        return intersect_galloping(list_1, list_2)
+
+    if np is not None and short_len >= NUMPY_MIN_SIZE:
+        return intersect_numpy(list_1, list_2)
+
+    return intersect_merge(list_1, list_2)
+
+
+ENGINES = {
+    "merge": intersect_merge,
+    "galloping": intersect_galloping,
+    "numpy": intersect_numpy,
+    "auto": intersect_auto,
+}
+
+
+def intersect_many(postings_lists, engine=intersect_auto):
+    """
+    Intersects all the postings lists, starting from the shortest list so that the
+    intermediate results are as short as possible. Stops as soon as the result is empty.
+
+    :param postings_lists: [ [ (docID, log-tf), ... ], ... ]
+    :param engine: function to intersect two postings lists
+    :return: [ (docID, minimum log-tf), ... ]
+    """
+    if not postings_lists:
+        return []
+
+    postings_lists = sorted(postings_lists, key=len)
+
+    results = postings_lists[0]
+    for postings in postings_lists[1:]:
+        if not results:
+            break
+
+        results = engine(results, postings)
+
+    return results
@@ -0,0 +1,190 @@
+"""
+Matching of phrases of any number of terms in positional postings lists, with optional slop.
+
+A phrasal query term is written in quotes, optionally followed by the slop, the number of other
+words allowed between consecutive terms of the phrase:
+
+    "breach of fiduciary duty"      exact phrase
+    "fiduciary duty care"~2         the terms in order, with up to 2 words between each term
+"""
+import bisect
+import re
+
+import util
+import intersect
+
+PHRASE_PATTERN = re.compile(r'^"(.*)"(?:~(\d+))?$')
+SLOP_PATTERN = re.compile(r'"~\d+')
+
+
+def parse_phrase(query_token):
+    """
+    Parses a phrasal query term.
+
+    :param query_token: query token. Eg. '"fertility treatment"~1'
+    :return: phrase, slop. Eg. 'fertility treatment', 1. None, 0 if the token is not a phrase
+    """
+    match = PHRASE_PATTERN.match(query_token)
+    if match is None:
+        return None, 0
+
+    return match.group(1), int(match.group(2) or 0)
+
+
+def remove_slop(query_str):
+    """
+    Removes the slop of the phrases in the query string. Eg. '"fiduciary duty"~2 AND care' to '"fiduciary duty" AND care'
+    """
+    return SLOP_PATTERN.sub('"', query_str)
+
+
+def count_phrase(positions_lists, slop=0):
+    """
+    Counts the occurrences of the phrase in a document, as the number of positions of the first
+    term from which the other terms follow in order, each within slop words after the previous term.
+
+    With slop, the earliest position of a term after the previous term is not always the one from
+    which the phrase can be completed, eg. "court appeal damage"~1 in "court appeal appeal witness damage".
+    So from each start position, all the positions of each term that can be reached from the
+    reachable positions of the previous term are kept.
+
+    :param positions_lists: sorted positions of each term in the document, in the order of the phrase
+    :return: phrase frequency
+    """
+    if slop == 0:
+        return count_exact_phrase(positions_lists)
+
+    count = 0
+    for start in positions_lists[0]:
+        reachable = [start]
+
+        for positions in positions_lists[1:]:
+            reachable = get_reachable_positions(reachable, positions, slop)
+            if not reachable:
+                break
+        else:
+            count += 1
+
+    return count
+
+
+def count_exact_phrase(positions_lists):
+    """
+    Counts the occurrences of the exact phrase in a document, like `count_phrase` without slop.
+
+    The positions lists are walked once: each term must be right after the previous term, and for a
+    later start position, the next position of each following term can only be later, so the cursor
+    of each term only moves forward.
+    """
+    cursors = [0] * len(positions_lists)
+
+    count = 0
+    for start in positions_lists[0]:
+        pos = start
+
+        for i in range(1, len(positions_lists)):
+            positions = positions_lists[i]
+
+            # Earliest position of the term after the previous term
+            cursor = cursors[i]
+            while cursor < len(positions) and positions[cursor] <= pos:
+                cursor += 1
+            cursors[i] = cursor
+
+            if cursor == len(positions):
+                # No occurrence of the term after this start, or any later start
+                return count
+
+            if positions[cursor] != pos + 1:
+                break
+
+            pos = positions[cursor]
+        else:
+            count += 1
+
+    return count
+
+
+def get_reachable_positions(previous_positions, positions, slop=0):
+    """
+    Returns the positions of a term that are within slop words after one of the positions of the previous term.
+
+    :param previous_positions: sorted reachable positions of the previous term
+    :param positions: sorted positions of the term
+    :return: sorted reachable positions of the term
+    """
+    # Positions in the range of all the previous positions
+    start = bisect.bisect_right(positions, previous_positions[0])
+    end = bisect.bisect_right(positions, previous_positions[-1] + 1 + slop, start)
+
+    if len(previous_positions) == 1:
+        return positions[start:end]
+
+    reachable = []
+
+    i = 0
+    for pos in positions[start:end]:
+        # Closest previous position before the position
+        while i + 1 < len(previous_positions) and previous_positions[i + 1] < pos:
+            i += 1
+
+        if pos <= previous_positions[i] + 1 + slop:
+            reachable.append(pos)
+
+    return reachable
+
+
+def phrase_intersect(postings_lists, slop=0):
+    """
+    Returns the documents that contain the phrase, with the log of the phrase frequency.
+
+    The documents are intersected starting from the term with the shortest postings list,
+    and the documents of the other terms are looked up by galloping, so that only the
+    positions of documents that contain all the terms are compared.
+
+    Params:
+        postings_lists: Positional index of each term of the phrase [ [ (docID, positions, log-tf), ... ], ... ]
+        slop: Number of other words allowed between consecutive terms
+
+    Returns:
+        postings: [ (docID, log-tf) ]
+    """
+    if not postings_lists:
+        return []
+
+    num_of_terms = len(postings_lists)
+    order = sorted(range(num_of_terms), key=lambda i: len(postings_lists[i]))
+
+    # Documents with all the terms so far [ (docID, [ positions of each term ]), ... ]
+    rarest = order[0]
+    candidates = []
+    for docID, positions, _ in postings_lists[rarest]:
+        positions_lists = [None] * num_of_terms
+        positions_lists[rarest] = positions
+        candidates.append((docID, positions_lists))
+
+    for i in order[1:]:
+        postings = postings_lists[i]
+
+        matches = []
+        j = 0
+        for docID, positions_lists in candidates:
+            j = intersect.gallop(postings, docID, j)
+            if j == len(postings):
+                break
+
+            if postings[j][0] == docID:
+                positions_lists[i] = postings[j][1]
+                matches.append((docID, positions_lists))
+
+        candidates = matches
+
+    phrase_postings = []
+    for docID, positions_lists in candidates:
+        phrase_term_freq = count_phrase(positions_lists, slop)
+
+        # Add document to postings if phrasal query occurs in it
+        if phrase_term_freq > 0:
+            phrase_postings.append((docID, 1 + util.log10(phrase_term_freq)))
+
+    return phrase_postings
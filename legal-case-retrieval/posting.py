@@ -1,36 +1,69 @@
+from array import array
+from itertools import accumulate
+
+
 class Posting(object):
+    """
+    Positional postings list of a term while indexing, in growable arrays of integers instead
+    of a dict and a list for every document, so that a posting costs a few bytes per document
+    and per position.
+    """
     def __init__(self):
-        self.docs = {}  # { docId: { "positions": [] } }  Term freq is computed from length of positions
+        self.doc_ids = array('I')  # docIDs in order of addition
+        self.term_freqs = array('I')  # Number of positions of each added docID
+        self.positions = array('I')  # Positions of the added docIDs, concatenated in order of addition
+
+
+    def add_positions_to_doc(self, docId, positions):
+        """
+        Adds the positions of the term in the document, in increasing order.
+        """
+        self.doc_ids.append(int(docId))
+        self.term_freqs.append(len(positions))
+        self.positions.extend(positions)
 
 
-    def add_doc_to_postings(self, docId):
-        if docId not in self.docs:
-            self.docs[docId] = {}
-            self.docs[docId]["positions"] = []
+    def get_sorted_docs(self):
+        """
+        Returns the postings as [ (docID, [position, ...]), ... ] sorted by integer docID,
+        with sorted positions. Positions of a document added more than once are merged.
+        """
+        doc_ids = self.doc_ids
+        starts = [0] + list(accumulate(self.term_freqs))
+
+        docs = []
+        for idx in sorted(range(len(doc_ids)), key=doc_ids.__getitem__):
+            positions = self.positions[starts[idx]:starts[idx + 1]].tolist()
 
+            if docs and docs[-1][0] == doc_ids[idx]:
+                docs[-1] = (doc_ids[idx], sorted(docs[-1][1] + positions))
+            else:
+                docs.append((doc_ids[idx], positions))
 
-    def add_pos_to_doc(self, docId, pos):
-        self.docs[docId]["positions"].append(pos)
+        return docs
 
 
     def save_postings(self, posting_file):
         """
         Saves postings as "docID1#pos1,pos2,pos3 docID2#pos1,pos2 "
-        
-        Example: postings = { 
-            222: { 'positions': [4,5,6,7,8] }, 
-            111: { 'positions': [1,2,3] }, 
-        }
+
+        Example: postings of docID 222 at positions [4,5,6,7,8] and docID 111 at [1,2,3]
         Output: 111#1,2,3 222#4,5,6,7,8
         """
-        postings = self.docs
-
-        docIDs = sorted(postings.keys())
-
         postings_list_str = ' '.join([
-                str(docID) + "#" + 
-                ','.join([str(pos) for pos in postings[docID]["positions"]]) 
-                    for docID in docIDs]) + ' '
+                str(docID) + "#" +
+                ','.join([str(pos) for pos in positions])
+                    for docID, positions in self.get_sorted_docs()]) + ' '
 
         posting_file.write(postings_list_str)
 
+
+    def load_postings(self, postings_str):
+        """
+        Adds the postings saved as "docID1#pos1,pos2,pos3 docID2#pos1,pos2 " to this posting.
+        Positions of a document already in the posting are merged with it.
+        """
+        for posting in postings_str.split():
+            [docId, positions] = posting.split('#')
+
+            self.add_positions_to_doc(docId, [int(pos) for pos in positions.split(',')])
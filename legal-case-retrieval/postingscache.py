@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+
+# Estimated memory used by a decoded postings list, to bound the size of the cache
+BYTES_PER_LIST = 64  # List of the postings
+BYTES_PER_POSTING = 120  # Tuple of (docID, weight) and its pointer in the list
+BYTES_PER_POSITION = 36  # Position in the positions list of a posting
+
+class PostingsCache(object):
+    """
+    Least recently used cache of decoded postings lists, bounded by the estimated bytes
+    of the lists instead of their number, so that a few long postings lists of common
+    terms do not push the process over the budget.
+
+    Can be shared by the threads of the search server. Cached lists are shared by all
+    the queries that read them and must not be modified.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size  # Bytes of postings lists to keep in memory. 0 to disable the cache
+        self.size = 0  # Estimated bytes of the postings lists in the cache
+        self.entries = OrderedDict()  # { key: (postings_list, size) } from least to most recently used
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the cached postings list of the key, or None if it is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, postings_list, size):
+        """
+        Caches the postings list, evicting the least recently used lists until it fits.
+        Lists larger than the whole cache are not cached.
+
+        :param size: estimated bytes of the postings list
+        """
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            while self.size + size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+            self.entries[key] = (postings_list, size)
+            self.size += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """
+        Returns the counters of the cache as { hits, misses, evictions, entries, size, maxSize }
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size,
+                "maxSize": self.max_size,
+            }
+
+
+def get_postings_size(postings_list):
+    """
+    Returns the estimated bytes of a decoded postings list [ (docID, weight), ... ]
+    """
+    return BYTES_PER_LIST + BYTES_PER_POSTING * len(postings_list)
+
+
+def get_positional_postings_size(postings_list):
+    """
+    Returns the estimated bytes of a decoded postings list [ (docID, [position, ...], log-tf), ... ]
+    """
+    num_of_positions = sum(len(positions) for _, positions, _ in postings_list)
+
+    return BYTES_PER_LIST + (BYTES_PER_POSTING + BYTES_PER_LIST) * len(postings_list) + BYTES_PER_POSITION * num_of_positions
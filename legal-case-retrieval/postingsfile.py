@@ -1,28 +1,189 @@
 import pickle
+import heapq
+import mmap
+import os
 from collections import defaultdict
+from functools import partial
+from itertools import groupby
 
 import util
+import codec
+import biword
+import zones
+import postingscache
+from posting import Posting
+from postingscache import PostingsCache
 
 class PostingsFile(object):
     """
     Getter and Setter functions related to the postings and posting list
     Also used to store on disk and access it using pickle and until functions
+
+    Postings are saved in the binary format of codec.py. Postings files saved as text
+    by older versions (without the binary header) can still be read.
+
+    With use_mmap, the file is memory-mapped once per process and postings lists are read
+    as zero-copy slices of the mapping, instead of opening the file for every postings list.
+
+    With a cache_size, the decoded postings lists are kept in LRU caches of cache_size bytes
+    each, one for the positional postings lists and one for the other forms, so that the
+    postings lists of terms used by several queries (or by several methods of a query) 
+    are only read and decoded once.
+
+    The postings lists without positions can be read for the documents of a filter only (a Bitmap,
+    see `facets.py`): the other documents are dropped as the docs stream is decoded, before their
+    weights are computed or read. Filtered postings lists are not cached.
     """
-    def __init__(self, file_name):
+    def __init__(self, file_name, use_mmap=False, cache_size=0):
         self.disk_file = file_name
+        self.block_files = []  # Blocks of postings flushed to disk while indexing
+        self.is_binary = None  # Whether the file on disk is in the binary format. Read from header when needed
+        self.use_mmap = use_mmap
+        self.mmap = None  # Memory-mapped postings file
+        self.mmap_view = None  # memoryview of the mapping, sliced without copying
+        self.mmap_pid = None  # Process that created the mapping
+        self.postings_cache = PostingsCache(cache_size)  # { (form, offset): [ (docID, weight), ... ] }
+        self.positions_cache = PostingsCache(cache_size)  # { offset: [ (docID, positions, log-tf), ... ] }
+
+    def save(self, dictionary, forward_index=None):
+        """
+        Saves the postings lists of all terms, in sorted order of terms as when the blocks are merged.
+        If a ForwardIndex is given, the terms are also added to the vectors of their documents.
+        """
+        if self.block_files:
+            # Flush the remaining postings and merge all the blocks
+            self.save_block(dictionary)
+            self.merge_blocks(dictionary, forward_index)
+            return
+
+        with open(self.disk_file, 'wb') as postings_file:
+            postings_file.write(codec.HEADER)
 
-    def save(self, dictionary):
-        with open(self.disk_file, 'wt') as postings_file:
-            for token in dictionary.get_terms():
-                offset = postings_file.tell()
+            for token in dictionary.get_terms_in_memory():
                 postings_list = dictionary.format_dict_for_saving_postings(token)
 
-                postings_list.save_postings(postings_file)
-                
-                size = (postings_file.tell() - offset) - 1 # Don't read whitespace at end
-                dictionary.update_offset_and_size(token, offset, size)
+                self.save_term_postings(postings_file, token, postings_list, dictionary, forward_index)
 
         postings_file.close()
+        self.is_binary = True
+
+    def save_term_postings(self, postings_file, token, postings_list, dictionary, forward_index=None):
+        """
+        Saves the postings list of the term at the end of the opened postings file, and
+        stores the offsets and sizes of its docs and positions streams in the dictionary.
+        If the dictionary uses precomputed weights, they are saved after the docs stream.
+        """
+        docs = postings_list.get_sorted_docs()
+        docs_bytes, positions_bytes = codec.encode_postings(docs)
+
+        # Biwords and terms of zones are not terms of the document vectors
+        if forward_index is not None and not biword.is_biword(token) and not zones.is_zone_term(token):
+            forward_index.add_postings(token, docs)
+
+        offset = postings_file.tell()
+        postings_file.write(docs_bytes)
+
+        if dictionary.has_precomputed_weights():
+            log_tfs, normalised_log_tfs = self.compute_weights(docs, dictionary, token)
+            postings_file.write(codec.encode_floats(log_tfs))
+            postings_file.write(codec.encode_floats(normalised_log_tfs))
+
+        positions_offset = postings_file.tell()
+        postings_file.write(positions_bytes)
+
+        dictionary.update_offset_and_size(token, offset, len(docs_bytes))
+        dictionary.update_positions_offset_and_size(token, positions_offset, len(positions_bytes))
+
+    def compute_weights(self, docs, dictionary, token=None):
+        """
+        Computes the court-weighted log-tf of the documents in the postings list, and the
+        log-tf normalised by the length of the document, or of its zone for a term of a zone.
+
+        Params:
+            - docs: [ (docID, [position, ...]), ... ]
+            - dictionary: Dictionary with the court weights and lengths of all documents
+            - token: term of the postings list
+
+        Returns:
+            - log_tfs, normalised_log_tfs: [ float, ... ] in the order of docs
+        """
+        get_doc_length = dictionary.get_normalised_doc_length
+        if token is not None and zones.is_zone_term(token):
+            get_doc_length = partial(dictionary.get_zone_doc_length, token.split(zones.SEPARATOR, 1)[0])
+
+        log_tfs = []
+        normalised_log_tfs = []
+        for docID, positions in docs:
+            docId = str(docID)
+
+            log_tf = 1 + util.log10(len(positions) * dictionary.get_court_weight(docId))
+
+            log_tfs.append(log_tf)
+            normalised_log_tfs.append(log_tf / get_doc_length(docId))
+
+        return log_tfs, normalised_log_tfs
+
+    def save_block(self, dictionary):
+        """
+        Saves the postings in memory to a new block on disk, sorted by term, and removes
+        them from memory (single-pass in-memory indexing).
+
+        Each line of the block is "term<TAB>docID1#pos1,pos2,pos3 docID2#pos1,pos2 "
+        """
+        block_file = self.disk_file + '.block' + str(len(self.block_files))
+
+        with open(block_file, 'wt') as block:
+            for token in dictionary.get_terms_in_memory():
+                block.write(token + '\t')
+                dictionary.format_dict_for_saving_postings(token).save_postings(block)
+                block.write('\n')
+
+        block.close()
+
+        dictionary.clear_postings()
+        self.block_files.append(block_file)
+
+    def read_block(self, block_idx):
+        """
+        Reads the lines of a block one at a time.
+
+        Returns:
+            - Generator of (term, block_idx, postings_str) in sorted order of terms
+        """
+        with open(self.block_files[block_idx], 'rt') as block:
+            for line in block:
+                [term, postings_str] = line.rstrip('\n').split('\t')
+                yield term, block_idx, postings_str
+
+        block.close()
+
+    def merge_blocks(self, dictionary, forward_index=None):
+        """
+        Performs a k-way merge of the blocks into the postings file, and deletes the blocks.
+        Only the postings of one term are in memory at a time. Terms removed from the
+        dictionary after their postings were flushed (rare biwords) are skipped.
+        """
+        blocks = [self.read_block(block_idx) for block_idx in range(len(self.block_files))]
+
+        with open(self.disk_file, 'wb') as postings_file:
+            postings_file.write(codec.HEADER)
+
+            for token, block_lines in groupby(heapq.merge(*blocks), key=lambda line: line[0]):
+                if not dictionary.has_indexed_term(token):
+                    continue
+
+                postings_list = Posting()
+                for _, _, postings_str in block_lines:
+                    postings_list.load_postings(postings_str)
+
+                self.save_term_postings(postings_file, token, postings_list, dictionary, forward_index)
+
+        postings_file.close()
+        self.is_binary = True
+
+        for block_file in self.block_files:
+            os.remove(block_file)
+        self.block_files = []
 
     def parse_postings_with_positions(self, postings_str, dictionary):
         """
@@ -54,24 +215,158 @@ class PostingsFile(object):
         return postings_list
     
 
-    def get_posting_list_with_positions(self, offset, size, dictionary):
+    def parse_binary_postings_with_positions(self, postings_bytes, positions_bytes, dictionary):
+        """
+        Returns postings list of the form [ (docID, positions, log-tf), ... ] by
+        decoding the docs and positions streams of the binary postings list. Document 
+        term frequencies are weighted by the importance of the corresponding court.
+        """
+        postings_list = []
+        for docID, positions in codec.decode_postings_with_positions(postings_bytes, positions_bytes):
+            tf_weight = dictionary.get_court_weight(str(docID))
+
+            tf = len(positions) * tf_weight
+            log_tf = 1 + util.log10(tf)
+
+            postings_list.append((docID, positions, log_tf))
+
+        return postings_list
+
+
+    def read_header(self):
+        """
+        Checks whether the file on disk is in the binary format, and if so, that it is
+        of the supported version.
+        """
+        with open(self.disk_file, 'rb') as postings_file:
+            header = postings_file.read(len(codec.HEADER))
+
+        postings_file.close()
+
+        self.is_binary = header.startswith(codec.MAGIC)
+        if self.is_binary and header != codec.HEADER:
+            raise ValueError("Unsupported postings file format version " + str(header[-1]) + ". Re-index the collection.")
+
+
+    def open_mmap(self):
+        """
+        Memory-maps the postings file for this process.
+        """
+        with open(self.disk_file, 'rb') as postings_file:
+            self.mmap = mmap.mmap(postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        postings_file.close()
+
+        self.mmap_view = memoryview(self.mmap)
+        self.mmap_pid = os.getpid()
+
+
+    def close(self):
+        """
+        Unmaps the postings file, if it is memory-mapped.
+        Slices of the postings lists must no longer be in use.
+        """
+        if self.mmap is not None:
+            self.mmap_view.release()
+            self.mmap.close()
+
+        self.mmap = None
+        self.mmap_view = None
+        self.mmap_pid = None
+
+
+    def read_postings(self, offset, size):
+        """
+        Reads the postings list at the offset in file.
+
+        :return: bytes-like object for the binary format, str for the older text format
+        """
+        if self.is_binary is None:
+            self.read_header()
+
+        if self.use_mmap:
+            if self.mmap_pid != os.getpid():
+                self.open_mmap()
+
+            postings = self.mmap_view[offset:offset + size]
+            return postings if self.is_binary else str(postings, 'utf8')
+
+        if not self.is_binary:
+            with open(self.disk_file, 'rt') as postings_file:
+                postings_file.seek(offset)
+                return postings_file.read(size)
+
+        with open(self.disk_file, 'rb') as postings_file:
+            postings_file.seek(offset)
+            return postings_file.read(size)
+
+
+    def get_cached(self, cache, key, read_posting_list, get_size):
+        """
+        Returns the postings list from the cache, or reads it and adds it to the cache.
+
+        :param read_posting_list: function to read and decode the postings list
+        :param get_size: function to estimate the bytes of the decoded postings list
+        """
+        if cache.max_size == 0:
+            return read_posting_list()
+
+        postings_list = cache.get(key)
+
+        if postings_list is None:
+            postings_list = read_posting_list()
+            cache.put(key, postings_list, get_size(postings_list))
+
+        return postings_list
+
+
+    def get_filtered(self, cache, key, doc_filter, read_posting_list):
+        """
+        Returns the postings of the documents of the doc_filter, filtered from the postings list if it is
+        cached, or else read for these documents only.
+
+        :param read_posting_list: function to read and decode the postings list of the documents of the filter
+        """
+        if cache.max_size > 0:
+            postings_list = cache.get(key)
+            if postings_list is not None:
+                return doc_filter.filter_postings(postings_list)
+
+        return read_posting_list()
+
+
+    def get_cache_stats(self):
+        """
+        Returns the counters of the caches as { postings: stats, positions: stats }
+        """
+        return {"postings": self.postings_cache.get_stats(), "positions": self.positions_cache.get_stats()}
+
+
+    def get_posting_list_with_positions(self, offset, size, dictionary, positions_offset=-1, positions_size=-1):
         """
         Gets posting list for a given offset in file
         :param offset: the offset to seek to in file
+        :param positions_offset: the offset of the positions stream in the binary format
         """
-        with open(self.disk_file, 'rt') as postings_file:
-            postings_file.seek(offset)
-            postings_str = postings_file.read(size)
+        return self.get_cached(self.positions_cache, offset,
+            lambda: self.read_posting_list_with_positions(offset, size, dictionary, positions_offset, positions_size),
+            postingscache.get_positional_postings_size)
+
+
+    def read_posting_list_with_positions(self, offset, size, dictionary, positions_offset, positions_size):
+        postings = self.read_postings(offset, size)
 
-            postings_list = self.parse_postings_with_positions(postings_str, dictionary)
+        if self.is_binary:
+            positions = self.read_postings(positions_offset, positions_size)
+            return self.parse_binary_postings_with_positions(postings, positions, dictionary)
 
-            return postings_list
+        return self.parse_postings_with_positions(postings, dictionary)
 
 
 
-    def parse_postings(self, postings_str, dictionary):
+    def parse_postings(self, postings_str, dictionary, doc_filter=None):
         """
-        Returns [ (docID, log-tf), ... ]
+        Returns [ (docID, log-tf), ... ] of the documents of the doc_filter, or of all documents if it is None
 
         Example:
             Input: 111#1,2,3 222#4,5,6,7,8
@@ -86,9 +381,12 @@ class PostingsFile(object):
         for posting in postings:
             [docID, positions] = posting.split('#')
 
+            if doc_filter is not None and int(docID) not in doc_filter:
+                continue
+
             tf_weight = dictionary.get_court_weight(docID)
 
-            tf = len(positions) * tf_weight
+            tf = len(positions.split(',')) * tf_weight
             log_tf = 1 + util.log10(tf)
 
             postings_list.append((int(docID), log_tf))
@@ -96,16 +394,127 @@ class PostingsFile(object):
         return postings_list
 
 
-    def get_posting_list(self, offset, size, dictionary):
+    def parse_binary_postings(self, postings_bytes, dictionary, doc_filter=None):
+        """
+        Returns [ (docID, log-tf), ... ] by decoding the binary postings list, for the documents of
+        the doc_filter, or all documents if it is None.
+        """
+        postings_list = []
+        for docID, tf in codec.decode_postings(postings_bytes, doc_filter):
+            tf_weight = dictionary.get_court_weight(str(docID))
+
+            log_tf = 1 + util.log10(tf * tf_weight)
+
+            postings_list.append((docID, log_tf))
+
+        return postings_list
+
+
+    def read_weights(self, offset, size, num_of_docs, is_normalised):
+        """
+        Reads the precomputed weights saved after the docs stream at the offset in file.
+
+        :param is_normalised: Whether to read the log-tf normalised by document length, instead of the log-tf
+        :return: array of floats
+        """
+        weights_offset = offset + size + (4 * num_of_docs if is_normalised else 0)
+
+        return codec.decode_floats(self.read_postings(weights_offset, 4 * num_of_docs))
+
+
+    def read_precomputed_posting_list(self, offset, size, is_normalised, doc_filter=None):
+        """
+        Returns [ (docID, weight), ... ] of the precomputed weights of the documents of the doc_filter,
+        or of all documents if it is None.
+
+        :param is_normalised: Whether to read the log-tf normalised by document length, instead of the log-tf
+        """
+        docIDs = [docID for docID, _ in codec.decode_postings(self.read_postings(offset, size))]
+        weights = self.read_weights(offset, size, len(docIDs), is_normalised)
+
+        if doc_filter is None:
+            return list(zip(docIDs, weights))
+
+        return [(docID, weights[i]) for docID, i in doc_filter.filter_postings(list(zip(docIDs, range(len(docIDs)))))]
+
+
+    def get_posting_list(self, offset, size, dictionary, doc_filter=None):
         """
         Gets posting list for a given offset in file
         :param offset: the offset to seek to in file
+        :param doc_filter: Bitmap of the documents to read. None to read all documents
         """
-        with open(self.disk_file, 'rt') as postings_file:
-            postings_file.seek(offset)
-            postings_str = postings_file.read(size)
+        if doc_filter is not None:
+            return self.get_filtered(self.postings_cache, ("log_tf", offset), doc_filter,
+                lambda: self.read_posting_list(offset, size, dictionary, doc_filter))
+
+        return self.get_cached(self.postings_cache, ("log_tf", offset),
+            lambda: self.read_posting_list(offset, size, dictionary),
+            postingscache.get_postings_size)
+
+
+    def read_posting_list(self, offset, size, dictionary, doc_filter=None):
+        postings = self.read_postings(offset, size)
+
+        if not self.is_binary:
+            return self.parse_postings(postings, dictionary, doc_filter)
+
+        if dictionary.has_precomputed_weights():
+            return self.read_precomputed_posting_list(offset, size, False, doc_filter)
+
+        return self.parse_binary_postings(postings, dictionary, doc_filter)
+
+
+    def get_normalised_posting_list(self, offset, size, dictionary, doc_filter=None):
+        """
+        Gets posting list of the form [ (docID, log-tf / normalised doc length), ... ] 
+        for a given offset in file
+        :param offset: the offset to seek to in file
+        :param doc_filter: Bitmap of the documents to read. None to read all documents
+        """
+        if doc_filter is not None:
+            return self.get_filtered(self.postings_cache, ("normalised", offset), doc_filter,
+                lambda: self.read_normalised_posting_list(offset, size, dictionary, doc_filter))
+
+        return self.get_cached(self.postings_cache, ("normalised", offset),
+            lambda: self.read_normalised_posting_list(offset, size, dictionary),
+            postingscache.get_postings_size)
+
+
+    def read_normalised_posting_list(self, offset, size, dictionary, doc_filter=None):
+        if self.is_binary is None:
+            self.read_header()
+
+        if self.is_binary and dictionary.has_precomputed_weights():
+            return self.read_precomputed_posting_list(offset, size, True, doc_filter)
+
+        return [(docID, log_tf / dictionary.get_normalised_doc_length(str(docID)))
+                    for docID, log_tf in self.get_posting_list(offset, size, dictionary, doc_filter)]
+
+
+    def get_posting_list_with_tf(self, offset, size, doc_filter=None):
+        """
+        Gets posting list of the form [ (docID, raw tf), ... ] for a given offset in file,
+        without any court weights.
+        :param offset: the offset to seek to in file
+        :param doc_filter: Bitmap of the documents to read. None to read all documents
+        """
+        if doc_filter is not None:
+            return self.get_filtered(self.postings_cache, ("tf", offset), doc_filter,
+                lambda: self.read_posting_list_with_tf(offset, size, doc_filter))
+
+        return self.get_cached(self.postings_cache, ("tf", offset),
+            lambda: self.read_posting_list_with_tf(offset, size),
+            postingscache.get_postings_size)
+
+
+    def read_posting_list_with_tf(self, offset, size, doc_filter=None):
+        postings = self.read_postings(offset, size)
 
-            postings_list = self.parse_postings(postings_str, dictionary)
+        if self.is_binary:
+            return codec.decode_postings(postings, doc_filter)
 
-            return postings_list
+        postings_list = [(int(docID), len(positions.split(','))) 
+                            for docID, positions in (posting.split('#') for posting in postings.split(' '))]
 
+        return postings_list if doc_filter is None else doc_filter.filter_postings(postings_list)
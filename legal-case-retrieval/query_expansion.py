@@ -1,92 +1,367 @@
 from collections import defaultdict
+from functools import lru_cache
 from spellchecker import SpellChecker
 
 from nltk.corpus import wordnet
 from nltk.wsd import lesk
 
+import getopt
 import math
+import os
+import pickle
+import sys
+import threading
 
 import util
+from dictionary import Dictionary
 
-def query_expansion_thesaurus(query_str):
+# Weights of the expanded query terms
+ORIGINAL_TERM_WEIGHT = 1
+SYNONYM_TERM_WEIGHT = 0.5
+MISSPELLING_TERM_WEIGHT = 0.6
+CONTEXT_TERM_WEIGHT = 0.7
+
+FRACTION_SYNONYMS = 0.35  # Fraction of the lemmas of each synset of a term added as synonyms
+NUM_CORRECTIONS = 3  # Corrections added for a known word
+
+# Lookups memoized per process. Words of queries follow Zipf's law, so most lookups are repeated
+WORD_CACHE_SIZE = 50000  # Synsets and spelling corrections of words
+CONTEXT_CACHE_SIZE = 10000  # Context synonyms of (query, word)
+
+SPELL_CHECKER = None  # Loaded once per process, as it decompresses and parses the word frequency list
+SPELL_CHECKER_LOCK = threading.Lock()
+
+
+def get_spell_checker():
+    """
+    Returns the spell checker of this process, loading it on first use.
+    """
+    global SPELL_CHECKER
+
+    with SPELL_CHECKER_LOCK:
+        if SPELL_CHECKER is None:
+            SPELL_CHECKER = SpellChecker()
+
+    return SPELL_CHECKER
+
+
+def load_resources():
+    """
+    Loads wordnet and the spell checker up front, so that they are loaded only once by
+    long-running processes, before any query is evaluated.
+    """
+    get_spell_checker()
+    wordnet.synsets('law')  # wordnet is loaded lazily on first use
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def get_synsets(term):
+    """
+    Returns the synsets of the word in wordnet.
+    """
+    return wordnet.synsets(term)
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def get_synonyms(term):
+    """
+    Returns the synonyms of the word: the words of the first FRACTION_SYNONYMS of the lemmas of each of its synsets.
+
+    :return: ( synonym, ... )
+    """
+    synonyms = []
+    for syn in get_synsets(term):
+        num_synonyms = math.ceil(len(syn.lemmas()) * FRACTION_SYNONYMS)
+
+        for l in syn.lemmas()[:num_synonyms]:
+            synonyms.extend(l.name().split("_"))
+
+    return tuple(synonyms)
+
+
+@lru_cache(maxsize=CONTEXT_CACHE_SIZE)
+def get_context_synonyms(context, term):
+    """
+    Returns the words of the lemmas of the sense of the word in the context of the query, chosen by the Lesk algorithm.
+
+    :return: ( synonym, ... )
+    """
+    context_syn = lesk(context, term, synsets=get_synsets(term))
+    if context_syn is None:
+        return ()
+
+    return tuple(t for l in context_syn.lemmas() for t in l.name().split("_"))
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def get_corrections(term):
+    """
+    Returns the spelling corrections of the word, with their weights. The most likely correct word if the word
+    is unknown, which is added without any weight of its own, and otherwise the NUM_CORRECTIONS most frequent
+    known words within an edit distance of 2.
+
+    :return: ( (correction, weight), ... )
+    """
+    spell = get_spell_checker()
+
+    if spell.unknown([term]):
+        return ((spell.correction(term), 0.0),)
+
+    corrected_terms = spell.known(spell.edit_distance_2(term))
+
+    probs = sorted(((t, spell.word_probability(t)) for t in corrected_terms), key=lambda x: x[1], reverse=True)
+
+    return tuple((t, MISSPELLING_TERM_WEIGHT) for t, _ in probs[:NUM_CORRECTIONS])
+
+
+def get_word_expansions(term):
+    """
+    Returns the expansions of the word that do not depend on the rest of the query:
+    its synonyms and its spelling corrections.
+
+    :return: [ (term, weight), ... ]
+    """
+    return [(t, SYNONYM_TERM_WEIGHT) for t in get_synonyms(term)] + list(get_corrections(term))
+
+
+def get_synonyms_file_name(dict_file):
+    """
+    Returns the name of the synonym table file saved next to the dictionary file.
+    """
+    return dict_file + '.syn'
+
+
+def has_term_in_index(dictionary, terms):
+    """
+    Returns True if any of the normalised terms of a word is in the index.
+    """
+    return any(dictionary.get_df(term) != -1 for term in terms)
+
+
+def get_deletes(word, max_distance=2):
     """
+    Returns the strings obtained by deleting up to max_distance characters from the word, including the word.
+    """
+    deletes = {word}
+    edges = {word}
+    for _ in range(max_distance):
+        edges = set(edge[:i] + edge[i + 1:] for edge in edges for i in range(len(edge)))
+        deletes.update(edges)
+
+    return deletes
+
+
+class IndexCorrections(object):
+    """
+    Spelling corrections of words restricted to the words of the spell checker with a term in the index,
+    as `get_corrections` would return them if the spell checker only knew these words.
+
+    Instead of generating every string within an edit distance of 2 of a word, the candidate corrections
+    are looked up by the strings obtained by deleting up to 2 characters of the word: two words within
+    2 edits of each other have such a string in common (symmetric delete). The candidates are then
+    checked with the edits of the spell checker.
+    """
+    def __init__(self, words):
+        self.deletes = defaultdict(list)  # { word with up to 2 characters deleted: [ word, ... ] }
+        for word in words:
+            for delete in get_deletes(word):
+                self.deletes[delete].append(word)
+
+    def get_corrections_by_distance(self, term):
+        """
+        Returns the words within an edit distance of 1 of the term, and those within an edit distance of 2.
+
+        :return: set of words within 1 edit, set of words within 2 edits
+        """
+        spell = get_spell_checker()
+        edits = spell.edit_distance_1(term)
+
+        candidates = set(word for delete in get_deletes(term) for word in self.deletes.get(delete, ()))
+
+        # Edits of the spell checker are symmetric, so a word is within 2 edits if it has an edit in common with the term
+        within_1 = set(word for word in candidates if word in edits)
+        within_2 = within_1 | set(word for word in candidates - within_1 if not edits.isdisjoint(spell.edit_distance_1(word)))
+
+        return within_1, within_2
+
+    def get_corrections(self, term):
+        """
+        Returns the spelling corrections of the word in the index, with their weights, like `get_corrections`.
+
+        :return: ( (correction, weight), ... )
+        """
+        spell = get_spell_checker()
+        within_1, within_2 = self.get_corrections_by_distance(term)
+
+        if spell.unknown([term]):
+            candidates = within_1 or within_2 or {term}
+            return ((max(sorted(candidates), key=spell.word_probability), 0.0),)
+
+        probs = sorted(((t, spell.word_probability(t)) for t in within_2), key=lambda x: x[1], reverse=True)
+
+        return tuple((t, MISSPELLING_TERM_WEIGHT) for t, _ in probs[:NUM_CORRECTIONS])
+
+
+def build_synonym_table(dictionary, words=None):
+    """
+    Builds the expansions of words offline, restricted to the expansions with a term in the index, so that
+    expanding these words at query time does not look up wordnet or the spell checker.
+    The spelling corrections are only searched among the words with a term in the index (see `IndexCorrections`).
+
     Params:
-        - query_str: Original input query string
+        - dictionary: Dictionary object of the index
+        - words: words to expand. None for the single words of wordnet with a term in the index
 
     Returns:
-        - new_query: List of expanded query terms and weights [ (term, weight), ...]
+        - synonym_table: { lowercase word: ( (term, weight), ... ) }
     """
+    def in_index(word):
+        return has_term_in_index(dictionary, util.preprocess_content(word))
 
-    query_str = query_str.replace('AND', '').replace('"', '')
-    query_terms = set([query_term.strip() for query_term in query_str.split(' ')])
+    if words is None:
+        lemma_names = [word for word in wordnet.all_lemma_names() if word.isalpha()]
+        words = [word for word, terms in zip(lemma_names, util.preprocess_contents(lemma_names))
+                    if has_term_in_index(dictionary, terms)]
 
-    term_weights = defaultdict(lambda: 0.0)
-    new_query_terms = list(query_terms)
+    spell_words = list(get_spell_checker().word_frequency.keys())
+    corrections = IndexCorrections(word for word, terms in zip(spell_words, util.preprocess_contents(spell_words))
+                                    if has_term_in_index(dictionary, terms))
 
-    ORIGINAL_TERM_WEIGHT = 1
-    SYNONYM_TERM_WEIGHT = 0.5
-    MISSPELLING_TERM_WEIGHT = 0.6
-    CONTEXT_TERM_WEIGHT = 0.7
+    synonym_table = {}
+    for word in words:
+        word = word.lower()
 
+        synonyms = [(t, SYNONYM_TERM_WEIGHT) for t in get_synonyms(word) if in_index(t)]
+        synonym_table[word] = tuple(synonyms) + tuple((t, weight) for t, weight in corrections.get_corrections(word) if in_index(t))
 
-    for term in query_terms:
-        term_weights[term] = ORIGINAL_TERM_WEIGHT
+    return synonym_table
 
 
-    # Add synonyms to query
-    FRACTION_SYNONYMS = 0.35
+def save_synonym_table(synonym_table, synonyms_file):
+    with open(synonyms_file, 'wb') as f:
+        pickle.dump(synonym_table, f)
 
-    synonyms = []
-    for term in query_terms:
-        for syn in wordnet.synsets(term):
-            num_synonyms = math.ceil(len(syn.lemmas()) * FRACTION_SYNONYMS)
+    f.close()
+
+
+def load_synonym_table(synonyms_file):
+    """
+    Loads the synonym table saved next to the dictionary. Empty if it was not built.
+    """
+    if not os.path.exists(synonyms_file):
+        return {}
 
-            for l in syn.lemmas()[:num_synonyms]:
-                for t in l.name().split("_"):
-                    synonyms.append(t)
-                    term_weights[t] = max(SYNONYM_TERM_WEIGHT, term_weights[t])
+    with open(synonyms_file, 'rb') as f:
+        synonym_table = pickle.load(f)
 
-        # Use original query context to find suitable synonyms
-        context_syn = lesk(query_str, term)
-        if context_syn is not None:
-            for l in context_syn.lemmas():
-                for t in l.name().split("_"):
-                    synonyms.append(t)
-                    term_weights[t] = max(CONTEXT_TERM_WEIGHT, term_weights[t])
+    f.close()
 
-    new_query_terms.extend(synonyms)
+    return synonym_table
 
 
-    # Add spelling corrections
-    spell = SpellChecker()
+class QueryExpander(object):
+    """
+    Expands queries with synonyms, synonyms of the sense of the words in the query, and spelling corrections.
+
+    The lookups of wordnet, the Lesk algorithm and the spell checker are memoized per process in LRU caches.
+    With a dictionary, only the expanded terms in the index are emitted. The others have no postings
+    and an idf of 0, so they do not change the scores. With a synonym table built offline, the synonyms
+    and corrections of the words in the table are read from it.
+    """
+    def __init__(self, dictionary=None, synonym_table=None):
+        self.dictionary = dictionary
+        self.synonym_table = synonym_table if synonym_table is not None else {}
+
+    def get_word_expansions(self, term):
+        expansions = self.synonym_table.get(term.lower())
+        if expansions is not None:
+            return expansions
+
+        return get_word_expansions(term)
+
+    def expand(self, query_str):
+        """
+        Params:
+            - query_str: Original input query string
+
+        Returns:
+            - new_query: List of expanded query terms and weights [ (term, weight), ...]
+        """
+        query_str = query_str.replace('AND', '').replace('"', '')
+        query_terms = set([query_term.strip() for query_term in query_str.split(' ')])
+
+        term_weights = defaultdict(lambda: 0.0)
+        new_query_terms = list(query_terms)
+
+        for term in query_terms:
+            term_weights[term] = ORIGINAL_TERM_WEIGHT
+
+        # Add synonyms and spelling corrections to query
+        for term in query_terms:
+            for t, weight in self.get_word_expansions(term):
+                new_query_terms.append(t)
+                term_weights[t] = max(weight, term_weights[t])
+
+            # Use original query context to find suitable synonyms
+            for t in get_context_synonyms(query_str, term):
+                new_query_terms.append(t)
+                term_weights[t] = max(CONTEXT_TERM_WEIGHT, term_weights[t])
+
+        # Preprocess terms and assign weights to the expanded query terms
+        new_query = defaultdict(lambda: 0.0)
+        for term in set(new_query_terms):
+            for new_term in set(util.preprocess_content(term)):
+                if self.dictionary is not None and self.dictionary.get_df(new_term) == -1:
+                    continue
+
+                new_query[new_term] = max(term_weights[term], new_query[new_term])
+
+        new_query = [(term, weight) for term, weight in new_query.items()]
+
+        return new_query
+
+
+QUERY_EXPANDER = QueryExpander()  # Without an index, for query_expansion_thesaurus
+
+
+def query_expansion_thesaurus(query_str):
+    """
+    Expands the query with the default QueryExpander, without restricting the terms to an index.
+
+    Params:
+        - query_str: Original input query string
+
+    Returns:
+        - new_query: List of expanded query terms and weights [ (term, weight), ...]
+    """
+    return QUERY_EXPANDER.expand(query_str)
 
-    unknown_misspelled_terms = spell.unknown(query_terms)
-    for term in unknown_misspelled_terms:
-        new_query_terms.append(spell.correction(term))  # Add the most likely correct word
 
-    known_misspelled_terms = spell.known(query_terms)
-    for mispelled_term in known_misspelled_terms:
-        corrected_terms = spell.known(spell.edit_distance_2(mispelled_term))
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file")
 
-        probs = []
-        for term in corrected_terms:
-            probs.append((term, spell.word_probability(term)))
 
-        probs = sorted(probs, key=lambda x: x[1], reverse=True)
-        new_corrected_terms = [term[0] for term in probs]
+if __name__ == "__main__":
+    dictionary_file = None
 
-        new_query_terms.extend(new_corrected_terms[:3])  # Add top 3 corrections
-        for t in new_corrected_terms[:3]:
-            term_weights[t] = max(MISSPELLING_TERM_WEIGHT, term_weights[t])
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
 
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        else:
+            assert False, "unhandled option"
 
-    # Preprocess terms and assign weights to the expanded query terms
-    new_query = defaultdict(lambda: 0.0)
-    for term in set(new_query_terms):
-        for new_term in set(util.preprocess_content(term)):
-            new_query[new_term] = max(term_weights[term], new_query[new_term])
+    if dictionary_file == None:
+        usage()
+        sys.exit(2)
 
-    new_query = [(term, weight) for term, weight in new_query.items()]
+    dictionary = Dictionary(dictionary_file)
+    dictionary.load()
 
-    return new_query
+    save_synonym_table(build_synonym_table(dictionary), get_synonyms_file_name(dictionary_file))
 
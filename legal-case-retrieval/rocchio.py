@@ -1,5 +1,7 @@
 from collections import Counter, defaultdict
 import util
+import biword
+import zones
 from math import sqrt
 
 ALPHA = 0.8
@@ -7,12 +9,19 @@ BETA = 0.3
 GAMMA = 0.1  # Because getting non-relevant docs vector is time consuming
 
 
-def get_document_vector(docId, dictionary, postings_file):
+def get_document_vector(docId, dictionary, postings_file, forward_index=None):
+    if forward_index is not None:
+        return {term: int(round(10**(log_tf - 1)))
+                    for term, log_tf in forward_index.get_doc_vector(docId, dictionary).items()}
 
+    # Without a forward index, every postings list of the collection is read
     doc_vector = dict()
     for term in dictionary.get_terms():
+        if biword.is_biword(term) or zones.is_zone_term(term):
+            continue
+
         offset, size = dictionary.get_offset_and_size_of_term(term)
-        term_postings = dict(postings_file.get_posting_list(offset, size))
+        term_postings = dict(postings_file.get_posting_list(offset, size, dictionary))
 
         if docId in term_postings:
             doc_vector[term] = int(round(10**(term_postings[docId] - 1)))
@@ -20,12 +29,19 @@ def get_document_vector(docId, dictionary, postings_file):
     return doc_vector
     # print(doc_vector)
 
-def get_docs_vectors(docs, dictionary, postings_file):
+def get_docs_vectors(docs, dictionary, postings_file, forward_index=None):
+    if forward_index is not None:
+        return {doc: forward_index.get_doc_vector(doc, dictionary) for doc in docs}
+
+    # Without a forward index, every postings list of the collection is read
     docs_vector_dict = defaultdict(lambda: defaultdict(float))
 
     for term in dictionary.get_terms():
+        if biword.is_biword(term) or zones.is_zone_term(term):
+            continue
+
         offset, size = dictionary.get_offset_and_size_of_term(term)
-        term_postings = dict(postings_file.get_posting_list(offset, size))
+        term_postings = dict(postings_file.get_posting_list(offset, size, dictionary))
 
         for doc in docs:
             if doc in term_postings:
@@ -33,10 +49,10 @@ def get_docs_vectors(docs, dictionary, postings_file):
 
     return docs_vector_dict
 
-def rocchio(query, relevant_docs, dictionary, postings_file, non_relevant_docs=None):
-    relevant_docs_vector = get_docs_vectors(relevant_docs, dictionary, postings_file)
+def rocchio(query, relevant_docs, dictionary, postings_file, non_relevant_docs=None, forward_index=None):
+    relevant_docs_vector = get_docs_vectors(relevant_docs, dictionary, postings_file, forward_index)
     if non_relevant_docs is not None:
-        non_relevant_docs_vector = get_docs_vectors(non_relevant_docs, dictionary, postings_file)
+        non_relevant_docs_vector = get_docs_vectors(non_relevant_docs, dictionary, postings_file, forward_index)
     else:
         non_relevant_docs_vector = {}
 
@@ -4,6 +4,8 @@ import getopt
 import util
 import linecache
 import math
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from collections import defaultdict
 from spellchecker import SpellChecker
 import heapq
@@ -14,14 +16,23 @@ from nltk.wsd import lesk
 
 from dictionary import Dictionary
 from postingsfile import PostingsFile
+import forwardindex
 from extended_boolean import extended_boolean_p_norm_model
 import tf_idf
 import query_expansion
 import boolean
+import phrase
+import segments
+import shards
+import facets
+import zones
+from segmentedindex import SegmentedPostingsFile, SegmentedFacetIndex
 
+CACHE_SIZE = 64 * 1024 * 1024  # Default bytes of each cache of decoded postings lists
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results [-k num-results] [-b] [-r] [-c cache-MB] [-z title-weight]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s port [-k num-results] [-r] [-c cache-MB] [-z title-weight]")
 
 
 def parse_query(query_str):
@@ -29,15 +40,30 @@ def parse_query(query_str):
     Possible Inputs: 
         - Free text: quite phone call
         - Boolean and phrasal queries: "fertility treatment" AND damages AND "medicine" and sick
+        - Phrases with slop: "fiduciary duty care"~2 AND damages
+        - Filter clauses, removed by `facets.parse_filters` before parsing: damages AND court:"SG High Court" AND year:2010-2015
+        - Terms scoped to the title: damages title:negligence, or title:"medical negligence" AND damages
 
     Returns:
         - is_boolean_query: whether it is a boolean query
         - query: list of query tokens [term, ...]
+
+    Raises ValueError if a token of a boolean query has no terms, eg. an operator without an operand, or title:""
     """
     is_boolean_query = "AND" in query_str
 
     if is_boolean_query:
         query = [query_term.strip() for query_term in query_str.split('AND')]
+
+        for query_term in query:
+            zone, words = zones.parse_zone_token(query_term)
+            phrase_str, _ = phrase.parse_phrase(query_term)
+
+            if zone is None:
+                words = query_term if phrase_str is None else phrase_str
+
+            if not util.preprocess_content(words):
+                raise ValueError("Malformed query: " + repr(query_term) + " has no terms to search for")
     else:
         # Free text query
         query = util.preprocess_content(query_str)
@@ -45,68 +71,327 @@ def parse_query(query_str):
     return is_boolean_query, query
 
 
-def run_search(dict_file, postings_file, query_file, results_file):
+def load_index(dict_file, postings_file, use_feedback=False, cache_size=CACHE_SIZE):
     """
-    using the given dictionary file and postings file,
-    perform searching on the given query file and output the results to a file
+    Loads the dictionary and memory-maps the postings file, with caches of cache_size bytes
+    for the decoded postings lists.
+
+    Returns:
+        - dictionary: Dictionary object
+        - postings: PostingsFile object, or the ShardedIndex of an index built in shards
+        - forward_index: ForwardIndex object saved next to the postings file if use_feedback, else None
+
+    An index that was appended to is loaded from its segments, as a single index (see `segments.py`).
+    An index built in shards is loaded by a worker process for each shard (see `shards.py`), and the
+    dictionary is then the statistics of the whole collection.
     """
-    postings = PostingsFile(postings_file)
+    if shards.has_shards(dict_file):
+        sharded_index = shards.ShardedIndex(dict_file, use_feedback, cache_size)
+        forward_index = shards.ShardedForwardIndex(sharded_index) if use_feedback else None
+
+        return sharded_index.dictionary, sharded_index, forward_index
+
+    if segments.has_segments(dict_file):
+        return segments.SegmentManager(dict_file, postings_file).open_index(use_feedback, cache_size)
+
+    postings = PostingsFile(postings_file, use_mmap=True, cache_size=cache_size)
 
     # Load index into memory
     dictionary = Dictionary(dict_file)
     dictionary.load()
 
-    output_f = open(results_file, 'wt')
+    forward_index = None
+    if use_feedback:
+        forward_index = forwardindex.ForwardIndex(forwardindex.get_file_name(postings_file))
 
-    line_num = 1
-    query_str = linecache.getline(query_file, line_num)
+    return dictionary, postings, forward_index
 
-    is_boolean_query, query = parse_query(query_str)
 
-    new_query = query_expansion.query_expansion_thesaurus(query_str)
+def load_query_expander(dict_file, dictionary):
+    """
+    Returns the QueryExpander restricted to the terms of the index, with the synonym table
+    saved next to the dictionary file if it was built (see `query_expansion.py`).
+    """
+    synonym_table = query_expansion.load_synonym_table(query_expansion.get_synonyms_file_name(dict_file))
 
-    if is_boolean_query:
-        results_bool = boolean.eval_boolean_query(query, dictionary, postings)
-        results_ex_bool = boolean.eval_extended_boolean_query(query, dictionary, postings)
-        results_lnc = tf_idf.eval_free_text_query(new_query, dictionary, postings, True)
+    return query_expansion.QueryExpander(dictionary, synonym_table)
+
+
+def load_facet_index(postings_file, postings):
+    """
+    Returns the facets of the index to filter queries by, read when a query is first filtered (see `facets.py`).
+    None for an index built in shards, as each shard filters its documents by its own facets.
+    """
+    if isinstance(postings, shards.ShardedIndex):
+        return None
 
-        results = boolean.rank_results_bool(results_bool, results_ex_bool, results_lnc)
+    if isinstance(postings, SegmentedPostingsFile):
+        return SegmentedFacetIndex(postings.segments)
+
+    return facets.FacetIndex(facets.get_file_name(postings_file))
+
+
+def evaluate_query(is_boolean_query, query, expanded_query, dictionary, postings, k=None, is_rocchio=False,
+                   filters=None, facet_index=None, zone_query=None, title_weight=None):
+    """
+    Ranks the documents of the index for the parsed query and its expansion, or for the Rocchio query.
+    The shards of a sharded index rank their own documents in parallel.
+    With filters, only the documents that match the filters { field: [value, ...] } of the facet index are ranked.
+    Free text queries with terms scoped to a zone [ (zone term, weight), ... ], or with a title weight,
+    are ranked by weighted zone scoring (see `zones.py`).
+
+    Returns:
+        - results: ranked docIDs [ docID, ... ]
+    """
+    if isinstance(postings, shards.ShardedIndex):
+        return postings.evaluate_query(is_boolean_query, query, expanded_query, k, is_rocchio, filters, zone_query, title_weight)
+
+    doc_filter = None
+    if filters:
+        if facet_index is None:
+            raise ValueError("The query has filters but no facet index was loaded")
+
+        doc_filter = facet_index.get_filter(filters)
+
+    if is_boolean_query:
+        return boolean.eval_fused_query(query, expanded_query, dictionary, postings, k, doc_filter)
+    elif zone_query or title_weight is not None:
+        return zones.eval_zone_query(expanded_query, zone_query or [], dictionary, postings, title_weight, k, is_rocchio, doc_filter)
     else:
-        results = tf_idf.eval_free_text_query(new_query, dictionary, postings)
+        return tf_idf.eval_free_text_query(expanded_query, dictionary, postings, is_boolean=False, is_rocchio=is_rocchio,
+                                           doc_filter=doc_filter, k=k)
+
+
+def search_query(query_str, dictionary, postings, k=None, forward_index=None, expander=None, facet_index=None,
+                 title_weight=None):
+    """
+    Evaluates a single query against the loaded index.
+
+    Params:
+        - query_str: query, as a line of the query file
+        - dictionary: Dictionary object
+        - postings: PostingsFile object
+        - k: number of top ranked results to return. None to return all results
+        - forward_index: ForwardIndex object to refine free text queries with pseudo relevance 
+        feedback on the top 3 results. None to not use feedback
+        - expander: QueryExpander object. None to expand the query without restricting it to the index
+        - facet_index: FacetIndex object to filter the results of queries with filter clauses by
+        - title_weight: Weight of the title in the score of free text queries, in which all query terms are
+        also scored in the title. None to only score the terms scoped to the title in the title
+
+    Returns:
+        - results: ranked docIDs [ docID, ... ]
+    """
+    query_str, filters = facets.parse_filters(query_str)
+    is_boolean_query, query = parse_query(query_str)
+
+    if expander is None:
+        expander = query_expansion.QUERY_EXPANDER
+
+    # Boolean queries match the scoped tokens, and free text queries score the scoped terms in their zone
+    unscoped_query_str, zone_query = zones.parse_zone_terms(query_str)
+    new_query = expander.expand(phrase.remove_slop(unscoped_query_str)) if unscoped_query_str else []
 
-        # Rocchio
-        # query_rocchio = rocchio.rocchio(query_str, results[:3], dictionary, postings)
-        # results = tf_idf.eval_free_text_query(query_rocchio, dictionary, postings, is_boolean=False, is_rocchio=True)
+    results = evaluate_query(is_boolean_query, query, new_query, dictionary, postings, k, False, filters, facet_index,
+                             zone_query, title_weight)
+
+    # Queries of only scoped terms have no terms of the document vectors to refine
+    if not is_boolean_query and forward_index is not None and new_query:
+        # Rocchio, with the document vectors of the top results read from the forward index
+        query_rocchio = rocchio.rocchio(new_query, results[:3], dictionary, postings, forward_index=forward_index)
+
+        results = evaluate_query(False, None, query_rocchio, dictionary, postings, k, True, filters, facet_index,
+                                 zone_query, title_weight)
+
+    return results
+
+
+def run_search(dict_file, postings_file, query_file, results_file, k=None, use_feedback=False, cache_size=CACHE_SIZE, title_weight=None):
+    """
+    using the given dictionary file and postings file,
+    perform searching on the given query file and output the results to a file.
+    If k is given, only the top k results are written
+    """
+    dictionary, postings, forward_index = load_index(dict_file, postings_file, use_feedback, cache_size)
+    expander = load_query_expander(dict_file, dictionary)
+    facet_index = load_facet_index(postings_file, postings)
+
+    output_f = open(results_file, 'wt')
+
+    line_num = 1
+    query_str = linecache.getline(query_file, line_num)
+
+    results = search_query(query_str, dictionary, postings, k, forward_index, expander, facet_index, title_weight)
 
     # Write results to file
     write_data = util.format_results(results)
     output_f.write(write_data)
 
     output_f.close()
+    postings.close()
+    if forward_index is not None:
+        forward_index.close()
 
 
-dictionary_file = postings_file = query_file = file_of_output = None
+def run_batch_search(dict_file, postings_file, query_file, results_file, k=None, use_feedback=False, cache_size=CACHE_SIZE, title_weight=None):
+    """
+    Performs searching on every line of the query file in a single process, and writes
+    the results of each query to the corresponding line of the output file.
+    """
+    dictionary, postings, forward_index = load_index(dict_file, postings_file, use_feedback, cache_size)
+    expander = load_query_expander(dict_file, dictionary)
+    facet_index = load_facet_index(postings_file, postings)
+    query_expansion.load_resources()
 
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
+    with open(query_file, 'rt') as query_f, open(results_file, 'wt') as output_f:
+        for query_str in query_f:
+            results = search_query(query_str, dictionary, postings, k, forward_index, expander, facet_index, title_weight)
+            output_f.write(util.format_results(results))
 
-for o, a in opts:
-    if o == '-d':
-        dictionary_file = a
-    elif o == '-p':
-        postings_file = a
-    elif o == '-q':
-        query_file = a
-    elif o == '-o':
-        file_of_output = a
-    else:
-        assert False, "unhandled option"
+    postings.close()
+    if forward_index is not None:
+        forward_index.close()
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST requests with a JSON body { "query": str, "k": int (optional) } with
+    the JSON { "results": [ docID, ... ] }, using the index loaded by the server.
+    Answers GET requests to /stats with the counters of the postings caches.
+    """
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_json(404, { "error": "Not found" })
+            return
+
+        self.send_json(200, self.server.postings.get_cache_stats())
 
-if dictionary_file == None or postings_file == None or query_file == None or file_of_output == None:
-    usage()
-    sys.exit(2)
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            query_str = request["query"]
+            k = request.get("k", self.server.k)
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, { "error": "Expected a JSON body with a query" })
+            return
 
-run_search(dictionary_file, postings_file, query_file, file_of_output)
+        if not isinstance(query_str, str):
+            self.send_json(400, { "error": "The query must be a string" })
+            return
+
+        if k is not None and (isinstance(k, bool) or not isinstance(k, int) or k <= 0):
+            self.send_json(400, { "error": "k must be a positive integer" })
+            return
+
+        try:
+            results = search_query(query_str, self.server.dictionary, self.server.postings, k, self.server.forward_index,
+                                   self.server.expander, self.server.facet_index, self.server.title_weight)
+        except ValueError as e:
+            # Malformed queries and filters
+            self.send_json(400, { "error": str(e) })
+            return
+        except Exception as e:
+            self.log_error("error searching %r: %r", query_str, e)
+            self.send_json(500, { "error": "Internal error" })
+            return
+
+        self.send_json(200, { "results": results })
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode('utf8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run_server(dict_file, postings_file, port, k=None, use_feedback=False, cache_size=CACHE_SIZE, title_weight=None):
+    """
+    Loads the index, wordnet and the spell checker once, and answers concurrent queries 
+    over HTTP on localhost until interrupted.
+    """
+    dictionary, postings, forward_index = load_index(dict_file, postings_file, use_feedback, cache_size)
+    expander = load_query_expander(dict_file, dictionary)
+    facet_index = load_facet_index(postings_file, postings)
+    query_expansion.load_resources()
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), SearchRequestHandler)
+    server.dictionary = dictionary
+    server.postings = postings
+    server.k = k
+    server.forward_index = forward_index
+    server.expander = expander
+    server.facet_index = facet_index
+    server.title_weight = title_weight
+
+    print('serving on http://127.0.0.1:' + str(server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+    postings.close()
+    if forward_index is not None:
+        forward_index.close()
+
+
+if __name__ == "__main__":
+    dictionary_file = postings_file = query_file = file_of_output = None
+    num_results = None
+    is_batch = False
+    use_feedback = False
+    cache_size = CACHE_SIZE
+    port = None
+    title_weight = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:k:bs:rc:z:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            query_file = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-k':
+            num_results = int(a)
+        elif o == '-b':
+            is_batch = True
+        elif o == '-s':
+            port = int(a)
+        elif o == '-r':
+            use_feedback = True
+        elif o == '-c':
+            cache_size = int(float(a) * 1024 * 1024)
+        elif o == '-z':
+            title_weight = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None:
+        usage()
+        sys.exit(2)
+
+    if port is not None:
+        run_server(dictionary_file, postings_file, port, num_results, use_feedback, cache_size, title_weight)
+        sys.exit(0)
+
+    if query_file == None or file_of_output == None:
+        usage()
+        sys.exit(2)
+
+    if is_batch:
+        run_batch_search(dictionary_file, postings_file, query_file, file_of_output, num_results, use_feedback, cache_size,
+                         title_weight)
+    else:
+        run_search(dictionary_file, postings_file, query_file, file_of_output, num_results, use_feedback, cache_size, title_weight)
@@ -0,0 +1,343 @@
+"""
+Search over an index made of several segments (see `segments.py`), as if it was a single index.
+
+Each segment is an immutable index of some documents, with its own dictionary, postings and forward index
+files and facets, and the tombstones of its documents that were deleted or superseded by a newer segment. The live
+documents of the segments are disjoint, so the postings list of a term in the whole index is the merge of
+its postings lists in the segments, without the tombstones. SegmentedDictionary, SegmentedPostingsFile and
+SegmentedForwardIndex have the methods of Dictionary, PostingsFile and ForwardIndex used to evaluate queries,
+so all the retrieval models score the documents of all segments with the statistics of the whole index.
+
+The "offset" of a term is the term itself, which the SegmentedPostingsFile looks up in each segment.
+Document frequencies are the sums over the segments of the postings of their live documents, so that they
+agree with the number of live documents. The tombstones of a term in a segment are counted from its docIDs the
+first time the term is looked up.
+"""
+import heapq
+from array import array
+
+from dictionary import Dictionary
+from postingsfile import PostingsFile
+import forwardindex
+import biword
+import facets
+from bitmap import Bitmap
+
+
+class Segment(object):
+    """
+    Files and tombstones of a segment, and its index once opened.
+    """
+    def __init__(self, name, dict_file, postings_file, num_of_docs, tombstones=(), rows_file=None):
+        self.name = name
+        self.dict_file = dict_file
+        self.postings_file = postings_file
+        self.num_of_docs = num_of_docs  # Documents in the segment, including tombstones
+        self.tombstones = set(tombstones)  # docIDs of the deleted or superseded documents of the segment
+        self.rows_file = rows_file  # Rows of the documents copied to the segment. None if the rows are in the indexed dataset file
+        self.dictionary = None
+        self.postings = None
+        self.forward_index = None
+        self.facet_index = None
+        self.live_dfs = {}  # { term: document frequency without the tombstones } of the terms read since opened
+
+    def open(self, use_feedback=False, cache_size=0):
+        """
+        Loads the dictionary and memory-maps the postings file of the segment.
+        """
+        self.dictionary = Dictionary(self.dict_file)
+        self.dictionary.load()
+        self.live_dfs = {}
+        self.postings = PostingsFile(self.postings_file, use_mmap=True, cache_size=cache_size)
+
+        if use_feedback:
+            self.forward_index = forwardindex.ForwardIndex(forwardindex.get_file_name(self.postings_file))
+
+        # Read when a query is filtered
+        self.facet_index = facets.FacetIndex(facets.get_file_name(self.postings_file))
+
+        return self
+
+    def close(self):
+        if self.postings is not None:
+            self.postings.close()
+        if self.forward_index is not None:
+            self.forward_index.close()
+
+    def get_live_docs(self):
+        """
+        Returns the docIDs of the documents of the segment that are not tombstones.
+        """
+        return [doc_id for doc_id in self.dictionary.normalised_doc_lengths if doc_id not in self.tombstones]
+
+    def get_live_doc_count(self):
+        return self.num_of_docs - len(self.tombstones)
+
+    def get_live_df(self, term):
+        """
+        Returns the number of live documents of the segment with the term. -1 if term not present
+        """
+        df = self.dictionary.get_df(term)
+        if df == -1 or not self.tombstones:
+            return df
+
+        if term not in self.live_dfs:
+            offset, size = self.dictionary.get_offset_and_size_of_term(term)
+            self.live_dfs[term] = len(self.remove_tombstones(self.postings.get_posting_list_with_tf(offset, size)))
+
+        return self.live_dfs[term]
+
+    def remove_tombstones(self, postings):
+        """
+        Removes the postings of the tombstones from a postings list [ (docID, ...), ... ] of the segment.
+        """
+        if not self.tombstones:
+            return postings
+
+        return [posting for posting in postings if str(posting[0]) not in self.tombstones]
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "dictionary": self.dict_file,
+            "postings": self.postings_file,
+            "rows": self.rows_file,
+            "numOfDocs": self.num_of_docs,
+            "tombstones": sorted(self.tombstones, key=int),
+        }
+
+    @staticmethod
+    def from_json(entry):
+        return Segment(entry["name"], entry["dictionary"], entry["postings"], entry["numOfDocs"],
+                       entry["tombstones"], entry["rows"])
+
+
+class SegmentedDictionary(object):
+    """
+    Dictionary of the whole index, from the dictionaries of the opened segments.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+        self.terms = None  # Sorted terms of all segments. Built when needed
+        self.doc_table = None  # (doc_ids, normalised_lengths) arrays of the live documents sorted by docID. Built when needed
+
+        self.doc_segments = {}  # { docID: segment with the live document }
+        for segment in segments:
+            for doc_id in segment.get_live_docs():
+                self.doc_segments[doc_id] = segment
+
+    def get_segment(self, doc_id):
+        """
+        Returns the segment with the live document, or None if the document is not in the index.
+        """
+        return self.doc_segments.get(str(doc_id))
+
+    def get_segments_of_term(self, term):
+        return [segment for segment in self.segments if segment.dictionary.get_df(term) != -1]
+
+    def get_terms(self):
+        if self.terms is None:
+            self.terms = sorted(set(term for segment in self.segments for term in segment.dictionary.get_terms()))
+
+        return self.terms
+
+    def get_df(self, token):
+        """
+        Gets the number of live documents with the term in all segments. Returns -1 if the term is not in
+        a live document, or if it is a biword whose postings may have been pruned from a segment that does not have it.
+        """
+        df = 0
+        for segment in self.segments:
+            segment_df = segment.get_live_df(token)
+
+            if segment_df != -1:
+                df += segment_df
+            elif biword.is_biword(token):
+                min_df = segment.dictionary.get_biword_min_df()
+                if min_df is None or min_df > 1:
+                    return -1
+
+        return df if df > 0 else -1
+
+    def get_offset_and_size_of_term(self, term):
+        """
+        Returns the term as the offset of its postings lists for the SegmentedPostingsFile, and
+        the total size of its postings lists. -1, -1 if term not present
+        """
+        if self.get_df(term) == -1:
+            return -1, -1
+
+        return term, sum(segment.dictionary.get_offset_and_size_of_term(term)[1] for segment in self.get_segments_of_term(term))
+
+    def get_positions_offset_and_size_of_term(self, term):
+        """
+        Returns the term as the offset of its positions, and their total size. -1, -1 if term or its positions are not present
+        """
+        if self.get_df(term) == -1:
+            return -1, -1
+
+        size = 0
+        for segment in self.get_segments_of_term(term):
+            positions_offset, positions_size = segment.dictionary.get_positions_offset_and_size_of_term(term)
+            if positions_offset == -1:
+                return -1, -1
+
+            size += positions_size
+
+        return term, size
+
+    def get_normalised_doc_length(self, doc_id):
+        return self.get_segment(doc_id).dictionary.get_normalised_doc_length(doc_id)
+
+    def get_zone_doc_length(self, zone, doc_id):
+        return self.get_segment(doc_id).dictionary.get_zone_doc_length(zone, doc_id)
+
+    def get_court_weight(self, doc_id):
+        segment = self.get_segment(doc_id)
+        if segment is None:
+            return 1
+
+        return segment.dictionary.get_court_weight(doc_id)
+
+    def get_doc_table(self):
+        """
+        Returns the dense table of the live documents of all segments, sorted by docID.
+
+        :return: doc_ids, normalised_lengths: array('q') of sorted docIDs, and array('d') of their normalised lengths
+        """
+        if self.doc_table is None:
+            docs = sorted((int(doc_id), segment.dictionary.get_normalised_doc_length(doc_id))
+                            for doc_id, segment in self.doc_segments.items())
+
+            self.doc_table = (array('q', [doc_id for doc_id, _ in docs]),
+                              array('d', [length for _, length in docs]))
+
+        return self.doc_table
+
+    def has_precomputed_weights(self):
+        return all(segment.dictionary.has_precomputed_weights() for segment in self.segments)
+
+    def get_doc_count(self):
+        """
+        Returns the number of live documents in all segments.
+        """
+        return len(self.doc_segments)
+
+
+class SegmentedPostingsFile(object):
+    """
+    Postings lists of the whole index, merged from the postings lists of the opened segments.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+
+    def merge_postings(self, term, read_posting_list):
+        """
+        Merges the postings lists of the term in the segments, without the tombstones.
+
+        :param read_posting_list: function of a segment and the term that returns the postings list of the term in the segment
+        """
+        postings_lists = [segment.remove_tombstones(read_posting_list(segment, term))
+                            for segment in self.segments if segment.dictionary.get_df(term) != -1]
+
+        if len(postings_lists) == 1:
+            return postings_lists[0]
+
+        return list(heapq.merge(*postings_lists, key=lambda posting: posting[0]))
+
+    def get_posting_list(self, offset, size, dictionary, doc_filter=None):
+        def read_posting_list(segment, term):
+            term_offset, term_size = segment.dictionary.get_offset_and_size_of_term(term)
+            return segment.postings.get_posting_list(term_offset, term_size, segment.dictionary, doc_filter)
+
+        return self.merge_postings(offset, read_posting_list)
+
+    def get_normalised_posting_list(self, offset, size, dictionary, doc_filter=None):
+        def read_posting_list(segment, term):
+            term_offset, term_size = segment.dictionary.get_offset_and_size_of_term(term)
+            return segment.postings.get_normalised_posting_list(term_offset, term_size, segment.dictionary, doc_filter)
+
+        return self.merge_postings(offset, read_posting_list)
+
+    def get_posting_list_with_tf(self, offset, size, doc_filter=None):
+        def read_posting_list(segment, term):
+            term_offset, term_size = segment.dictionary.get_offset_and_size_of_term(term)
+            return segment.postings.get_posting_list_with_tf(term_offset, term_size, doc_filter)
+
+        return self.merge_postings(offset, read_posting_list)
+
+    def get_posting_list_with_positions(self, offset, size, dictionary, positions_offset=-1, positions_size=-1):
+        def read_posting_list(segment, term):
+            term_offset, term_size = segment.dictionary.get_offset_and_size_of_term(term)
+            term_positions_offset, term_positions_size = segment.dictionary.get_positions_offset_and_size_of_term(term)
+            return segment.postings.get_posting_list_with_positions(term_offset, term_size, segment.dictionary,
+                                                                    term_positions_offset, term_positions_size)
+
+        return self.merge_postings(offset, read_posting_list)
+
+    def get_cache_stats(self):
+        """
+        Returns the sums of the counters of the caches of the segments as { postings: stats, positions: stats }
+        """
+        cache_stats = {}
+        for segment in self.segments:
+            for cache, stats in segment.postings.get_cache_stats().items():
+                totals = cache_stats.setdefault(cache, dict.fromkeys(stats, 0))
+                for counter, value in stats.items():
+                    totals[counter] += value
+
+        return cache_stats
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class SegmentedForwardIndex(object):
+    """
+    Reads the vector of a live document from the forward index of its segment.
+    """
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+
+    def get_doc_vector_with_tf(self, doc_id, dictionary):
+        segment = self.dictionary.get_segment(doc_id)
+        if segment is None:
+            return {}
+
+        return segment.forward_index.get_doc_vector_with_tf(doc_id, segment.dictionary)
+
+    def get_doc_vector(self, doc_id, dictionary):
+        segment = self.dictionary.get_segment(doc_id)
+        if segment is None:
+            return {}
+
+        return segment.forward_index.get_doc_vector(doc_id, segment.dictionary)
+
+    def close(self):
+        for segment in self.dictionary.segments:
+            if segment.forward_index is not None:
+                segment.forward_index.close()
+
+
+class SegmentedFacetIndex(object):
+    """
+    Filters the documents of the segments by the facets of each segment (see `facets.py`).
+    """
+    def __init__(self, segments):
+        self.segments = segments
+
+    def get_filter(self, filters):
+        """
+        Returns the union of the bitmaps of the matching live documents of the segments. The tombstones are
+        removed, as a superseded document may have had other facets than its newer version.
+        """
+        doc_filter = Bitmap()
+        for segment in self.segments:
+            segment_filter = segment.facet_index.get_filter(filters)
+            if segment.tombstones:
+                segment_filter = segment_filter - Bitmap.from_sorted(sorted(int(doc_id) for doc_id in segment.tombstones))
+
+            doc_filter = doc_filter | segment_filter
+
+        return doc_filter
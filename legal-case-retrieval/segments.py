@@ -0,0 +1,493 @@
+#!/usr/bin/python3
+"""
+Incremental indexing of the collection into segments.
+
+An index built by `index.py` is a single segment. New or changed rows are indexed into a new immutable
+segment next to it, without reindexing the rest of the collection, and the previous versions of changed
+or deleted documents are marked with tombstones in their segments. The segments of an index and their
+tombstones are listed in a manifest next to the dictionary file (`dictionary-file.segments`):
+
+    { "nextSegment": int, "segments": [ { name, dictionary, postings, rows, numOfDocs, tombstones }, ... ] }
+
+A row is new or changed if the hash of its fields differs from the hash saved for its document when it
+was indexed, so the dataset file may be overwritten in place between appends. The rows indexed into a
+segment are copied next to it (`dictionary-file.segN.csv`) when it is created, and merges copy the rows
+of the merged segments. The base segment built by `index.py` reads its rows from its dataset file: a merge
+finds the rows that have moved in it by their docID and hash, and does not copy the rows that have changed.
+
+Small segments are merged by the merge policy, which drops the tombstones: segments with about the same
+number of documents are merged once there are MERGE_FACTOR of them, so that every document is merged
+a logarithmic number of times, and a segment with many tombstones is rewritten without them.
+
+After an append, the merge policy runs in a detached `segments.py` process. Appends and merges hold a lock
+file next to the manifest, so that only one process changes the segments of an index at a time. Searching
+(see `segmentedindex.py`) uses the segments in the manifest when the index is loaded.
+"""
+import getopt
+import json
+import math
+import os
+import subprocess
+import sys
+from contextlib import contextmanager
+
+import codec
+import docstore
+import facets
+import forwardindex
+import index
+import biword
+import zones
+from dictionary import Dictionary
+from postingsfile import PostingsFile
+from segmentedindex import Segment, SegmentedDictionary, SegmentedPostingsFile, SegmentedForwardIndex
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Appends and merges are not locked across processes without fcntl
+
+MERGE_FACTOR = 10  # Segments of the same level that are merged together
+MAX_TOMBSTONES_RATIO = 0.3  # Segments with a larger fraction of tombstones are rewritten without them
+
+
+def get_manifest_file(dict_file):
+    """
+    Returns the name of the manifest of the segments of the index, saved next to the dictionary file.
+    """
+    return dict_file + '.segments'
+
+
+def has_segments(dict_file):
+    """
+    Returns True if the index has been appended to, and is searched through its segments.
+    """
+    return os.path.exists(get_manifest_file(dict_file))
+
+
+def get_rows_file(dict_file):
+    """
+    Returns the name of the file of the rows copied next to the dictionary file of a segment.
+    """
+    return dict_file + '.csv'
+
+
+def get_segment_files(segment):
+    """
+    Returns the names of the dictionary, postings, forward index, facets and rows files of a segment.
+    The rows file is None if the segment reads its rows from the dataset file it was built from.
+    """
+    return [segment.dict_file, segment.postings_file, forwardindex.get_file_name(segment.postings_file),
+            facets.get_file_name(segment.postings_file), segment.rows_file]
+
+
+def get_level(num_of_docs):
+    """
+    Returns the level of a segment in the merge policy: segments of a level have up to MERGE_FACTOR times more documents than the previous level.
+    """
+    return int(math.log(max(num_of_docs, 1), MERGE_FACTOR))
+
+
+def find_merges(segments):
+    """
+    Returns the segments to merge according to the merge policy.
+
+    :param segments: [ Segment, ... ]
+    :return: [ [ Segment, ... ], ... ] groups of segments to merge into one segment each
+    """
+    merges = []
+    merged = set()
+
+    levels = {}  # { level: [ Segment, ... ] }
+    for segment in segments:
+        levels.setdefault(get_level(segment.get_live_doc_count()), []).append(segment)
+
+    for level in sorted(levels):
+        level_segments = levels[level]
+        while len(level_segments) >= MERGE_FACTOR:
+            merges.append(level_segments[:MERGE_FACTOR])
+            merged.update(segment.name for segment in level_segments[:MERGE_FACTOR])
+            level_segments = level_segments[MERGE_FACTOR:]
+
+    # Expunge the tombstones of the other segments with many deleted documents
+    for segment in segments:
+        if segment.name not in merged and segment.num_of_docs > 0 and len(segment.tombstones) > MAX_TOMBSTONES_RATIO * segment.num_of_docs:
+            merges.append([segment])
+
+    return merges
+
+
+class SegmentManager(object):
+    """
+    Appends segments to the index saved in the dictionary file and postings file, marks tombstones,
+    and merges segments.
+    """
+    def __init__(self, dict_file, postings_file):
+        self.dict_file = dict_file
+        self.postings_file = postings_file
+        self.manifest_file = get_manifest_file(dict_file)
+        self.segments = []  # [ Segment, ... ] from the oldest to the newest
+        self.next_segment = 1
+
+        self.load()
+
+    def load(self):
+        """
+        Loads the manifest. An index without a manifest is a single segment, if it was built.
+        """
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'rt') as f:
+                manifest = json.load(f)
+
+            f.close()
+
+            self.segments = [Segment.from_json(entry) for entry in manifest["segments"]]
+            self.next_segment = manifest["nextSegment"]
+        elif os.path.exists(self.dict_file):
+            dictionary = Dictionary(self.dict_file)
+            dictionary.load()
+
+            self.segments = [Segment("base", self.dict_file, self.postings_file, dictionary.get_doc_count())]
+
+    @contextmanager
+    def lock(self):
+        """
+        Holds the lock file of the segments (`dictionary-file.segments.lock`) while the segments are changed,
+        waiting for the process that holds it, such as a merge in the background. The manifest is then
+        loaded again, as the segments may have been changed by that process.
+        """
+        with open(self.manifest_file + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            self.load()
+            yield
+
+        lock_file.close()
+
+    def save(self):
+        """
+        Saves the manifest, replacing the previous manifest at once so that it is never partially written.
+        """
+        manifest = {"nextSegment": self.next_segment, "segments": [segment.to_json() for segment in self.segments]}
+
+        with open(self.manifest_file + '.tmp', 'wt') as f:
+            json.dump(manifest, f)
+
+        f.close()
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def new_segment_files(self):
+        """
+        Returns the name, dictionary file, postings file and rows file of a new segment.
+        """
+        name = 'seg' + str(self.next_segment)
+        self.next_segment += 1
+
+        return name, self.dict_file + '.' + name, self.postings_file + '.' + name, get_rows_file(self.dict_file + '.' + name)
+
+    def open_segments(self, use_feedback=False, cache_size=0):
+        """
+        Opens all segments, with caches of cache_size bytes shared evenly between the segments.
+        """
+        segment_cache_size = cache_size // max(len(self.segments), 1)
+
+        return [segment.open(use_feedback, segment_cache_size) for segment in self.segments]
+
+    def open_index(self, use_feedback=False, cache_size=0):
+        """
+        Opens the segments for searching, as a single index.
+
+        Returns:
+            - dictionary: SegmentedDictionary object
+            - postings: SegmentedPostingsFile object
+            - forward_index: SegmentedForwardIndex object if use_feedback, else None
+        """
+        segments = self.open_segments(use_feedback, cache_size)
+
+        dictionary = SegmentedDictionary(segments)
+        forward_index = SegmentedForwardIndex(dictionary) if use_feedback else None
+
+        return dictionary, SegmentedPostingsFile(segments), forward_index
+
+    def append(self, dataset_file=None, num_workers=1, memory_budget=None, precompute_weights=False,
+               biword_min_df=None, deleted_doc_ids=()):
+        """
+        Marks the deleted documents with tombstones, and indexes the new or changed rows of the
+        dataset file into a new segment. The previous versions of the changed documents are marked with tombstones.
+
+        Params:
+            - dataset_file: Path to the rows to add. None to only delete documents
+            - deleted_doc_ids: docIDs of the documents to delete
+
+        Returns:
+            - segment: the new Segment, or None if no row was new or changed
+        """
+        with self.lock():
+            live_segments = SegmentedDictionary(self.open_segments()).doc_segments
+
+            for doc_id in deleted_doc_ids:
+                if doc_id in live_segments:
+                    live_segments.pop(doc_id).tombstones.add(doc_id)
+
+            segment = None
+            if dataset_file is not None:
+                def is_new_or_changed(row):
+                    segment = live_segments.get(row[0])
+                    return segment is None or segment.dictionary.get_doc_hash(row[0]) != docstore.get_row_hash(row)
+
+                name, dict_file, postings_file, rows_file = self.new_segment_files()
+                dictionary = index.build_index(dataset_file, dict_file, postings_file, num_workers, memory_budget,
+                                               precompute_weights, biword_min_df, is_new_or_changed, rows_file)
+
+                segment = Segment(name, dict_file, postings_file, dictionary.get_doc_count(), rows_file=rows_file)
+                segment.dictionary = dictionary
+
+                # Supersede the previous versions of the documents
+                for doc_id in segment.get_live_docs():
+                    if doc_id in live_segments:
+                        live_segments[doc_id].tombstones.add(doc_id)
+
+                if segment.num_of_docs > 0:
+                    self.segments.append(segment)
+                else:
+                    self.remove_segment_files(segment)
+                    segment = None
+
+            for existing_segment in self.segments:
+                existing_segment.close()
+
+            self.save()
+
+        return segment
+
+    def merge(self, segments):
+        """
+        Merges the segments into a new segment without their tombstones, and deletes their files.
+        Must be called with the lock held, see `merge_segments`.
+        The rows of the documents are copied next to the new segment, so that the segment does not
+        depend on the rows files of the merged segments.
+
+        If the base segment is merged, the new segment replaces it under the names of the dictionary
+        file and postings file of the index, with its rows in `dictionary-file.csv`.
+
+        :param segments: [ Segment, ... ] of this index
+        :return: the new Segment
+        """
+        segments = [segment.open() for segment in segments]
+        name, dict_file, postings_file, rows_file = self.new_segment_files()
+
+        base = next((segment for segment in segments if segment.dict_file == self.dict_file), None)
+        final_rows_file = rows_file if base is None else get_rows_file(self.dict_file)
+
+        # A biword is complete in the merged segment if it was not pruned from any merged segment
+        min_dfs = [segment.dictionary.get_biword_min_df() for segment in segments]
+        biword_min_df = None if None in min_dfs else max(min_dfs, default=None)
+
+        dictionary = Dictionary(dict_file)
+        dictionary.set_precomputed_weights(any(segment.dictionary.has_precomputed_weights() for segment in segments))
+        dictionary.set_dataset_file(os.path.abspath(final_rows_file))
+        dictionary.set_biword_min_df(biword_min_df)
+
+        with open(rows_file, 'wb') as rows:
+            for segment in segments:
+                store = docstore.DocumentStore(segment.dictionary, segment.rows_file)
+                live_docs = segment.get_live_docs()
+
+                records = {doc_id: store.read_record(doc_id) for doc_id in live_docs}
+                moved_doc_ids = set(doc_id for doc_id, record in records.items() if record is None)
+                if moved_doc_ids:
+                    records.update(store.find_records(moved_doc_ids))
+
+                for doc_id in live_docs:
+                    dictionary.add_normalised_doc_length(doc_id, segment.dictionary.get_normalised_doc_length(doc_id))
+                    for zone in zones.ZONES:
+                        dictionary.add_zone_doc_length(zone, doc_id, segment.dictionary.get_zone_doc_length(zone, doc_id))
+                    dictionary.add_court_weight(doc_id, segment.dictionary.get_court_weight(doc_id))
+                    dictionary.add_doc_count()
+
+                    if segment.dictionary.get_doc_hash(doc_id) != -1:
+                        dictionary.add_doc_hash(doc_id, segment.dictionary.get_doc_hash(doc_id))
+
+                    if records[doc_id] is not None:
+                        offset, size = docstore.write_record(rows, records[doc_id])
+                        dictionary.add_doc_location(doc_id, offset, size)
+
+        rows.close()
+
+        merged_postings = PostingsFile(postings_file)
+        forward_index = forwardindex.ForwardIndex(forwardindex.get_file_name(postings_file))
+
+        with open(postings_file, 'wb') as out:
+            out.write(codec.HEADER)
+
+            for term in sorted(set(term for segment in segments for term in segment.dictionary.get_terms())):
+                if biword.is_biword(term) and not self.is_complete_biword(term, segments):
+                    continue
+
+                for segment in segments:
+                    positions_offset, positions_size = segment.dictionary.get_positions_offset_and_size_of_term(term)
+                    offset, size = segment.dictionary.get_offset_and_size_of_term(term)
+                    if offset == -1:
+                        continue
+
+                    postings = segment.postings.get_posting_list_with_positions(offset, size, segment.dictionary,
+                                                                                positions_offset, positions_size)
+                    for docID, positions, _ in segment.remove_tombstones(postings):
+                        dictionary.add_positions_of_term(term, positions, docID)
+
+                # Terms of tombstones only are not in the merged segment
+                if dictionary.has_indexed_term(term):
+                    merged_postings.save_term_postings(out, term, dictionary.format_dict_for_saving_postings(term),
+                                                       dictionary, forward_index)
+
+        out.close()
+
+        forward_index.save(dictionary)
+
+        # Facets of the live documents
+        facet_index = facets.FacetIndex(facets.get_file_name(postings_file))
+        for segment in segments:
+            if not facets.has_facets(segment.postings_file):
+                continue
+
+            for facet in segment.facet_index.get_facets():
+                for doc_id in segment.facet_index.get_bitmap(facet):
+                    if str(doc_id) not in segment.tombstones:
+                        facet_index.add_doc(doc_id, [facet])
+
+        facet_index.save()
+        dictionary.save()
+
+        for segment in segments:
+            segment.close()
+
+        merged_segment = Segment(name, dict_file, postings_file, dictionary.get_doc_count(), rows_file=rows_file)
+
+        if base is not None:
+            # The new segment takes the file names of the base segment, whose files it replaces
+            base_segment = Segment(base.name, self.dict_file, self.postings_file, dictionary.get_doc_count(),
+                                   rows_file=final_rows_file)
+
+            for file_name, base_file_name in zip(get_segment_files(merged_segment), get_segment_files(base_segment)):
+                os.replace(file_name, base_file_name)
+
+            merged_segment = base_segment
+
+        # Replace the merged segments in the manifest, before their files are deleted
+        merged_names = set(segment.name for segment in segments)
+        position = min(i for i, segment in enumerate(self.segments) if segment.name in merged_names)
+        self.segments = [segment for segment in self.segments if segment.name not in merged_names]
+        self.segments.insert(position, merged_segment)
+        self.save()
+
+        for segment in segments:
+            if segment is not base:
+                self.remove_segment_files(segment)
+
+        return merged_segment
+
+    def is_complete_biword(self, term, segments):
+        """
+        Returns True if the biword is in every segment that may have pruned it.
+        """
+        for segment in segments:
+            min_df = segment.dictionary.get_biword_min_df()
+            if segment.dictionary.get_df(term) == -1 and (min_df is None or min_df > 1):
+                return False
+
+        return True
+
+    def merge_segments(self, force=False):
+        """
+        Merges the segments chosen by the merge policy, until there is nothing to merge.
+        With force, merges all segments into a single segment.
+
+        :return: number of merges
+        """
+        num_of_merges = 0
+
+        with self.lock():
+            if force and (len(self.segments) > 1 or any(segment.tombstones for segment in self.segments)):
+                self.merge(self.segments)
+                return 1
+
+            merges = find_merges(self.segments)
+            while merges:
+                for segments in merges:
+                    self.merge(segments)
+                    num_of_merges += 1
+
+                merges = find_merges(self.segments)
+
+        return num_of_merges
+
+    def merge_in_background(self):
+        """
+        Runs the merge policy in a detached `segments.py` process, so that the calling process can exit
+        without waiting for the merges. The output of the process is appended to `dictionary-file.segments.log`.
+
+        :return: the started subprocess.Popen
+        """
+        with open(self.manifest_file + '.log', 'a') as log:
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-d', self.dict_file, '-p', self.postings_file],
+                                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+        log.close()
+
+        return process
+
+    def remove_segment_files(self, segment):
+        for file_name in get_segment_files(segment):
+            if file_name is not None and os.path.exists(file_name):
+                os.remove(file_name)
+
+    def remove_segments(self):
+        """
+        Deletes the files of the segments, other than the dictionary file and postings file, and the manifest.
+        Used before the index is built again from scratch, once a merge in the background is done.
+        """
+        with self.lock():
+            for segment in self.segments:
+                if segment.dict_file != self.dict_file:
+                    self.remove_segment_files(segment)
+                elif segment.rows_file is not None and os.path.exists(segment.rows_file):
+                    # Rows copied by a merge of the base segment
+                    os.remove(segment.rows_file)
+
+            if os.path.exists(self.manifest_file):
+                os.remove(self.manifest_file)
+
+            self.segments = []
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file [-f]")
+
+
+if __name__ == "__main__":
+    dictionary_file = postings_file = None
+    force = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:f')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-f': # merge all segments into one
+            force = True
+        else:
+            assert False, "unhandled option"
+
+    if dictionary_file == None or postings_file == None:
+        usage()
+        sys.exit(2)
+
+    num_of_merges = SegmentManager(dictionary_file, postings_file).merge_segments(force)
+    print(str(num_of_merges) + ' merges')
@@ -0,0 +1,342 @@
+"""
+Document-partitioned shards of the index, searched by scatter-gather.
+
+`index.py -n num-shards` partitions the documents of the collection by docID, and builds a complete index
+of the documents of each shard, with its own dictionary, postings, forward index and facets files
+(`dictionary-file.shardN`, `postings-file.shardN`). The document frequencies of the terms and the number
+of documents of the whole collection are saved in `dictionary-file`, as a dictionary without postings
+lists, and the shards are listed in `dictionary-file.shards`.
+
+A ShardedIndex opens each shard in a worker process, with the statistics of the whole collection, so that
+the query terms have the same tf-idf weights in every shard. The parsed and expanded query is sent to all
+the shards, which filter and score their own documents, and their ranked lists are merged. Documents with equal scores
+are ordered by the first query term that scored them and then by docID, as in an unsharded index, so the
+rankings are exactly the same. Free text queries with weighted zone scoring are ranked by score and then docID
+in the shards and when merging. The scores of boolean queries are normalised over all the matching documents,
+so for boolean queries the shards return the scores of all their matching documents instead of their top k.
+
+The worker processes are forked, so that they iterate over the terms of a query in the same order as the
+process that merges their results.
+"""
+import heapq
+import json
+import multiprocessing
+import os
+from functools import partial
+from itertools import islice
+
+import biword
+import boolean
+import facets
+import forwardindex
+import index
+import tf_idf
+import zones
+from dictionary import Dictionary
+from postingsfile import PostingsFile
+
+
+def get_manifest_file(dict_file):
+    """
+    Returns the name of the list of the shards of the index, saved next to the dictionary file.
+    """
+    return dict_file + '.shards'
+
+
+def has_shards(dict_file):
+    """
+    Returns True if the index was built in shards.
+    """
+    return os.path.exists(get_manifest_file(dict_file))
+
+
+def get_shard(doc_id, num_shards):
+    """
+    Returns the shard of the document.
+    """
+    return int(doc_id) % num_shards
+
+
+def is_in_shard(row, num_shards, shard):
+    return get_shard(row[0], num_shards) == shard
+
+
+def build_shards(dataset_file, dict_file, postings_file, num_shards, num_workers=1, memory_budget=None,
+                 precompute_weights=False, biword_min_df=None):
+    """
+    Builds the index of each shard, then saves the statistics of the whole collection in the dictionary file
+    and the list of the shards next to it. The dataset file is read once per shard, and the rows of the
+    other shards are skipped before they are tokenized.
+    """
+    remove_shards(dict_file)
+
+    shards = []
+    stats = Dictionary(dict_file)
+
+    for shard in range(num_shards):
+        shard_dict_file = dict_file + '.shard' + str(shard)
+        shard_postings_file = postings_file + '.shard' + str(shard)
+
+        dictionary = index.build_index(dataset_file, shard_dict_file, shard_postings_file, num_workers, memory_budget,
+                                       precompute_weights, biword_min_df, partial(is_in_shard, num_shards=num_shards, shard=shard))
+
+        # Biwords are looked up in each shard, as the shards may have pruned different biwords
+        for term, entry in dictionary.get_terms().items():
+            if not biword.is_biword(term):
+                stats.add_doc_freq(term, entry["docFreq"])
+
+        stats.add_doc_count(dictionary.get_doc_count())
+
+        shards.append({"dictionary": shard_dict_file, "postings": shard_postings_file})
+
+    stats.save()
+
+    with open(get_manifest_file(dict_file), 'wt') as f:
+        json.dump({"shards": shards}, f)
+
+    f.close()
+
+
+def remove_shards(dict_file):
+    """
+    Deletes the files of the shards of the index and their list, if the index was built in shards.
+    """
+    if not has_shards(dict_file):
+        return
+
+    with open(get_manifest_file(dict_file), 'rt') as f:
+        shards = json.load(f)["shards"]
+
+    f.close()
+
+    for shard in shards:
+        for file_name in (shard["dictionary"], shard["postings"], forwardindex.get_file_name(shard["postings"]),
+                          facets.get_file_name(shard["postings"])):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    os.remove(get_manifest_file(dict_file))
+
+
+class ShardDictionary(Dictionary):
+    """
+    Dictionary of a shard, with the document frequencies and the number of documents of the whole collection.
+    The terms of the collection that are not in the shard have an empty postings list, of size 0.
+    """
+    def __init__(self, disk_file, stats):
+        super().__init__(disk_file)
+        self.stats = stats  # Dictionary of the statistics of the collection
+
+    def is_missing(self, term):
+        """
+        Returns True if the term is in the collection but not in the shard.
+        """
+        return super().get_df(term) == -1 and self.get_df(term) != -1
+
+    def get_df(self, token):
+        # Biwords are pruned by their frequency in the shard
+        if biword.is_biword(token):
+            return super().get_df(token)
+
+        return self.stats.get_df(token)
+
+    def get_offset_and_size_of_term(self, term):
+        if self.is_missing(term):
+            return 0, 0
+
+        return super().get_offset_and_size_of_term(term)
+
+    def get_positions_offset_and_size_of_term(self, term):
+        if self.is_missing(term):
+            return 0, 0
+
+        return super().get_positions_offset_and_size_of_term(term)
+
+    def get_doc_count(self):
+        return self.stats.get_doc_count()
+
+
+class ShardPostingsFile(PostingsFile):
+    """
+    Postings file of a shard, where the postings lists of size 0 of the terms that are not in the shard are empty.
+    """
+    def get_posting_list(self, offset, size, dictionary, doc_filter=None):
+        if size == 0:
+            return []
+
+        return super().get_posting_list(offset, size, dictionary, doc_filter)
+
+    def get_normalised_posting_list(self, offset, size, dictionary, doc_filter=None):
+        if size == 0:
+            return []
+
+        return super().get_normalised_posting_list(offset, size, dictionary, doc_filter)
+
+    def get_posting_list_with_tf(self, offset, size, doc_filter=None):
+        if size == 0:
+            return []
+
+        return super().get_posting_list_with_tf(offset, size, doc_filter)
+
+    def get_posting_list_with_positions(self, offset, size, dictionary, positions_offset=-1, positions_size=-1):
+        if size == 0:
+            return []
+
+        return super().get_posting_list_with_positions(offset, size, dictionary, positions_offset, positions_size)
+
+
+shard_index = None  # (ShardDictionary, ShardPostingsFile, ForwardIndex or None, FacetIndex) of the shard of a worker process
+
+
+def open_shard(dict_file, postings_file, stats_file, use_feedback, cache_size):
+    """
+    Opens the shard in the worker process, with the statistics of the collection saved in stats_file.
+    """
+    global shard_index
+
+    stats = Dictionary(stats_file)
+    stats.load()
+
+    dictionary = ShardDictionary(dict_file, stats)
+    dictionary.load()
+
+    postings = ShardPostingsFile(postings_file, use_mmap=True, cache_size=cache_size)
+
+    forward_index = None
+    if use_feedback:
+        forward_index = forwardindex.ForwardIndex(forwardindex.get_file_name(postings_file))
+
+    facet_index = facets.FacetIndex(facets.get_file_name(postings_file))
+
+    shard_index = (dictionary, postings, forward_index, facet_index)
+
+
+def search_shard(is_boolean_query, query, expanded_query, k, is_rocchio, filters=None, zone_query=None, title_weight=None):
+    """
+    Scores the documents of the shard of the worker process for the query, that match the filters if any.
+
+    Returns:
+        - docs: scores of all the matching documents of a boolean query, as `boolean.score_fused_query`, or
+        the top k results of a free text query with their scores [ (docID, score, first query term), ... ],
+        or [ (docID, score), ... ] with weighted zone scoring
+    """
+    dictionary, postings, _, facet_index = shard_index
+
+    doc_filter = facet_index.get_filter(filters) if filters else None
+
+    if is_boolean_query:
+        return boolean.score_fused_query(query, expanded_query, dictionary, postings, doc_filter)
+    elif zone_query or title_weight is not None:
+        return zones.eval_zone_query(expanded_query, zone_query or [], dictionary, postings, title_weight, k, is_rocchio,
+                                     doc_filter, with_scores=True)
+    else:
+        return tf_idf.eval_free_text_query(expanded_query, dictionary, postings, False, is_rocchio, True, doc_filter, k)
+
+
+def get_shard_doc_vector(doc_id):
+    dictionary, _, forward_index, _ = shard_index
+
+    return forward_index.get_doc_vector(doc_id, dictionary)
+
+
+def get_shard_cache_stats():
+    return shard_index[1].get_cache_stats()
+
+
+class ShardedIndex(object):
+    """
+    Sends the queries to a worker process for each shard of the index, and merges the ranked results of the shards.
+    """
+    def __init__(self, dict_file, use_feedback=False, cache_size=0):
+        with open(get_manifest_file(dict_file), 'rt') as f:
+            shards = json.load(f)["shards"]
+
+        f.close()
+
+        self.dictionary = Dictionary(dict_file)  # Statistics of the collection, to expand queries and for feedback
+        self.dictionary.load()
+
+        self.pools = [multiprocessing.get_context('fork').Pool(1, open_shard, (shard["dictionary"], shard["postings"],
+                          dict_file, use_feedback, cache_size // len(shards))) for shard in shards]
+
+    def scatter(self, function, args=()):
+        """
+        Calls the function in the worker processes of all shards at once, and returns their results.
+        """
+        results = [pool.apply_async(function, args) for pool in self.pools]
+
+        return [result.get() for result in results]
+
+    def evaluate_query(self, is_boolean_query, query, expanded_query, k=None, is_rocchio=False, filters=None,
+                       zone_query=None, title_weight=None):
+        """
+        Ranks the documents of all shards for the query.
+
+        Params:
+            - is_boolean_query: Whether the query is a boolean query
+            - query: boolean query string tokens. None for a free text query
+            - expanded_query: expanded query terms with term weights [ (term, weight), ...], or the
+            Rocchio query { term: weight } if is_rocchio
+            - k: number of top ranked results to return. None to return all results
+            - filters: { field: [value, ...] } of the documents to rank, as returned by `facets.parse_filters`
+            - zone_query, title_weight: terms scoped to zones and weight of the title, for weighted zone scoring
+
+        Returns:
+            - results: ranked docIDs [ docID, ... ]
+        """
+        shard_results = self.scatter(search_shard, (is_boolean_query, query, expanded_query, k, is_rocchio, filters,
+                                                    zone_query, title_weight))
+
+        if is_boolean_query:
+            return boolean.rank_fused_query(list(heapq.merge(*shard_results, key=lambda doc: doc[0])), k)
+
+        if zone_query or title_weight is not None:
+            results = heapq.merge(*shard_results, key=lambda result: (-result[1], result[0]))
+
+            return [docID for docID, _ in islice(results, k)]
+
+        # Documents with equal scores are ranked by the order in which the terms are scored
+        query_terms = list(expanded_query.keys()) if is_rocchio else [term for term, _ in expanded_query]
+        term_order = {term: order for order, term in enumerate(set(query_terms))}
+
+        results = heapq.merge(*shard_results, key=lambda result: (-result[1], term_order[result[2]], result[0]))
+
+        return [docID for docID, _, _ in islice(results, k)]
+
+    def get_doc_vector(self, doc_id):
+        """
+        Reads the vector of the document from the forward index of its shard.
+        """
+        return self.pools[get_shard(doc_id, len(self.pools))].apply(get_shard_doc_vector, (doc_id,))
+
+    def get_cache_stats(self):
+        """
+        Returns the sums of the counters of the caches of the shards as { postings: stats, positions: stats }
+        """
+        cache_stats = {}
+        for shard_stats in self.scatter(get_shard_cache_stats):
+            for cache, stats in shard_stats.items():
+                totals = cache_stats.setdefault(cache, dict.fromkeys(stats, 0))
+                for counter, value in stats.items():
+                    totals[counter] += value
+
+        return cache_stats
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+            pool.join()
+
+
+class ShardedForwardIndex(object):
+    """
+    Reads the vectors of documents from the forward indexes of their shards, for relevance feedback.
+    """
+    def __init__(self, sharded_index):
+        self.sharded_index = sharded_index
+
+    def get_doc_vector(self, doc_id, dictionary):
+        return self.sharded_index.get_doc_vector(doc_id)
+
+    def close(self):
+        pass
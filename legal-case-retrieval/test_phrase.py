@@ -0,0 +1,48 @@
+import unittest
+
+import phrase
+
+
+class CountPhraseTest(unittest.TestCase):
+    def test_exact_phrase(self):
+        # "court appeal damage" in "court appeal damage court appeal"
+        self.assertEqual(phrase.count_phrase([[0, 3], [1, 4], [2]]), 1)
+        self.assertEqual(phrase.count_phrase([[0], [2], [3]]), 0)
+
+    def test_slop_skips_earliest_position(self):
+        # "court appeal damage"~1 in "court appeal appeal witness damage": court@0 appeal@2 damage@4
+        positions_lists = [[0], [1, 2], [4]]
+
+        self.assertEqual(phrase.count_phrase(positions_lists, 0), 0)
+        self.assertEqual(phrase.count_phrase(positions_lists, 1), 1)
+        self.assertEqual(phrase.count_phrase(positions_lists, 2), 1)
+
+    def test_slop_counts_each_start(self):
+        # "a b"~1 in "a a b": both positions of a are within 1 word of b
+        self.assertEqual(phrase.count_phrase([[0, 1], [2]], 1), 2)
+        self.assertEqual(phrase.count_phrase([[0, 1], [2]], 0), 1)
+
+    def test_terms_in_order(self):
+        # "b a"~3 in "a b": the terms must follow in the order of the phrase
+        self.assertEqual(phrase.count_phrase([[1], [0]], 3), 0)
+
+    def test_phrase_intersect_with_slop(self):
+        postings_lists = [
+            [(1, [0], 1.0), (2, [0], 1.0)],
+            [(1, [1, 2], 1.3), (2, [1], 1.0)],
+            [(1, [4], 1.0), (2, [2], 1.0)],
+        ]
+
+        self.assertEqual([docID for docID, _ in phrase.phrase_intersect(postings_lists, 0)], [2])
+        self.assertEqual([docID for docID, _ in phrase.phrase_intersect(postings_lists, 1)], [1, 2])
+
+
+class ParsePhraseTest(unittest.TestCase):
+    def test_parse_slop(self):
+        self.assertEqual(phrase.parse_phrase('"fiduciary duty care"~2'), ('fiduciary duty care', 2))
+        self.assertEqual(phrase.parse_phrase('"fiduciary duty"'), ('fiduciary duty', 0))
+        self.assertEqual(phrase.parse_phrase('duty'), (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
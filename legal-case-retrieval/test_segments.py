@@ -0,0 +1,105 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import docstore
+import index
+import segments
+import tf_idf
+from dictionary import Dictionary
+from postingsfile import PostingsFile
+
+HEADER = ['document_id', 'title', 'content', 'date_posted', 'court']
+
+ROWS = [
+    ['1', 'Smith v Jones', 'The defendant breached the contract of sale', '2001-03-04 00:00:00', 'High Court of Australia'],
+    ['2', 'Re Brown', 'Negligence of the driver caused the accident', '1999-01-01 00:00:00', 'UK Supreme Court'],
+    ['3', 'Lee v Tan', 'The contract was void for mistake', '2010-06-30 00:00:00', 'SG Court of Appeal'],
+    ['4', 'Public Prosecutor v Lim', 'The accused was convicted of fraud', '2005-11-11 00:00:00', 'SG High Court'],
+    ['5', 'Green v White', 'Trespass to land and nuisance by the neighbour', '2012-02-02 00:00:00', 'Unknown Court'],
+    ['6', 'Re Black', 'Fiduciary duty of the trustee to the beneficiary', '2015-05-05 00:00:00', 'UK Supreme Court'],
+    ['7', 'Wong v Chan', 'Damages for breach of contract of employment', '2003-07-07 00:00:00', 'HK High Court'],
+    ['8', 'Kelly v Reid', 'Rescission of the contract for misrepresentation', '1998-08-08 00:00:00', 'High Court of Australia'],
+]
+
+
+class AppendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dataset_file = os.path.join(self.dir, 'dataset.csv')
+        self.dict_file = os.path.join(self.dir, 'dictionary.txt')
+        self.postings_file = os.path.join(self.dir, 'postings.txt')
+
+        write_rows(self.dataset_file, ROWS)
+        index.build_index(self.dataset_file, self.dict_file, self.postings_file)
+
+        # The dataset file is overwritten in place with changed, new and reordered rows
+        self.rows = [list(row) for row in reversed(ROWS) if row[0] not in ('5', '6')]
+        self.rows[0][2] = 'Rescission of the contract for innocent misrepresentation'
+        self.rows.append(['9', 'Ng v Ho', 'Negligence of the surgeon and damages', '2020-09-09 00:00:00', 'SG High Court'])
+        write_rows(self.dataset_file, self.rows)
+
+        self.manager = segments.SegmentManager(self.dict_file, self.postings_file)
+        self.manager.append(self.dataset_file, deleted_doc_ids=['5', '6'])
+
+        write_rows(os.path.join(self.dir, 'fresh.csv'), self.rows)
+        index.build_index(os.path.join(self.dir, 'fresh.csv'), os.path.join(self.dir, 'fresh.txt'),
+                          os.path.join(self.dir, 'fresh-postings.txt'))
+
+        self.fresh_dictionary = Dictionary(os.path.join(self.dir, 'fresh.txt'))
+        self.fresh_dictionary.load()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_only_new_or_changed_rows_are_appended(self):
+        self.assertEqual(sorted(self.manager.segments[1].get_live_docs(), key=int), ['8', '9'])
+        self.assertEqual(sorted(self.manager.segments[0].tombstones, key=int), ['5', '6', '8'])
+
+    def test_statistics_of_fresh_build(self):
+        dictionary, postings, _ = self.manager.open_index()
+        self.addCleanup(postings.close)
+
+        self.assertEqual(dictionary.get_doc_count(), self.fresh_dictionary.get_doc_count())
+        for term in self.fresh_dictionary.get_terms():
+            self.assertEqual(dictionary.get_df(term), self.fresh_dictionary.get_df(term), term)
+
+        # Terms of deleted documents only
+        self.assertEqual(dictionary.get_df('trespass'), -1)
+        self.assertEqual(dictionary.get_offset_and_size_of_term('trespass'), (-1, -1))
+
+    def test_scores_of_fresh_build(self):
+        dictionary, postings, _ = self.manager.open_index()
+        self.addCleanup(postings.close)
+
+        fresh_postings = PostingsFile(os.path.join(self.dir, 'fresh-postings.txt'))
+        query_tokens = [('contract', 1), ('neglig', 1), ('damag', 1), ('fiduciari', 1)]
+
+        self.assertEqual(tf_idf.eval_free_text_query(query_tokens, dictionary, postings, with_scores=True),
+                         tf_idf.eval_free_text_query(query_tokens, self.fresh_dictionary, fresh_postings, with_scores=True))
+
+    def test_merge_keeps_rows_and_file_names(self):
+        self.manager.merge_segments(force=True)
+
+        self.assertEqual([segment.dict_file for segment in self.manager.segments], [self.dict_file])
+        self.assertFalse(any(name.endswith('.seg1') for name in os.listdir(self.dir)))
+
+        segment = self.manager.open_segments()[0]
+        store = docstore.DocumentStore(segment.dictionary, segment.rows_file)
+        for row in self.rows:
+            self.assertEqual(store.get_document(row[0]), row)
+
+
+def write_rows(dataset_file, rows):
+    with open(dataset_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+    f.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,13 @@ import sys
 
 import util
 
-def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=False, is_rocchio=False):
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Scores are accumulated in a dict without numpy
+
+def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=False, is_rocchio=False, with_scores=False,
+                         doc_filter=None, k=None):
     """
     Performs search for free text query using tf-idf scoring. 
     Evaluates the query and returns ranked results based on lnc.ltc
@@ -18,16 +24,27 @@ def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=Fal
     :param dictionary: Object of Dictionary
     :param postings_file: Object of PostingsFile
     :param is_boolean: Whether this query is for a boolean query
+    :param with_scores: Whether to return the scores of the ranked results of a free text query
+    :param doc_filter: Bitmap of the documents to score, as returned by `FacetIndex.get_filter`. None to score all documents
+    :param k: number of ranked results of a free text query to return. None to return all results
     
     :return: 
         - If it is free text query, uses `document_score` for list of 
         ranked results. [ docID, ... ]
 
+        - If with_scores, the ranked results with their scores and the first query term 
+        that scored them, by which documents with equal scores are ordered. [ (docID, score, term), ... ]
+
         - If it is boolean query, returns `doc_scores` with ranked results and 
         normalised scores. [ (docID, score), ... ]
     """
+    if np is not None:
+        return eval_free_text_query_vectorized(query_tokens, dictionary, postings_file, is_boolean, is_rocchio, with_scores,
+                                               doc_filter, k)
+
     tf_query = defaultdict(int)
     document_score = defaultdict(float)
+    first_terms = {}  # { docID: first query term that scored the document } if with_scores
     query_norm_tokens = list()
     total_docs = dictionary.get_doc_count()
 
@@ -44,7 +61,7 @@ def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=Fal
         offset, size = dictionary.get_offset_and_size_of_term(norm_token)
 
         if offset != -1:
-            posting_list = postings_file.get_posting_list(offset, size, dictionary) 
+            posting_list = postings_file.get_normalised_posting_list(offset, size, dictionary, doc_filter)
         else:  
             # For unknown words, skip updates
             continue
@@ -60,12 +77,12 @@ def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=Fal
         norm_query += (wt * wt)
 
         # Update document tf-idf scores
-        for posting in posting_list:
-            doc_id = posting[0]
-            tf_doc = posting[1]
-            doc_norm_len = dictionary.get_normalised_doc_length(str(doc_id))
+        for doc_id, normalised_tf_doc in posting_list:
+            document_score[doc_id] += wt * normalised_tf_doc
 
-            document_score[doc_id] += wt * (tf_doc / doc_norm_len)
+        if with_scores:
+            for doc_id, _ in posting_list:
+                first_terms.setdefault(doc_id, norm_token)
 
     norm_query = sqrt(norm_query) # Length of query vector
 
@@ -79,7 +96,12 @@ def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=Fal
 
     if not is_boolean:
         # Return ranked documents for free text query
-        return heapq.nlargest(len(document_score), document_score, key=document_score.__getitem__)
+        ranking = heapq.nlargest(len(document_score) if k is None else k, document_score, key=document_score.__getitem__)
+
+        if with_scores:
+            return [(docId, document_score[docId], first_terms[docId]) for docId in ranking]
+
+        return ranking
 
 
     # Normalise scores using softmax
@@ -96,3 +118,124 @@ def eval_free_text_query(query_tokens, dictionary, postings_file, is_boolean=Fal
     doc_scores = sorted(doc_scores, key=lambda x: x[1])
 
     return doc_scores
+
+
+def eval_free_text_query_vectorized(query_tokens, dictionary, postings_file, is_boolean=False, is_rocchio=False, with_scores=False,
+                                    doc_filter=None, k=None):
+    """
+    Performs search for free text query using tf-idf scoring, like `eval_free_text_query`,
+    but accumulates the scores of the postings of each term into a numpy array over the 
+    dense doc table of the dictionary instead of a dict.
+
+    Returns exactly the same results as `eval_free_text_query`. Documents with equal scores 
+    are kept in the order in which they were first scored.
+    """
+    tf_query = defaultdict(int)
+    query_norm_tokens = list()
+    total_docs = dictionary.get_doc_count()
+
+    doc_ids, doc_lengths = dictionary.get_doc_table()
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int64)
+    doc_lengths = np.frombuffer(doc_lengths, dtype=np.float64)
+
+    document_score = np.zeros(len(doc_ids))
+    is_scored = np.zeros(len(doc_ids), dtype=bool)
+    score_order = np.zeros(len(doc_ids), dtype=np.int64)  # Order in which documents were first scored
+    num_scored = 0
+    first_term = np.zeros(len(doc_ids), dtype=np.int64)  # Index in scored_terms of the first term that scored each document
+    scored_terms = []
+
+    if is_rocchio:
+        tf_query = query_tokens
+        query_norm_tokens = list(query_tokens.keys())
+    else:
+        for token, weight in query_tokens:
+            query_norm_tokens.append(token)
+            tf_query[token] += 1 * weight
+
+    norm_query = 0
+    for norm_token in set(query_norm_tokens):
+        offset, size = dictionary.get_offset_and_size_of_term(norm_token)
+
+        if offset == -1:
+            # For unknown words, skip updates
+            continue
+
+        df = dictionary.get_df(norm_token)
+
+        if df == 0 or df == -1:
+            idf = 0
+        else:
+            idf = util.log10(total_docs / df)
+
+        wt = idf * (1 + util.log10(tf_query[norm_token]))
+        norm_query += (wt * wt)
+
+        if size == 0:
+            continue
+
+        if dictionary.has_precomputed_weights():
+            posting_list = postings_file.get_normalised_posting_list(offset, size, dictionary, doc_filter)
+        else:
+            posting_list = postings_file.get_posting_list(offset, size, dictionary, doc_filter)
+
+        posting_list = np.array(posting_list)
+
+        # All the postings of a term may be tombstones of a segmented index, or filtered out
+        if len(posting_list) == 0:
+            continue
+
+        if dictionary.has_precomputed_weights():
+            doc_idx = np.searchsorted(doc_ids, posting_list[:, 0].astype(np.int64))
+            normalised_tf_doc = posting_list[:, 1]
+        else:
+            doc_idx = np.searchsorted(doc_ids, posting_list[:, 0].astype(np.int64))
+            normalised_tf_doc = posting_list[:, 1] / doc_lengths[doc_idx]
+
+        # Keep track of the order in which documents are first scored, to break ties
+        new_doc_idx = doc_idx[~is_scored[doc_idx]]
+        score_order[new_doc_idx] = np.arange(num_scored, num_scored + len(new_doc_idx))
+        is_scored[new_doc_idx] = True
+        num_scored += len(new_doc_idx)
+        first_term[new_doc_idx] = len(scored_terms)
+        scored_terms.append(norm_token)
+
+        # Update document tf-idf scores. DocIDs are unique in a postings list
+        document_score[doc_idx] += wt * normalised_tf_doc
+
+    norm_query = sqrt(norm_query) # Length of query vector
+
+    scored_idx = np.nonzero(is_scored)[0]
+    scored_idx = scored_idx[np.argsort(score_order[scored_idx])]
+    scores = document_score[scored_idx] / norm_query
+    docIds = doc_ids[scored_idx]
+
+    if not is_boolean:
+        # Return ranked documents for free text query
+        ranking = np.arange(len(scores))
+        if k is not None and k < len(scores):
+            # Only the documents with at least the k-th highest score are sorted
+            kth_score = -np.partition(-scores, k - 1)[k - 1] if k > 0 else np.inf
+            ranking = np.nonzero(scores >= kth_score)[0]
+
+        ranking = ranking[np.argsort(-scores[ranking], kind='stable')][:k]
+
+        if with_scores:
+            return [(docId, score, scored_terms[term_idx]) for docId, score, term_idx in 
+                        zip(docIds[ranking].tolist(), scores[ranking].tolist(), first_term[scored_idx][ranking].tolist())]
+
+        return docIds[ranking].tolist()
+
+    # Normalise scores using softmax
+    exp_scores = []
+    for s in scores.tolist():
+        exp_scores.append(math.exp(s))
+    sum_exp_scores = sum(exp_scores)
+
+    doc_scores = []
+    for docId, s in zip(docIds.tolist(), exp_scores):
+        doc_scores.append((docId, s / sum_exp_scores))
+
+    doc_scores = sorted(doc_scores, key=lambda x: x[1])
+
+    return doc_scores
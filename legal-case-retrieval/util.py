@@ -1,4 +1,5 @@
 from collections import defaultdict
+from functools import lru_cache
 import nltk
 import os
 import math
@@ -9,7 +10,19 @@ import sys
 
 
 REMOVE_PUNCTUATION = True
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)  # Deletes punctuation characters
 STEMMER = nltk.stem.porter.PorterStemmer()
+STEM_CACHE_SIZE = 200000  # Words in the vocabulary follow Zipf's law, so most stems are repeated
+BATCH_SEPARATOR = ' # '  # Separates the documents of a batch. Punctuation, so it is not left in any document
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    """
+    Returns the Porter stem of the lowercase word. Stems of recent words are cached.
+    """
+    return STEMMER.stem(word)
+
 
 def preprocess_content(content):
     """
@@ -24,131 +37,101 @@ def preprocess_content(content):
 
     for sentence in sentences:
         if REMOVE_PUNCTUATION:
-            exclude = set(string.punctuation)
-            sentence = ''.join(ch for ch in sentence if ch not in exclude)
+            sentence = sentence.translate(PUNCTUATION_TABLE)
             
         words = nltk.tokenize.word_tokenize(sentence)
         for word in words:
-            terms.append(STEMMER.stem(word.lower()))
+            terms.append(stem(word.lower()))
 
     return terms
 
 
-def format_results(results):
-    """
-    Formats result as required for output file.
-
-    :param results: List of doc IDs.  [10, 3, 7]
-    
-    :return: formatted string. '10 3 7'
+def preprocess_contents(contents):
     """
-    return ' '.join([str(docID) for docID in results]) + '\n'
+    Preprocess many documents at once, with the same tokens as `preprocess_content` for each document.
 
+    The sentences of all the documents are stripped of punctuation and word tokenized in a single
+    pass, instead of one sentence at a time, with the documents separated by BATCH_SEPARATOR. As no
+    punctuation is left, the word tokenizer finds the same words in the joined sentences as in each
+    sentence on its own.
 
-def log10(x):
+    :param contents: iterable of raw content of each document
+    :return: generator of the list of normalised tokens of each document, in order
     """
-    Returns log base 10 for positive input, and zero otherwise.
-    """
-    if x > 0:
-        return math.log(x, 10)
-    
-    return 0
-
+    if not REMOVE_PUNCTUATION:
+        for content in contents:
+            yield preprocess_content(content)
+        return
 
-def positional_intersect(has_2_terms, postings1, postings2, postings3='dummy'):
-    """
-    Performs positional intersect for the postings lists and returns matching documents.
-
-    Params:
-        has_2_terms: Whether the phrasal query has 2 terms. If so, 3rd positional index is unused.
-        postings1, postings2: Positional index [ (docID, positions, log-tf), ... ]
-        postings3: If phrasal query has 3 terms, then positional index [ (docID, positions, log-tf), ... ]
-
-    Returns:
-        postings: [ (docID, log-tf) ]
-    """
+    contents = list(contents)
+    if not contents:
+        return
 
-    i, j, k = 0, 0, 0
-    len1, len2, len3 = len(postings1), len(postings2), len(postings3)
+    text = BATCH_SEPARATOR.join(' '.join(nltk.tokenize.sent_tokenize(content)).translate(PUNCTUATION_TABLE)
+                                for content in contents)
 
-    postings = []
-    while i < len1 and j < len2 and k < len3:
-        # If document IDs are the same
-        if postings1[i][0] == postings2[j][0] and (has_2_terms or postings3[k][0] == postings2[j][0]):
-            curr_document = postings1[i][0]
+    terms = []
+    for word in nltk.tokenize.word_tokenize(text, preserve_line=True):
+        if word == BATCH_SEPARATOR.strip():
+            yield terms
+            terms = []
+        else:
+            terms.append(stem(word.lower()))
 
-            positions1 = postings1[i][1]
-            positions2 = postings2[j][1]
-            positions3 = 'dummy' if has_2_terms else postings3[k][1]
+    yield terms
 
-            poslen1, poslen2, poslen3 = len(positions1), len(positions2), len(positions3)
 
-            phrasal_term_freq = 0
+def get_term_positions(tokens):
+    """
+    Groups the positions of the tokens of a document by term.
 
-            # Get term frequency for phrasal query in this document
-            x = 0
-            while x < poslen1:
-                y = 0
-                while y < poslen2:
-                    if positions2[y] == positions1[x] + 1:
-                        if has_2_terms:
-                            phrasal_term_freq += 1
-                            break
+    :param tokens: list of normalised tokens of the document
+    :return: { term: [position, ...] } with terms in order of first occurrence
+    """
+    term_positions = {}
 
-                        else:
-                            did_find_doc = False
+    for position, token in enumerate(tokens):
+        if token in term_positions:
+            term_positions[token].append(position)
+        else:
+            term_positions[token] = [position]
 
-                            z = 0
-                            while z < poslen3:
-                                if positions3[z] == positions2[y] + 1:
-                                    phrasal_term_freq += 1
+    return term_positions
 
-                                    did_find_doc = True
-                                    break
-                                elif positions3[z] > positions2[y]:
-                                    break
-                                else:
-                                    z += 1
 
-                            if did_find_doc:
-                                break
-                            else:
-                                y += 1
+def remove_clauses(query_str, clause_pattern):
+    """
+    Removes the clauses matching the compiled pattern from the query, with the AND operators
+    of a boolean query that joined them.
 
-                    elif positions2[y] > positions1[x]:
-                        break
-                    else:
-                        y += 1
+    Eg. 'damages AND year:2015' -> 'damages'
+    """
+    query_str = clause_pattern.sub('', query_str)
+    if "AND" in query_str:
+        query_str = ' AND '.join(part.strip() for part in query_str.split('AND') if part.strip())
 
-                x += 1
+    return query_str.strip()
 
-            # Add document to postings if phrasal query occurs in it
-            if phrasal_term_freq > 0:
-                postings.append((curr_document, 1 + log10(phrasal_term_freq)))
 
-            i += 1
-            j += 1
-            k += 0 if has_2_terms else 1
+def format_results(results):
+    """
+    Formats result as required for output file.
 
-        elif has_2_terms:  # Update pointers of 2 query postings
-            if postings1[i][0] < postings2[j][0]:
-                i += 1
-            else:
-                j += 1
+    :param results: List of doc IDs.  [10, 3, 7]
+    
+    :return: formatted string. '10 3 7'
+    """
+    return ' '.join([str(docID) for docID in results]) + '\n'
 
-        else:  # Update pointers of 3 query postings
-            if postings1[i][0] <= postings2[j][0]:
-                if postings1[i][0] <= postings3[k][0]:
-                    i += 1
-                else:
-                    k += 1
-            else:
-                if postings2[j][0] <= postings3[k][0]:
-                    j += 1
-                else:
-                    k += 1
 
-    return postings
+def log10(x):
+    """
+    Returns log base 10 for positive input, and zero otherwise.
+    """
+    if x > 0:
+        return math.log(x, 10)
+    
+    return 0
 
 
 def has_skip(idx, skip_len, total_len):
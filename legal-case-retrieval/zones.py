@@ -0,0 +1,181 @@
+"""
+Zone index of the titles of the documents, for field-scoped query terms and weighted zone scoring.
+
+The title, content, date and court of a document are indexed together as before, and the terms of its title
+are also indexed in the title zone, saved in the dictionary and postings file like those of a term, under the
+zone and the term joined by SEPARATOR. Eg. 'title:neglig'. Punctuation is removed from terms, so zone terms
+cannot collide with terms or biwords. The length of each zone of a document is saved in the dictionary, so that
+the terms of the title are normalised by the length of the title instead of the length of the whole document.
+Zone terms are not part of the document lengths or the document vectors.
+
+A query can scope terms to the title, eg. `title:negligence` or `title:"medical negligence"`. The score of a
+document for a free text query is the weighted sum of the cosine similarities of the query with its zones:
+
+    score = (1 - title_weight) * tf-idf score of the whole document + title_weight * tf-idf score of the title
+
+where the scoped terms are only scored in the title, and the other query terms in the whole document, and also
+in the title if a title weight is given. Queries of only scoped terms are answered from the small postings lists
+of the title zone, without reading the postings lists of the content.
+"""
+import heapq
+import re
+from collections import defaultdict
+from math import sqrt
+
+import tf_idf
+import util
+
+SEPARATOR = ':'
+ZONES = ['title']
+TITLE_WEIGHT = 0.5  # Weight of the title of queries with scoped terms, if no title weight is given
+
+ZONE_CLAUSE = re.compile(r'\b(title):(?:"([^"]*)"|(\S+))')
+
+
+def get_zone_term(zone, term):
+    """
+    Returns the key of the term of the zone in the dictionary. Eg. 'title:neglig'
+    """
+    return zone + SEPARATOR + term
+
+
+def is_zone_term(term):
+    """
+    Returns True if the term of the dictionary is a term of a zone.
+    """
+    return SEPARATOR in term
+
+
+def get_zone_contents(row):
+    """
+    Returns the raw contents of the zones of the document, in the order of ZONES.
+
+    :param row: [docId, title, content, date, court]
+    """
+    return [row[1]]
+
+
+def get_zone_term_positions(zone_tokens):
+    """
+    Groups the term positions of each zone of the document.
+
+    :param zone_tokens: list of normalised tokens of each zone, in the order of ZONES
+    :return: { zone: { term: [position, ...] } } with terms in order of first occurrence
+    """
+    return {zone: util.get_term_positions(tokens) for zone, tokens in zip(ZONES, zone_tokens)}
+
+
+def parse_zone_token(query_token):
+    """
+    Returns the zone and the words of a scoped query token. Eg. 'title:"medical negligence"' -> title, medical negligence
+
+    :return: zone, words. None, None if the token is not scoped
+    """
+    match = ZONE_CLAUSE.fullmatch(query_token.strip())
+    if match is None:
+        return None, None
+
+    return match.group(1), match.group(2) if match.group(2) is not None else match.group(3)
+
+
+def parse_zone_terms(query_str):
+    """
+    Removes the scoped terms from the query.
+
+    Eg. 'damages title:"medical negligence"' -> 'damages', [ ('title:medic', 1), ('title:neglig', 1) ]
+
+    Returns:
+        - query_str: the query without the scoped terms and their AND operators
+        - zone_query: zone terms with term weights [ (zone term, weight), ...]. Empty if no term is scoped
+    """
+    matches = list(ZONE_CLAUSE.finditer(query_str))
+    if not matches:
+        return query_str, []
+
+    zone_query = []
+    for match in matches:
+        words = match.group(2) if match.group(2) is not None else match.group(3)
+        zone_query.extend((get_zone_term(match.group(1), term), 1) for term in util.preprocess_content(words))
+
+    return util.remove_clauses(query_str, ZONE_CLAUSE), zone_query
+
+
+def score_zone(zone_query, dictionary, postings_file, doc_filter=None):
+    """
+    Scores the documents for the zone terms with lnc.ltc, where the documents are normalised
+    by the length of their zone.
+
+    :param zone_query: zone terms with term weights [ (zone term, weight), ...]
+    :return: cosine similarities of the documents with the zone terms { docID: score }
+    """
+    tf_query = defaultdict(int)
+    for term, weight in zone_query:
+        tf_query[term] += 1 * weight
+
+    total_docs = dictionary.get_doc_count()
+    document_score = defaultdict(float)
+    norm_query = 0
+
+    for term, tf in tf_query.items():
+        offset, size = dictionary.get_offset_and_size_of_term(term)
+        if offset == -1:
+            continue
+
+        df = dictionary.get_df(term)
+        idf = 0 if df == 0 or df == -1 else util.log10(total_docs / df)
+
+        wt = idf * (1 + util.log10(tf))
+        norm_query += (wt * wt)
+
+        posting_list = postings_file.get_posting_list(offset, size, dictionary, doc_filter)
+
+        zone = term.split(SEPARATOR, 1)[0]
+        for doc_id, log_tf in posting_list:
+            document_score[doc_id] += wt * log_tf / dictionary.get_zone_doc_length(zone, str(doc_id))
+
+    if norm_query == 0:
+        return {}
+
+    norm_query = sqrt(norm_query)
+
+    return {doc_id: score / norm_query for doc_id, score in document_score.items()}
+
+
+def eval_zone_query(query_tokens, zone_query, dictionary, postings_file, title_weight=None, k=None, is_rocchio=False,
+                    doc_filter=None, with_scores=False):
+    """
+    Ranks the documents of a free text query by the weighted sum of the scores of their zones.
+
+    :param query_tokens: query terms with term weights [ (term, weight), ...], or the Rocchio query { term: weight } if is_rocchio
+    :param zone_query: scoped zone terms with term weights [ (zone term, weight), ...]
+    :param title_weight: weight of the title, with which the query terms are also scored in the title.
+    None to only score the scoped terms in the title, with TITLE_WEIGHT
+    :param k: number of top ranked results to return. None to return all results
+    :param doc_filter: Bitmap of the documents to score. None to score all documents
+    :param with_scores: Whether to return the scores of the results
+    :return: ranked results, of equal scores in order of docID. [ docID, ... ] or [ (docID, score), ... ] if with_scores
+    """
+    query_terms = list(query_tokens.items()) if is_rocchio else query_tokens
+
+    zone_query = list(zone_query)
+    if title_weight is not None:
+        zone_query.extend((get_zone_term('title', term), weight) for term, weight in query_terms)
+    else:
+        title_weight = TITLE_WEIGHT
+
+    scores = defaultdict(float)
+
+    if query_terms:
+        for doc_id, score, _ in tf_idf.eval_free_text_query(query_tokens, dictionary, postings_file, False, is_rocchio,
+                                                            True, doc_filter):
+            scores[doc_id] += (1 - title_weight) * score
+
+    for doc_id, score in score_zone(zone_query, dictionary, postings_file, doc_filter).items():
+        scores[doc_id] += title_weight * score
+
+    ranking = heapq.nsmallest(len(scores) if k is None else k, scores.items(), key=lambda doc: (-doc[1], doc[0]))
+
+    if with_scores:
+        return ranking
+
+    return [doc_id for doc_id, _ in ranking]